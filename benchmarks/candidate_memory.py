@@ -0,0 +1,57 @@
+# Measures the memory used to hold a pool of candidate posts, comparing the
+# full PRAW Submission objects that come back from a listing with the FoodPost
+# projections that the bot keeps instead.
+# Run from the root of the repository:
+#   python -m benchmarks.candidate_memory [number of candidates]
+from praw.models import Submission
+from typing import Callable, List
+import gc
+import sys
+import tracemalloc
+from food_post import FoodPost
+
+
+CANDIDATES = 10000
+
+
+# a stand in for the fields of a listing item. Real submissions have around a
+# hundred fields, most of which the bot never reads
+def submission_data(i: int) -> dict:
+    data = {f'field_{n}': f'value {n} for submission {i}' for n in range(80)}
+    data.update({
+        'id': f'id{i}',
+        'name': f't3_id{i}',
+        'title': f'[Homemade] Candidate post number {i}',
+        'url': f'https://i.redd.it/{i}.jpg',
+        'permalink': f'/r/FoodPorn/comments/id{i}/candidate_post_number_{i}/',
+        'is_self': False,
+        'score': i,
+        'num_comments': i % 100,
+        'created_utc': 1600000000.0 + i,
+        'preview': {'images': [{'source': {'url': f'https://preview.redd.it/{i}.jpg', 'width': 1080}}]},
+    })
+    return data
+
+
+# returns the number of bytes still allocated after building the objects
+def measure(build: Callable[[], List]) -> int:
+    gc.collect()
+    tracemalloc.start()
+    objects = build()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return size
+
+
+def main(count: int) -> None:
+    submissions = measure(lambda: [Submission(None, _data=submission_data(i)) for i in range(count)])
+    posts = measure(lambda: [FoodPost.from_submission(Submission(None, _data=submission_data(i))) for i in range(count)])
+    print(f'{count} candidates')
+    print(f'  Submission: {submissions / 1024 / 1024:8.2f} MiB ({submissions // count} bytes each)')
+    print(f'  FoodPost:   {posts / 1024 / 1024:8.2f} MiB ({posts // count} bytes each)')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else CANDIDATES)
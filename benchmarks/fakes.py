@@ -0,0 +1,101 @@
+# In-memory stand ins for Reddit and Redis, so that the benchmarks measure
+# the bot's own code instead of the network.
+from functools import partial
+from typing import Dict, Iterator, List, Optional
+
+
+# a listing item with roughly the fields that Reddit returns for a submission
+class FakeSubmission:
+    def __init__(self, submission_id: str, title: str, subreddit: str = 'FoodPorn'):
+        self.id = submission_id
+        self.name = f't3_{submission_id}'
+        self.title = title
+        self.subreddit = FakeSubreddit(subreddit)
+        self.url = f'https://i.redd.it/{submission_id}.jpg'
+        self.permalink = f'/r/{subreddit}/comments/{submission_id}/{title.lower().replace(" ", "_")}/'
+        self.is_self = False
+        self.is_video = False
+        self.score = 1000
+        self.num_comments = 100
+        self.preview = {'images': [{'source': {'url': f'https://preview.redd.it/{submission_id}.jpg'}}]}
+
+    @property
+    def fullname(self) -> str:
+        return self.name
+
+
+# a subreddit (or several joined with '+') whose listings are generated on
+# demand. Each listing is `size` submissions long, and supports resuming
+# from the fullname of a submission through `params={'after': ...}`
+class FakeSubreddit:
+    def __init__(self, display_name: str, size: int = 1000, titles: Optional[List[str]] = None):
+        self.display_name = display_name
+        self.size = size
+        self.titles = titles or ['Homemade beef pho', 'Tonkotsu ramen', 'Margherita pizza', 'Fish tacos']
+
+    def _listing(self, name: str, limit: int, params: Optional[Dict] = None) -> Iterator[FakeSubmission]:
+        after = (params or {}).get('after')
+        start = 0 if after is None else int(after[len(f't3_{name}'):]) + 1
+        for i in range(start, min(start + limit, self.size)):
+            yield FakeSubmission(f'{name}{i}', f'{self.titles[i % len(self.titles)]} {i}', self.display_name)
+
+    def hot(self, limit: int, params: Optional[Dict] = None) -> Iterator[FakeSubmission]:
+        return self._listing('hot', limit, params)
+
+    def new(self, limit: int, params: Optional[Dict] = None) -> Iterator[FakeSubmission]:
+        return self._listing('new', limit, params)
+
+    def top(self, limit: int, params: Optional[Dict] = None) -> Iterator[FakeSubmission]:
+        return self._listing('top', limit, params)
+
+
+class FakeReddit:
+    def __init__(self, size: int = 1000):
+        self.size = size
+
+    def subreddit(self, name: str) -> FakeSubreddit:
+        return FakeSubreddit(name, self.size)
+
+
+# only implements the commands used by the benchmarked code paths
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, command: str):
+        method = getattr(self.client, command)
+        return lambda *args, **kwargs: self.commands.append(partial(method, *args, **kwargs))
+
+    def execute(self) -> list:
+        return [command() for command in self.commands]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.sorted_sets = {}
+        self.streams = {}  # name -> [(entry ID, fields)]
+
+    def pipeline(self, transaction: bool = True) -> FakePipeline:
+        return FakePipeline(self)
+
+    def zadd(self, name: str, mapping: Dict[str, float]) -> int:
+        self.sorted_sets.setdefault(name, {}).update(mapping)
+        return len(mapping)
+
+    def zscore(self, name: str, member: str) -> Optional[float]:
+        return self.sorted_sets.get(name, {}).get(member)
+
+    def xadd(self, name: str, fields: Dict[str, str], maxlen: int = None, approximate: bool = True) -> str:
+        stream = self.streams.setdefault(name, [])
+        entry_id = f'{len(stream) + 1}-0'
+        stream.append((entry_id, fields))
+        return entry_id
+
+    def xrange(self, name: str, min: str = '-', max: str = '+', count: int = None) -> list:
+        return self.streams.get(name, [])[:count]
+
+    def xread(self, streams: Dict[str, str], count: int = None, block: int = None) -> list:
+        name, last = next(iter(streams.items()))
+        entries = self.streams.get(name, [])[int(last.split('-')[0]):][:count]
+        return [[name, entries]] if len(entries) > 0 else []
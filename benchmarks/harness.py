@@ -0,0 +1,80 @@
+# Registers, times and compares the benchmarks. See `benchmarks.run`.
+from typing import Callable, Dict, List, Optional
+import asyncio
+import json
+import os
+import statistics
+import time
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# Fraction that a benchmark may get slower than its baseline before it fails
+TOLERANCE = 0.5
+ROUNDS = 30
+WARMUP_ROUNDS = 3
+
+# name -> function that sets up the benchmark, and returns the function to time
+registry = {}
+# name -> most rounds that the benchmark is run for, for the benchmarks that are too slow to run ROUNDS times
+max_rounds = {}
+
+
+# registers a benchmark. The decorated function is called once to set up,
+# and returns the function that is timed. If it returns a coroutine, that is run to completion
+def benchmark(name: str, rounds: Optional[int] = None):
+    def register(setup: Callable[[], Callable]):
+        registry[name] = setup
+        if rounds is not None:
+            max_rounds[name] = rounds
+        return setup
+    return register
+
+
+# times `rounds` calls of the benchmark, and returns the statistics in seconds
+def measure(setup: Callable[[], Callable], rounds: int = ROUNDS, warmup: int = WARMUP_ROUNDS) -> Dict[str, float]:
+    loop = asyncio.new_event_loop()
+    try:
+        func = setup()
+
+        def call():
+            result = func()
+            if asyncio.iscoroutine(result):
+                loop.run_until_complete(result)
+        for _ in range(warmup):
+            call()
+        timings = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - start)
+    finally:
+        loop.close()
+    return {'median': statistics.median(timings), 'min': min(timings), 'max': max(timings), 'rounds': rounds}
+
+
+# returns a description of each benchmark that is slower than its baseline by more than the tolerance.
+# benchmarks that aren't in the baseline yet are skipped
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            tolerance: float = TOLERANCE) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['median'], result['median']
+        if after > before * (1 + tolerance):
+            regressions.append(f'{name}: {after * 1000:.3f}ms, was {before * 1000:.3f}ms '
+                               f'({(after / before - 1):+.0%})')
+    return regressions
+
+
+def load_baseline(path: str = BASELINE_PATH) -> Optional[Dict[str, Dict[str, float]]]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(results: Dict[str, Dict[str, float]], path: str = BASELINE_PATH) -> None:
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
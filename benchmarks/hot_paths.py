@@ -0,0 +1,108 @@
+# Benchmarks for the paths that run on every post: fetching and deduplicating
+# candidates, searching, building posts and embeds, and picking the channel
+# to post to. Reddit and Redis are replaced with the in-memory fakes, and the
+# image checks with an in-memory cache that has already seen every URL.
+from benchmarks.fakes import FakeReddit, FakeRedis, FakeSubmission
+from benchmarks.harness import benchmark
+from typing import Dict, List
+import logging
+import random
+import time
+import redis_connector
+import reddit_client
+from food_post import FoodPost
+from food_waifu import MAX_ALLOWED_SEARCH_SIZE, FoodWaifu
+from image_resolver import ImageResolver
+from utility import build_query, get_text_channel
+from mock_discord import DummyChannel, DummyGuild
+
+
+SUBS = ['FoodPorn', 'food']
+LISTING_SIZE = 1000
+SEARCH_INDEX_SIZE = 10000
+GUILD_CHANNELS = 500
+
+
+async def all_valid(keys: List[str]) -> Dict[str, bool]:
+    return {key: True for key in keys}
+
+
+async def discard(results: Dict[str, bool], positive_ttl: float, negative_ttl: float) -> None:
+    pass
+
+
+# replaces the Redis client with a fake one, where the first `saturation`
+# fraction of the submissions that are read from every listing were already posted
+def use_fake_redis(saturation: float) -> None:
+    redis_connector.r = FakeRedis()
+    redis_connector.used_posts.clear()
+    used = [f'{name}{i}' for name in ('hot', 'new', 'top') for i in range(int(MAX_ALLOWED_SEARCH_SIZE * saturation))]
+    now = redis_connector.clock()
+    redis_connector.r.zadd(redis_connector.POSTED_AT_KEY, {post_id: now for post_id in used})
+    redis_connector.used_posts.update(used)
+    redis_connector.used_posts_synced_to = redis_connector.r.xadd(redis_connector.RECORDED_POSTS_KEY, {'ids': ''})
+    redis_connector.used_posts_synced_at = time.monotonic()
+    redis_connector.used_posts_warm = True
+
+
+# the app, with a fake Reddit, an in-memory search index and image checks
+def create_app() -> FoodWaifu:
+    # every round pages through the listings again, instead of reading them from the cache,
+    # and the fake doesn't report a rate limit, so the budget has to be big enough for all of them
+    app = FoodWaifu(SUBS, logging.getLogger('benchmarks'),
+                    reddit_factory=lambda: reddit_client.RedditClient(FakeReddit(LISTING_SIZE),
+                                                                      reddit_client.RateBudget(capacity=10 ** 9),
+                                                                      cache_ttl=0),
+                    search_index_path=':memory:')
+    app.image_resolver = ImageResolver(all_valid, discard)
+    return app
+
+
+def saturation_benchmark(saturation: float):
+    def setup():
+        use_fake_redis(saturation)
+        app = create_app()
+        return lambda: app.get_submission_from_subs(SUBS)
+    return setup
+
+
+for percent in (0, 90, 99):
+    benchmark(f'get_submission_from_subs[{percent}% used]')(saturation_benchmark(percent / 100))
+
+
+# the local search path of search_submission_from_subs, over a full index
+@benchmark('search_submission_from_subs[local index]')
+def search_submission_from_subs():
+    use_fake_redis(0)
+    app = create_app()
+    app.search_index.add_submissions(FakeSubmission(f'p{i}', f'{random.choice(["Beef", "Pork"])} pho {i}')
+                                     for i in range(SEARCH_INDEX_SIZE))
+    query = build_query(['beef', 'pho'])
+    return lambda: app.search_submission_from_subs(SUBS, query)
+
+
+@benchmark('FoodPost.from_submission[100 submissions]')
+def from_submission():
+    submissions = [FakeSubmission(f'p{i}', f'Post {i}') for i in range(100)]
+    return lambda: [FoodPost.from_submission(s) for s in submissions]
+
+
+@benchmark('FoodPost.to_embed[100 new posts]')
+def to_embed():
+    submissions = [FakeSubmission(f'p{i}', f'Post {i}') for i in range(100)]
+    return lambda: [FoodPost.from_submission(s).to_embed() for s in submissions]
+
+
+@benchmark('FoodPost.to_embed[1 post, 100 guilds]')
+def to_embed_shared():
+    post = FoodPost.from_submission(FakeSubmission('p', 'Post'))
+    return lambda: [post.to_embed() for _ in range(100)]
+
+
+# the only channel the bot can post to is the last one
+@benchmark(f'get_text_channel[{GUILD_CHANNELS} channels]')
+def text_channel():
+    channels = [DummyChannel(i, i, can_send=i == GUILD_CHANNELS - 1) for i in range(GUILD_CHANNELS)]
+    random.shuffle(channels)
+    guild = DummyGuild(1, channels)
+    return lambda: get_text_channel(guild)
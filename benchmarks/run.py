@@ -0,0 +1,52 @@
+# Runs the benchmarks in `benchmarks.hot_paths` and `benchmarks.startup`, and compares the results
+# against the JSON baseline. A benchmark whose median time got slower than
+# the baseline by more than the tolerance is a regression, and makes the run
+# fail. Run from the root of the repository:
+#   python -m benchmarks.run                # compare against the baseline
+#   python -m benchmarks.run --save         # record a new baseline
+#   python -m benchmarks.run -k saturation  # only the benchmarks whose name contains "saturation"
+# Timings depend on the machine, so record the baseline on the machine that
+# the comparison runs on.
+from benchmarks.harness import BASELINE_PATH, ROUNDS, TOLERANCE, compare, load_baseline, max_rounds, measure, \
+    registry, save_baseline
+from typing import List
+import argparse
+import benchmarks.hot_paths  # noqa: F401 registers the benchmarks
+import benchmarks.startup  # noqa: F401
+import sys
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of the bot')
+    parser.add_argument('--save', action='store_true', help='record the results as the new baseline')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='path of the JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='fraction that a benchmark may get slower before it fails')
+    parser.add_argument('--rounds', type=int, default=ROUNDS)
+    parser.add_argument('-k', dest='keyword', default='', help='only run benchmarks whose name contains this')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name in sorted(registry):
+        if args.keyword in name:
+            results[name] = measure(registry[name], min(args.rounds, max_rounds.get(name, args.rounds)))
+            print(f'{name:<45} {results[name]["median"] * 1000:10.3f}ms median')
+
+    if args.save:
+        baseline = load_baseline(args.baseline) or {}
+        baseline.update(results)
+        save_baseline(baseline, args.baseline)
+        print(f'Saved {len(results)} results to {args.baseline}')
+        return 0
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        print(f'No baseline at {args.baseline}, run with --save to record one')
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
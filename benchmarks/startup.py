@@ -0,0 +1,21 @@
+# Benchmarks the bot's cold start, which is on the critical path of every pm2
+# or Heroku restart: a new interpreter imports `food_waifu`, and creates the
+# app and its Discord client. That is everything the bot does before it
+# connects to Discord, which the benchmark stops short of.
+from benchmarks.harness import benchmark
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = 'import food_waifu; food_waifu.create_app().bot'
+
+
+@benchmark('food_waifu cold start', rounds=10)
+def cold_start():
+    env = dict(os.environ, SUBREDDITS='FoodPorn,food')
+
+    def start():
+        subprocess.run([sys.executable, '-c', SCRIPT], env=env, cwd=ROOT, check=True)
+    return start
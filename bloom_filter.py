@@ -0,0 +1,74 @@
+# In-process Bloom filter, used to answer "has this post been used?" without
+# a Redis round trip. A Bloom filter never gives a false negative, so if it
+# says a post ID was never added, the post is definitely unused. If it says
+# the ID might have been added, the caller has to confirm with Redis.
+# https://en.wikipedia.org/wiki/Bloom_filter
+from hashlib import blake2b
+from typing import Iterable, List
+import math
+import threading
+
+
+class BloomFilter:
+    # Attributes
+    # capacity - number of items the filter is sized for
+    # error_rate - target false positive rate once the filter holds `capacity` items
+    # size - number of bits in the filter
+    # hash_count - number of bits set for each item
+    # count - number of items added so far
+    def __init__(self, capacity: int = 1000000, error_rate: float = 0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+        # items are added from several worker threads, and setting a bit is a read-modify-write
+        # of its byte. A bit lost to a race would be a false negative
+        self._lock = threading.Lock()
+
+    # derives the bit positions for an item from two halves of one digest
+    # (Kirsch-Mitzenmacher double hashing)
+    def _positions(self, item: str) -> Iterable[int]:
+        digest = blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str) -> None:
+        positions = list(self._positions(item))
+        with self._lock:
+            self._set_bits(positions)
+
+    def update(self, items: Iterable[str]) -> None:
+        positions = [list(self._positions(item)) for item in items]
+        with self._lock:
+            for item_positions in positions:
+                self._set_bits(item_positions)
+
+    # must be called with the lock held
+    def _set_bits(self, positions: List[int]) -> None:
+        for position in positions:
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    # returns False if the item was definitely never added
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+    # remove every item from the filter
+    def clear(self) -> None:
+        with self._lock:
+            self._bits = bytearray(len(self._bits))
+            self.count = 0
+
+    # estimated probability that an item that was never added is reported as present,
+    # given the number of items added so far
+    @property
+    def false_positive_rate(self) -> float:
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+    # number of bytes used by the bit array
+    @property
+    def memory_bytes(self) -> int:
+        return len(self._bits)
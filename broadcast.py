@@ -0,0 +1,167 @@
+# Helpers for the scheduled broadcast, which posts a picture to every
+# connected guild at once. Posts are assigned to all of the guilds in a
+# single pass over one batch of candidates, instead of fetching a new post
+# from Reddit for each guild that has already seen the shared one, and are
+# then sent to all of the guilds concurrently.
+# When the bot runs as several shard processes, each process posts to its own
+# guilds, and `SharedSelection` makes them all post from the same candidates.
+from typing import Awaitable, Callable, Collection, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+import asyncio
+import json
+import logging
+import os
+import time
+from food_post import FoodPost
+
+
+# The value persisted in Redis for a post that was shared by the broadcast
+BROADCAST_SERVER = 'all'
+# Maximum number of messages being sent at the same time during a broadcast
+SEND_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '10'))
+# Maximum number of messages started per second. Discord's global rate limit
+# is 50 requests per second for a bot, so this leaves headroom for commands.
+SEND_RATE = float(os.environ.get('BROADCAST_RATE', '40'))
+# Seconds that a process has to select a broadcast's candidates, before another process takes over
+SELECTION_LEASE = float(os.environ.get('BROADCAST_SELECTION_LEASE', '120'))
+
+
+# takes the guilds to post to, the ordered candidate posts, and the IDs of the
+# candidates each guild has already seen, and returns the post for each guild.
+# Every guild gets the first candidate it hasn't seen, so the first candidate
+# is shared by as many guilds as possible. Guilds that have seen every
+# candidate are left out of the result.
+def assign_posts(guild_ids: Iterable[Hashable],
+                 candidates: List[FoodPost],
+                 seen: Dict[Hashable, Set[str]]) -> Dict[Hashable, FoodPost]:
+    assignments = {}
+    for guild_id in guild_ids:
+        guild_seen = seen.get(guild_id, set())
+        for post in candidates:
+            if post.id not in guild_seen:
+                assignments[guild_id] = post
+                break
+    return assignments
+
+
+# takes the result of assign_posts, and returns the post ID -> server records
+# to persist in Redis. A post that went to more than one guild is recorded as
+# a broadcast post, and any other post is recorded with the guild it went to.
+# The `shared` posts are always recorded as broadcast posts, because other
+# processes may have posted them to their guilds too.
+def records_for(assignments: Dict[Hashable, FoodPost], shared: Collection[str] = ()) -> Dict[str, str]:
+    guilds_per_post = {}
+    for guild_id, post in assignments.items():
+        guilds_per_post.setdefault(post.id, []).append(guild_id)
+    records = {}
+    for post_id, guild_ids in guilds_per_post.items():
+        is_shared = len(guild_ids) > 1 or post_id in shared
+        records[post_id] = BROADCAST_SERVER if is_shared else str(guild_ids[0])
+    return records
+
+
+# Makes every process that posts the same broadcast use the same candidates.
+# The first process to take the broadcast's lease in Redis selects the
+# candidates, and publishes them along with the time they were selected.
+# The other processes wait for them to be published. If the selecting process
+# dies, its lease expires, and the next process to take it selects instead.
+class SharedSelection:
+    # Attributes
+    # acquire - coroutine function that takes a key and a TTL, and returns True if it took the key's lease
+    # load - coroutine function that takes a key, and returns its published selection, or None
+    # save - coroutine function that takes a key, a selection and a TTL, and publishes the selection
+    # lease - seconds that the selecting process has to publish the candidates
+    # ttl - seconds that a published selection is kept for
+    # poll_interval - seconds between checks for a selection, while another process is selecting
+    def __init__(self,
+                 acquire: Callable[[str, float], Awaitable[bool]],
+                 load: Callable[[str], Awaitable[Optional[str]]],
+                 save: Callable[[str, str, float], Awaitable],
+                 lease: float = SELECTION_LEASE,
+                 ttl: float = 2 * 60 * 60,
+                 poll_interval: float = 1,
+                 clock: Callable[[], float] = time.time):
+        self.acquire = acquire
+        self.load = load
+        self.save = save
+        self.lease = lease
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.clock = clock
+
+    # returns the candidates for the broadcast identified by `key`, and the time
+    # they were selected. `select` is only called if this process selects them.
+    async def get(self, key: str, select: Callable[[], Awaitable[List[FoodPost]]]) -> Tuple[List[FoodPost], float]:
+        while True:
+            payload = await self.load(key)
+            if payload is not None:
+                selection = json.loads(payload)
+                return [FoodPost.from_dict(d) for d in selection['posts']], selection['selected_at']
+            if await self.acquire(key, self.lease):
+                posts = await select()
+                selected_at = self.clock()
+                payload = json.dumps({'selected_at': selected_at, 'posts': [p.to_dict() for p in posts]})
+                await self.save(key, payload, self.ttl)
+                return posts, selected_at
+            await asyncio.sleep(self.poll_interval)
+
+
+# Outcome of sending a broadcast to every guild
+class FanOutResult:
+    # Attributes
+    # sent - IDs of the guilds the broadcast was delivered to
+    # failed - guild ID -> exception, for the guilds where sending raised
+    # elapsed - wall time of the whole fan-out, in seconds
+    def __init__(self):
+        self.sent = []
+        self.failed = {}
+        self.elapsed = 0.0
+
+    def __str__(self):
+        return f'sent to {len(self.sent)} guilds, {len(self.failed)} failed, in {self.elapsed:.2f}s'
+
+
+# Spaces out the start of each send so that no more than `rate` sends start per second
+class _Pacer:
+    def __init__(self, rate: float, clock: Callable[[], float]):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.clock = clock
+        self.next_start = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        async with self.lock:
+            delay = self.next_start - self.clock()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_start = max(self.clock(), self.next_start) + self.interval
+
+
+# takes guild ID -> coroutine function that sends that guild's message, and runs
+# them concurrently, with at most `concurrency` in flight and at most `rate`
+# started per second. discord.py retries rate limited requests on its own
+# per-route and global buckets, so the cap only keeps us from piling requests
+# onto those buckets. A failure for one guild is logged, and doesn't affect the rest.
+async def fan_out(sends: Dict[Hashable, Callable[[], Awaitable]],
+                  concurrency: int = SEND_CONCURRENCY,
+                  rate: float = SEND_RATE,
+                  logger: Optional[logging.Logger] = None,
+                  clock: Callable[[], float] = time.monotonic) -> FanOutResult:
+    result = FanOutResult()
+    start = clock()
+    semaphore = asyncio.Semaphore(concurrency)
+    pacer = _Pacer(rate, clock)
+
+    async def send_to_guild(guild_id, send):
+        async with semaphore:
+            await pacer.wait()
+            try:
+                await send()
+                result.sent.append(guild_id)
+            except Exception as e:
+                result.failed[guild_id] = e
+                if logger is not None:
+                    logger.error(f'Failed to send broadcast to guild {guild_id}: {repr(e)}')
+
+    await asyncio.gather(*[send_to_guild(guild_id, send) for guild_id, send in sends.items()])
+    result.elapsed = clock() - start
+    return result
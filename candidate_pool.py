@@ -0,0 +1,125 @@
+# Keeps a warm, bounded pool of FoodPost candidates that have not been posted
+# yet, so that a command can be answered without waiting on a Reddit listing.
+# A background task refills the pool whenever it drops below its low
+# watermark, and entries older than the max age are discarded, since a post
+# that was hot an hour ago may be stale, or may have been posted since.
+# Every candidate is re-validated against Redis when it is taken.
+from collections import deque
+from typing import Awaitable, Callable, Iterable, List, Optional
+import asyncio
+import logging
+import random
+import time
+from food_post import FoodPost
+
+
+class CandidatePool:
+    # Attributes
+    # fetch - coroutine function that returns a list of unused FoodPost candidates
+    # filter_unused - coroutine function that takes a list of post IDs, and returns the unused ones
+    # max_size - the maximum number of candidates held at once
+    # low_watermark - refill the pool when it holds fewer candidates than this
+    # max_age - number of seconds a candidate is allowed to stay in the pool
+    # retry_delay - number of seconds to wait after a refill that failed or came up short
+    def __init__(self,
+                 fetch: Callable[[], Awaitable[List[FoodPost]]],
+                 filter_unused: Callable[[List[str]], Awaitable[List[str]]],
+                 max_size: int = 50,
+                 low_watermark: int = 10,
+                 max_age: float = 600,
+                 retry_delay: float = 60,
+                 logger: Optional[logging.Logger] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.fetch = fetch
+        self.filter_unused = filter_unused
+        self.max_size = max_size
+        self.low_watermark = low_watermark
+        self.max_age = max_age
+        self.retry_delay = retry_delay
+        self.logger = logger
+        self.clock = clock
+        self._entries = deque()  # (FoodPost, time added) pairs, in the order they will be taken
+        self._ids = set()
+        self._refill_needed = None  # created lazily, so it binds to the running event loop
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _event(self) -> asyncio.Event:
+        if self._refill_needed is None:
+            self._refill_needed = asyncio.Event()
+        return self._refill_needed
+
+    # drop the entries at the front of the pool that are older than max_age.
+    # entries are added in time order, so this stops at the first fresh one
+    def _expire(self) -> None:
+        cutoff = self.clock() - self.max_age
+        while len(self._entries) > 0 and self._entries[0][1] < cutoff:
+            post, _ = self._entries.popleft()
+            self._ids.discard(post.id)
+
+    # add the given posts to the pool, skipping ones it already holds,
+    # and return the number of posts that were added
+    def add(self, posts: Iterable[FoodPost]) -> int:
+        new_posts = [p for p in posts if p.id not in self._ids]
+        # shuffle so that taking from the front is still a random pick
+        random.shuffle(new_posts)
+        now = self.clock()
+        added = 0
+        for post in new_posts:
+            if len(self._entries) >= self.max_size:
+                break
+            self._entries.append((post, now))
+            self._ids.add(post.id)
+            added += 1
+        return added
+
+    # fetch a new batch of candidates and add them to the pool
+    async def refill(self) -> int:
+        self._expire()
+        added = self.add(await self.fetch())
+        if self.logger is not None:
+            self.logger.info(f'Added {added} candidates to the pool, which now holds {len(self)}')
+        return added
+
+    # take the next candidate that is still unused, or None if the pool ran dry.
+    # wakes up the background task if the pool drops below its low watermark
+    async def take(self) -> Optional[FoodPost]:
+        try:
+            while True:
+                self._expire()
+                if len(self._entries) < 1:
+                    return None
+                post, _ = self._entries.popleft()
+                self._ids.discard(post.id)
+                if len(await self.filter_unused([post.id])) > 0:
+                    return post
+        finally:
+            if len(self._entries) < self.low_watermark:
+                self._event().set()
+
+    # background task that keeps the pool topped up. Runs until cancelled
+    async def run(self) -> None:
+        refill_needed = self._event()
+        while True:
+            refill_needed.clear()
+            self._expire()
+            if len(self._entries) < self.low_watermark:
+                try:
+                    added = await self.refill()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if self.logger is not None:
+                        self.logger.error(f'Failed to refill the candidate pool: {repr(e)}')
+                    added = 0
+                if added == 0 or len(self._entries) < self.low_watermark:
+                    # the listing didn't have enough new posts, so back off
+                    # instead of fetching the same listing again right away
+                    await asyncio.sleep(self.retry_delay)
+                continue
+            try:
+                # wake up at least once per max_age, so expired entries get replaced
+                await asyncio.wait_for(refill_needed.wait(), self.max_age)
+            except asyncio.TimeoutError:
+                pass
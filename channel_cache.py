@@ -0,0 +1,63 @@
+# Caches the channel that the bot posts to in each guild, so that the
+# scheduled broadcast doesn't have to walk every channel and compute
+# permissions for each one every hour. The bot invalidates a guild's entry
+# whenever an event could change which channel it is allowed to post in.
+# Resolved channels can be persisted (see redis_connector), so the cache
+# survives restarts. A persisted channel is checked once when it is loaded,
+# in case things changed while the bot was offline.
+from typing import Awaitable, Callable, Optional
+from discord import TextChannel
+from utility import get_text_channel, can_send_messages
+
+
+class ChannelCache:
+    # Attributes
+    # load - optional coroutine function that takes a guild ID and returns the persisted channel ID
+    # save - optional coroutine function that takes a guild ID and channel ID, and persists them
+    # delete - optional coroutine function that takes a guild ID and forgets its persisted channel
+    def __init__(self,
+                 load: Optional[Callable[[int], Awaitable[Optional[int]]]] = None,
+                 save: Optional[Callable[[int, int], Awaitable]] = None,
+                 delete: Optional[Callable[[int], Awaitable]] = None):
+        self.load = load
+        self.save = save
+        self.delete = delete
+        self._channels = {}  # guild ID -> resolved channel, or None if there isn't one
+        self._stale = set()  # guilds whose persisted channel can't be trusted anymore
+
+    # returns the channel to post to in the given guild, or None if there isn't one
+    async def get(self, guild) -> Optional[TextChannel]:
+        if guild.id in self._channels:
+            return self._channels[guild.id]
+        channel = None
+        if self.load is not None and guild.id not in self._stale:
+            channel = self._verify(guild, await self.load(guild.id))
+        if channel is None:
+            channel = get_text_channel(guild)
+            if channel is not None and self.save is not None:
+                await self.save(guild.id, channel.id)
+        self._stale.discard(guild.id)
+        self._channels[guild.id] = channel
+        return channel
+
+    # takes a persisted channel ID, and returns the channel if the bot can still post to it
+    @staticmethod
+    def _verify(guild, channel_id: Optional[int]) -> Optional[TextChannel]:
+        if channel_id is None:
+            return None
+        channel = guild.get_channel(int(channel_id))
+        if isinstance(channel, TextChannel) and can_send_messages(channel, guild.me):
+            return channel
+        return None
+
+    # forget the resolved channel for the guild, so the next lookup resolves it again
+    def invalidate(self, guild_id: int) -> None:
+        self._channels.pop(guild_id, None)
+        self._stale.add(guild_id)
+
+    # forget the guild entirely, including its persisted channel
+    async def remove(self, guild_id: int) -> None:
+        self._channels.pop(guild_id, None)
+        self._stale.discard(guild_id)
+        if self.delete is not None:
+            await self.delete(guild_id)
@@ -0,0 +1,74 @@
+# Circuit breaker for the calls to a service that can go down, such as Redis.
+# After `failure_threshold` failures in a row the breaker opens, and calls
+# fail fast instead of each waiting on a timeout. Once it has been open for
+# `reset_timeout` seconds, it lets a single trial call through (half open).
+# If the trial succeeds the breaker closes again, and if it fails the breaker
+# stays open for another `reset_timeout` seconds.
+# https://martinfowler.com/bliki/CircuitBreaker.html
+from typing import Callable, Optional
+import threading
+import time
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    # Attributes
+    # failure_threshold - number of failures in a row that opens the breaker
+    # reset_timeout - seconds the breaker stays open, before it lets a trial call through
+    # clock - source of the current time, in seconds
+    # on_change - function that is called with the new state, whenever the state changes
+    # state - CLOSED, OPEN or HALF_OPEN
+    # failures - number of failures in a row so far
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30,
+                 clock: Callable[[], float] = time.monotonic,
+                 on_change: Optional[Callable[[str], None]] = None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.on_change = on_change
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        # the calls are made from several worker threads
+        self._lock = threading.Lock()
+
+    # returns True if a call may be made now. Every call that is allowed has
+    # to be followed by `record_success` or `record_failure`
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == OPEN:
+                if self.clock() - self._opened_at < self.reset_timeout:
+                    return False
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                # only the one trial call is let through
+                if self._trial_in_flight:
+                    return False
+                self._trial_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._trial_in_flight = False
+            if self.state != CLOSED:
+                self._set_state(CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self._opened_at = self.clock()
+                if self.state != OPEN:
+                    self._set_state(OPEN)
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        if self.on_change is not None:
+            self.on_change(state)
@@ -0,0 +1,212 @@
+# Delivers the scheduled posts through a work queue in Redis, so that picking
+# the posts and sending them to Discord are separate stages. The broadcast adds
+# one job per guild to a Redis Stream, and workers read the jobs through a
+# consumer group, send them, and acknowledge them once they are sent and recorded.
+# https://redis.io/topics/streams-intro
+# A job that fails to send isn't acknowledged, so it stays pending, and is taken
+# over and retried once it has been idle for `retry_after` seconds. After it has
+# been tried `max_attempts` times, it's moved to the dead letter stream instead.
+# Delivery is at least once: a worker that dies after sending a job, but before
+# acknowledging it, leaves the job to be sent again by another worker.
+from food_post import FoodPost
+from functools import partial
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import asyncio
+import broadcast
+import discord
+import json
+import logging
+import metrics
+import os
+import time
+
+
+# Maximum number of times a job is tried, before it is dead lettered
+MAX_ATTEMPTS = int(os.environ.get('DELIVERY_MAX_ATTEMPTS', '5'))
+# Seconds that a job that failed (or whose worker died) waits, before it is tried again
+RETRY_AFTER = float(os.environ.get('DELIVERY_RETRY_AFTER', '60'))
+# Maximum number of jobs that a worker takes at a time
+BATCH_SIZE = int(os.environ.get('DELIVERY_BATCH_SIZE', '50'))
+# Seconds that a worker waits for new jobs in one read
+BLOCK = 2
+# Seconds that a worker waits before reading again, after it failed to reach Redis
+ERROR_BACKOFF = 5
+
+deliveries_total = metrics.registry.counter('food_waifu_deliveries_total',
+                                            'Scheduled post jobs handled by the delivery workers', ('outcome',))
+
+
+# Raised when sending a job fails in a way that retrying won't fix,
+# such as the channel having been deleted. The job is dead lettered right away
+class PermanentDeliveryError(Exception):
+    pass
+
+
+# A scheduled post to send to one guild
+class DeliveryJob:
+    # Attributes
+    # guild_id - ID of the guild to post to
+    # channel_id - ID of the channel in that guild to post to
+    # post - the FoodPost to send
+    # record - the server to record the post with once it's sent ('all' for a broadcast post)
+    # embed - the embed to send, as a dictionary (see discord.Embed.to_dict)
+    def __init__(self, guild_id: int, channel_id: int, post: FoodPost, record: str, embed: Optional[dict] = None):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.post = post
+        self.record = record
+        self.embed = embed if embed is not None else post.to_embed().to_dict()
+
+    def to_embed(self) -> discord.Embed:
+        return discord.Embed.from_dict(self.embed)
+
+    # Transforms this job into the fields of a stream entry
+    def to_fields(self) -> Dict[str, str]:
+        return {'guild': str(self.guild_id), 'channel': str(self.channel_id), 'post': self.post.to_json(),
+                'record': self.record, 'embed': json.dumps(self.embed)}
+
+    # Take the fields of a stream entry created by `to_fields`, and transform that back into a job.
+    # Raises a KeyError or ValueError if the fields aren't a valid job
+    @staticmethod
+    def from_fields(fields: Dict[str, str]):
+        return DeliveryJob(int(fields['guild']), int(fields['channel']), FoodPost.from_dict(json.loads(fields['post'])),
+                           fields['record'], json.loads(fields['embed']))
+
+
+# Outcome of handling one batch of jobs
+class DeliveryResult:
+    # Attributes
+    # sent - entry IDs of the jobs that were sent and acknowledged
+    # failed - entry IDs of the jobs that failed, and will be retried
+    # dead - entry IDs of the jobs that were dead lettered
+    # elapsed - wall time of sending the batch, in seconds
+    def __init__(self):
+        self.sent = []
+        self.failed = []
+        self.dead = []
+        self.elapsed = 0.0
+
+    def __len__(self):
+        return len(self.sent) + len(self.failed) + len(self.dead)
+
+    def __str__(self):
+        return f'sent {len(self.sent)} posts, {len(self.failed)} will be retried, {len(self.dead)} dead lettered, ' \
+               f'in {self.elapsed:.2f}s'
+
+
+class DeliveryWorker:
+    # Attributes
+    # read - coroutine function that takes a consumer name, a count and seconds to block for,
+    #        and returns new (entry ID, fields) for the consumer
+    # claim - coroutine function that takes a consumer name, seconds idle and a count, and takes
+    #         over unacknowledged (entry ID, fields, times delivered) that were idle for that long
+    # ack - coroutine function that takes entry IDs, and acknowledges them
+    # dead_letter - coroutine function that takes entry ID -> fields, and dead letters them
+    # deliver - coroutine function that takes a DeliveryJob, and sends it. Raises if it wasn't sent
+    # record - coroutine function that takes post ID -> server, and records the posts as used
+    # consumer - name of this worker in the consumer group, which must be unique among the workers
+    # concurrency, rate - limits on the sends in flight, and started per second (see broadcast.fan_out)
+    # clock - source of the current time, in seconds, to time the sends with
+    def __init__(self,
+                 read: Callable[[str, int, float], Awaitable[List[Tuple[str, Dict[str, str]]]]],
+                 claim: Callable[[str, float, int], Awaitable[List[Tuple[str, Dict[str, str], int]]]],
+                 ack: Callable[[List[str]], Awaitable],
+                 dead_letter: Callable[[Dict[str, Dict[str, str]]], Awaitable],
+                 deliver: Callable[[DeliveryJob], Awaitable],
+                 record: Callable[[Dict[str, str]], Awaitable],
+                 consumer: str,
+                 batch_size: int = BATCH_SIZE,
+                 block: float = BLOCK,
+                 retry_after: float = RETRY_AFTER,
+                 max_attempts: int = MAX_ATTEMPTS,
+                 concurrency: int = broadcast.SEND_CONCURRENCY,
+                 rate: float = broadcast.SEND_RATE,
+                 logger: Optional[logging.Logger] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.read = read
+        self.claim = claim
+        self.ack = ack
+        self.dead_letter = dead_letter
+        self.deliver = deliver
+        self.record = record
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.block = block
+        self.retry_after = retry_after
+        self.max_attempts = max_attempts
+        self.concurrency = concurrency
+        self.rate = rate
+        self.logger = logger
+        self.clock = clock
+
+    # handles one batch of jobs: the ones due for a retry first, then new ones.
+    # Only waits for new jobs if there were none to retry
+    async def run_once(self) -> DeliveryResult:
+        entries = await self.claim(self.consumer, self.retry_after, self.batch_size)
+        if len(entries) < self.batch_size:
+            block = self.block if len(entries) < 1 else 0
+            new = await self.read(self.consumer, self.batch_size - len(entries), block)
+            entries = entries + [(entry_id, fields, 1) for entry_id, fields in new]
+        return await self.process(entries)
+
+    # sends the given (entry ID, fields, times delivered), records and acknowledges
+    # the ones that were sent, and dead letters the ones that can't be sent
+    async def process(self, entries: List[Tuple[str, Dict[str, str], int]]) -> DeliveryResult:
+        result = DeliveryResult()
+        jobs = {}
+        dead = {}
+        attempts = {}
+        for entry_id, fields, times_delivered in entries:
+            if times_delivered > self.max_attempts:
+                dead[entry_id] = dict(fields, error=f'Gave up after {self.max_attempts} attempts')
+                continue
+            try:
+                jobs[entry_id] = DeliveryJob.from_fields(fields)
+                attempts[entry_id] = times_delivered
+            except (KeyError, ValueError) as e:
+                dead[entry_id] = dict(fields, error=f'Invalid job: {repr(e)}')
+
+        sends = {entry_id: partial(self.deliver, job) for entry_id, job in jobs.items()}
+        fanned_out = await broadcast.fan_out(sends, concurrency=self.concurrency, rate=self.rate, clock=self.clock)
+        result.elapsed = fanned_out.elapsed
+        for entry_id, e in fanned_out.failed.items():
+            job = jobs[entry_id]
+            self._warn('Failed to deliver post %s to guild %d (attempt %d of %d): %r',
+                       job.post.id, job.guild_id, attempts[entry_id], self.max_attempts, e)
+            if isinstance(e, PermanentDeliveryError):
+                dead[entry_id] = dict(job.to_fields(), error=repr(e))
+            else:
+                result.failed.append(entry_id)
+
+        # the posts are recorded before the jobs are acknowledged, so a post
+        # is never acknowledged without being recorded as used
+        result.sent = fanned_out.sent
+        if len(result.sent) > 0:
+            await self.record({jobs[entry_id].post.id: jobs[entry_id].record for entry_id in result.sent})
+            await self.ack(result.sent)
+        if len(dead) > 0:
+            await self.dead_letter(dead)
+        result.dead = list(dead)
+
+        deliveries_total.inc(len(result.sent), outcome='sent')
+        deliveries_total.inc(len(result.failed), outcome='retried')
+        deliveries_total.inc(len(result.dead), outcome='dead_lettered')
+        return result
+
+    # handles batches of jobs until `is_closed` returns True. Failing to reach
+    # Redis is logged, and the worker carries on after a short wait
+    async def run(self, is_closed: Callable[[], bool] = lambda: False) -> None:
+        while not is_closed():
+            try:
+                result = await self.run_once()
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.error(f'Failed to handle scheduled post deliveries: {repr(e)}')
+                await asyncio.sleep(ERROR_BACKOFF)
+                continue
+            if len(result) > 0 and self.logger is not None:
+                self.logger.info(f'Scheduled post deliveries: {result}')
+
+    def _warn(self, msg: str, *args) -> None:
+        if self.logger is not None:
+            self.logger.warn(msg, *args)
@@ -1,5 +1,8 @@
 # DTO for aggregated information from a Reddit post
+from image_resolver import get_image_url
+from typing import Dict
 import discord
+import json
 
 
 class FoodPost:
@@ -8,12 +11,26 @@ class FoodPost:
     # title - the Post title
     # post_url - the permalink for this post
     # image_url - the url for the associated image of a submission
+    # FoodPosts are immutable and slotted, because thousands of them are held as
+    # candidates at a time. That also makes it safe to build the embed and the
+    # serialized form once, and share them between every guild the post goes to.
+    __slots__ = ('id', 'title', 'post_url', 'image_url', '_embed', '_json')
+
+    color = 0xDB5172
+
     def __init__(self, **kwargs):
-        self.id = kwargs.get('id')
-        self.title = kwargs.get('title')
-        self.post_url = kwargs.get('permalink')
-        self.image_url = kwargs.get('image_url')
-        self.color = 0xDB5172
+        object.__setattr__(self, 'id', kwargs.get('id'))
+        object.__setattr__(self, 'title', kwargs.get('title'))
+        object.__setattr__(self, 'post_url', kwargs.get('permalink'))
+        object.__setattr__(self, 'image_url', kwargs.get('image_url'))
+        object.__setattr__(self, '_embed', None)
+        object.__setattr__(self, '_json', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'FoodPost is immutable, cannot set {name}')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'FoodPost is immutable, cannot delete {name}')
 
     def __str__(self):
         return f'{self.title} : {self.post_url}'
@@ -22,12 +39,15 @@ class FoodPost:
         return self.__str__()
 
     # Transforms this FoodPost object into the discord Embed object that
-    # should be posted by the bot.
+    # should be posted by the bot. The embed is built once, and the same
+    # object is returned every time after that, so callers must not modify it.
     def to_embed(self) -> discord.Embed:
-        em = discord.Embed(title=FoodPost.truncate(self.title), description=self.post_url, color=self.color)
-        if self.image_url != '':
-            em.set_image(url=self.image_url)
-        return em
+        if self._embed is None:
+            em = discord.Embed(title=FoodPost.truncate(self.title), description=self.post_url, color=self.color)
+            if self.image_url != '':
+                em.set_image(url=self.image_url)
+            object.__setattr__(self, '_embed', em)
+        return self._embed
 
     # Given a Reddit submission title, truncate the title if it's too long
     # https://github.com/SaxyPandaBear/discord-food-bot/issues/28
@@ -46,8 +66,24 @@ class FoodPost:
     @staticmethod
     def from_submission(submission):
         sub_id = submission.id
-        url = submission.url
+        url = get_image_url(submission)  # the direct image, not necessarily the submission's link
         # permalink does not give the full URL, so build it instead.
         permalink = f'https://www.reddit.com{submission.permalink}'
         title = submission.title
         return FoodPost(id=sub_id, title=title, image_url=url, permalink=permalink)
+
+    # Transforms this FoodPost into a plain dictionary, so that it can be
+    # serialized (i.e.: to JSON) and cached
+    def to_dict(self) -> Dict[str, str]:
+        return {'id': self.id, 'title': self.title, 'permalink': self.post_url, 'image_url': self.image_url}
+
+    # Returns `to_dict` serialized as JSON. This is only computed once per post
+    def to_json(self) -> str:
+        if self._json is None:
+            object.__setattr__(self, '_json', json.dumps(self.to_dict()))
+        return self._json
+
+    # Take a dictionary created by `to_dict`, and transform that back into a FoodPost
+    @staticmethod
+    def from_dict(data: Dict[str, str]):
+        return FoodPost(**data)
@@ -1,13 +1,26 @@
-from typing import List, Optional, Tuple
+# The Discord bot. Importing this module has no side effects: `create_app`
+# builds the bot from the environment, and `main` runs it. The Discord,
+# Reddit and Redis clients are only created when they are first used, and
+# PRAW is only imported then, so the bot connects to Discord as soon as possible.
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
 import discord
 from discord.ext import commands
-import praw
 import asyncio
-import auths
+import logging
+import time
 import random
-from time import gmtime
+from functools import partial
 from food_post import FoodPost
-import logging
+from candidate_pool import CandidatePool
+from channel_cache import ChannelCache
+from search_cache import SearchCache
+from search_index import SearchIndex, PATH as SEARCH_INDEX_PATH
+from image_resolver import ImageResolver
+from scheduler import BroadcastScheduler
+from guild_subreddits import GuildSubreddits, group_by_subreddits
+import logging_config
+import os
+import socket
 import subprocess
 from predicates import is_admin
 from help_commands import bot_description, \
@@ -15,285 +28,723 @@ from help_commands import bot_description, \
     help_bot_fetch_value_from_redis, \
     help_bot_random, \
     help_bot_restart, \
-    help_bot_search
+    help_bot_search, \
+    help_bot_cadence, \
+    help_bot_subreddits
 import redis_connector
+import broadcast
+import delivery
+import reddit_client
+import metrics
 from utility import read_subreddits_from_env, \
-    get_text_channel, \
-    build_query
-
-
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-stream_handler = logging.StreamHandler()
-stream_handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-stream_handler.setFormatter(formatter)
-logger.addHandler(stream_handler)
-
-
-MAX_ALLOWED_SEARCH_SIZE = 500  # Not sure if the API actually lets me do this
-# read a list of subreddits from the environment, and use that
-# for the search criteria
-subs_list = read_subreddits_from_env()
-
-
-# Instantiate the bot
-bot_presence = discord.Activity(
-    name=f"Serving good food from {' and '.join(['r/' + s for s in subs_list])}",
-    type=discord.ActivityType.playing)
-bot = commands.Bot(command_prefix="!food ", description=bot_description(), activity=bot_presence)
-
-
-# use this to determine when to post hourly
-stored_hour = None
-
-
-# function that posts a picture to the server on a timer
-async def post_new_picture():
-    global stored_hour
-    await bot.wait_until_ready()  # doesn't execute until the client is ready
-    while not bot.is_closed():
-        current_time = gmtime().tm_hour
-        if stored_hour is None or is_scheduled_time(current_time, stored_hour):
-            # set stored_hour for next scheduled post
-            stored_hour = current_time
-
-            post_id, em = get_random_embedded_post()  # get a single post, and post it to each server
-            for guild in bot.guilds:  # each server that this bot is active in
-                channel = get_text_channel(guild)
-                # because we can't filter for posts that are already there in each server before
-                # generating the post, make the check here
-                if redis_connector.post_already_used(post_id, logger):
-                    # if the post is already there, generate a new one specific to this guild and return
-                    p_id, diff_em = get_random_embedded_post(guild.id)  # already written to file
-                    await channel.send(embed=diff_em)
-                    redis_connector.store_post_from_server(p_id, guild.id, logger)
-                    continue
-                await channel.send(embed=em)  # post to the default text channel
-            # after the post has been posted to all connected servers,
-            # persist the post
-            redis_connector.store_post_from_server(post_id, 'all', logger)  # right now, we don't use the value stored in Redis
-        await asyncio.sleep(30)  # wait 30 seconds before checking again
-
-
-# return True if is next hour, false otherwise
-def is_scheduled_time(current_time: int, stored_hour: Optional[int] = None) -> bool:
-    # if the hour that we store is 23, that means the next hour should be 0
-    if stored_hour == 23:
-        return current_time < 23
-    else:
-        # otherwise compare normally
-        return current_time > stored_hour
-
-
-# returns a discord.Embed with all of the necessary information for an embedded message
-# this function accepts a guild parameter so that the ID can be written for the specific guild
-# If a server ID is passed in, then the post is persisted in Redis,
-# associated with the given server ID so that it doesn't get reposted
-# elsewhere later
-def get_random_embedded_post(server=None) -> Tuple[str, discord.Embed]:
-    submission = get_submission_from_subs(subs_list)
-    post = FoodPost.from_submission(submission)
-    # need to write the id of this post into our file so we don't post it again later
-    if server is not None:
-        # write_id_to_file(post.id, server)
-        redis_connector.store_post_from_server(post.id, server, logger)
-    return post.id, post.to_embed()
-
-
-# takes a search query and returns the first result within the given
-# subreddits. no duplicates are allowed
-def search_posts(query: str, server: str) -> Optional[discord.Embed]:
-    # This searches, and returns a new post that isn't already persisted
-    # to Redis
-    submission = search_submission_from_subs(subs_list, query)
-    # if submission is None, then the search returned no results
-    if submission is None:
-        return None
-    # write_id_to_file(submission.id, server)
-    redis_connector.store_post_from_server(submission.id, server, logger)
-    post = FoodPost.from_submission(submission)
-    return post.to_embed()
-
-
-# find the first, most relevant result from the search. do not include duplicates
-def search_submission_from_subs(subs: List[str], query: str):
-    subs_list = '+'.join(subs)
-    for submission in reddit.subreddit(subs_list).search(query=query, sort='relevance', syntax='lucene'):
-        if not redis_connector.post_already_used(submission.id, logger):
-            return submission
-    # if we didn't return in the iteration, just return the first relevant one this month
-    try:
-        # call to next() can raise StopIteration error if the list generator has no values left,
-        # meaning there were no results for this search
-        result = next(reddit.subreddit(subs_list).search(
-            query=query,
-            sort='relevance',
-            syntax='lucene',
-            time_filter='month'))
-        return result
-    except StopIteration:
-        logger.error(f'No results found for {query} in subs: {subs}')
-        return None
-
-
-# because a submission's URL can either be the link to a hosted image,
-# or to the comments section of it's own submission, let's try to get
-# the actual image every time.
-def get_image_url(submission) -> str:
-    return submission.url  # TODO: figure out what kinds of data can appear
-
-
-# returns a random submission from the given list of subreddits
-# uses the top 20 hot submissions
-# has a list of ids for posts that were already posted.
-def get_submission_from_subs(subs):
-    submissions = []
-    joined_subs = '+'.join(subs)  # should have a string like "a+b+c"
-    limit = 20  # this is the maximum number of submissions to poll
-    for submission in reddit.subreddit(joined_subs).hot(limit=limit):
-        if not redis_connector.post_already_used(submission.id, logger):
-            submissions.append(submission)
-    # need a check in case all of the submissions were already posted
-    hit_max_search = False
-    while len(submissions) < 1:
-        if limit == MAX_ALLOWED_SEARCH_SIZE and not hit_max_search:
-            hit_max_search = True
-        if limit == MAX_ALLOWED_SEARCH_SIZE and hit_max_search:
-            raise Exception("Reached search limit, but couldn't find a new post")
-        for submission in reddit.subreddit(joined_subs).hot(limit=limit):
-            if not redis_connector.post_already_used(submission.id, logger):
-                submissions.append(submission)
-        # at some point either we will get rate limited, or we'll find a new post
-        # by including a max search size, a big TODO would be to actually paginate
-        # the search... but oh well
-        limit = min(limit * 2, MAX_ALLOWED_SEARCH_SIZE)
-    return random.choice(submissions)
-
-
-# restarts the bot using pm2's restart functionality.
-# if the bot restarts successfully, then the bot will have been
-# abruptly stopped, not gracefully.
-def restart_bot():
-    # first, need to get this process's ID from pm2.
-    # then, invoke restart on it.
-    id_output = subprocess.run(["pm2", "id", "Food Bot"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    logger.info(id_output)
-    # the output of the above command would be in the form of "[ id ]" with the intended whitespace illustrated
-    # need to strip the characters around the ID
-    pm2_id = id_output.stdout.decode('utf-8').replace("[", "").replace("]", "").strip()
-    if len(pm2_id) == 0:
-        logger.error('Could not find pm2 ID for this bot')
-        return False
-    logger.info(pm2_id)
-
-    # attempt to restart the bot
-    subprocess.run(["pm2", "restart", str(pm2_id)])
-    return False
-
-
-@bot.event
-async def on_ready():
-    logger.info(f"Username: {bot.user.name}")
-    logger.info(f"ID: {bot.user.id}")
-
-
-@bot.command(
-    description="Post a new food picture into the channel",
-    help=help_bot_random(),
-    brief="Post food picture"
-)
-async def new(context):
-    post_id, em = get_random_embedded_post(context.guild.id)
-    await context.send(embed=em)
-
-
-@bot.command(
-    description="Searches for a new food picture to post into the channel",
-    help=help_bot_search(),
-    usage="something I want to search separated by spaces",
-    brief="Search for new food picture"
-)
-async def search(context, *search_terms: str):
-    try:
-        query = build_query(search_terms)
-    except ValueError:
-        logger.exception('Exception occurred building search query')
-        await context.send("Specify at least one term to search for")
-        return
-    em = search_posts(query, context.guild.id)
-    if em is None:
-        await context.send(f"No titles containing {search_terms} found in defined subreddits")
-        return
-    else:
-        await context.send(embed=em)
-        return
-
-
-@bot.command(
-    description="Clears all of the Reddit post IDs that are persisted for deduplication",
-    help=help_bot_clear(),
-    brief="Flushes Redis keys"
-)
-@commands.guild_only()  # restrict this command to Guild channels
-@is_admin()
-async def clear(context):
-    redis_connector.flush_all_records(logger)
-    await context.send("Successfully cleared contents")
-
-
-@bot.command(
-    description="Restarts the bot on request",
-    help=help_bot_restart(),
-    brief="Restarts bot"
-)
-@commands.guild_only()  # restrict this command to Guild channels
-@is_admin()
-async def restart(context):
-    if not restart_bot():
-        await context.send("Error when attempting to restart bot. Please restart manually.")
-
-
-@bot.command(description="Print all stored Redis keys to log", help=help_bot_list_keys(), brief="Logs Redis keys")
-@is_admin()
-async def keys(context):
-    if redis_connector.enumerate_keys(logger):
-        await context.send("Successfully printed Redis keys to log")
-    else:
-        await context.send("Error occurred when printing Redis keys to log")
-
-
-@bot.command(
-    description="Get and print the server where a Reddit submission was posted",
-    help=help_bot_fetch_value_from_redis(),
-    brief="Print Redis key-value pair",
-    usage="some_reddit_post_id"
-)
-@is_admin()
-async def fetch(context, *ids: str):
-    if len(ids) != 1:
-        await context.send("Only allowed to fetch one value from Redis at a time.")
-        return
-    reddit_id = ids[0]
-    val = redis_connector.get_value(reddit_id)
-    if val is not None:
-        await context.send(f"{reddit_id} -> {val}")
-    else:
-        await context.send(f"Couldn't find key {reddit_id} in Redis.")
-
-
-# Starts the discord client
-logger.info("Creating looped task")
-bot.loop.create_task(post_new_picture())  # looped task
-logger.info("Finished creating looped task")
-try:
-    # instantiate a new Reddit Client
+    read_shards_from_env, \
+    build_query, \
+    interleave
+
+
+MAX_ALLOWED_SEARCH_SIZE = 500  # maximum number of submissions read from each listing
+CANDIDATE_FETCH_SIZE = 100  # number of hot submissions polled for each candidate pool refill
+
+
+sends_total = metrics.registry.counter('food_waifu_discord_sends_total', 'Messages sent to Discord', ('outcome',))
+send_seconds = metrics.registry.histogram('food_waifu_discord_send_seconds', 'Time taken to send a message to Discord')
+commands_total = metrics.registry.counter('food_waifu_commands_total', 'Bot commands invoked', ('command', 'outcome'))
+command_seconds = metrics.registry.histogram('food_waifu_command_seconds',
+                                             'End to end latency of bot commands', ('command',))
+candidate_listing_requests = metrics.registry.gauge(
+    'food_waifu_candidate_listing_requests', 'Listing requests the last search for unused posts needed')
+candidate_items_fetched = metrics.registry.gauge(
+    'food_waifu_candidate_items_fetched', 'Submissions the last search for unused posts read')
+candidate_exhaustions_total = metrics.registry.counter(
+    'food_waifu_candidate_exhaustions_total', 'Searches for unused posts that ran out of listings')
+startup_seconds = metrics.registry.gauge(
+    'food_waifu_startup_seconds', 'Time from creating the app to the bot first being ready')
+
+
+# instantiates a new Reddit client from the credentials in auths.py, with
+# every request going through it staying within the rate limit
+def create_reddit_client() -> reddit_client.RedditClient:
+    import auths
+    import praw
     reddit = praw.Reddit(
         client_id=auths.reddit_client_id,
         client_secret=auths.reddit_client_secret,
         user_agent='discord:food_waifu:v0.2'
     )
-    bot.run(auths.discord_token)
-except Exception as e:
-    logger.error(repr(e))
+    return reddit_client.RedditClient(reddit)
+
+
+# sends a message to a channel (or a command's context), and records its latency and outcome
+async def send(destination, *args, **kwargs):
+    outcome = 'error'
+    try:
+        with send_seconds.time():
+            message = await destination.send(*args, **kwargs)
+        outcome = 'ok'
+        return message
+    finally:
+        sends_total.inc(outcome=outcome)
+
+
+class FoodWaifu:
+    # Attributes
+    # subs - subreddits that the posts are found in, for the guilds that didn't configure their own
+    # logger - where the bot logs to
+    # shard_count, shard_ids - the shards that this process runs, if the bot is sharded
+    # instance_id - identifies this process in the claims and leases it takes in Redis
+    # reddit_factory - function that creates the Reddit client, when it is first used
+    # search_index_path - location of the local search index, which is opened when it is first used
+    def __init__(self,
+                 subs: List[str],
+                 logger: logging.Logger,
+                 shard_count: Optional[int] = None,
+                 shard_ids: Optional[List[int]] = None,
+                 reddit_factory: Callable[[], reddit_client.RedditClient] = create_reddit_client,
+                 search_index_path: str = SEARCH_INDEX_PATH):
+        self.subs = subs
+        self.logger = logger
+        self.shard_count = shard_count
+        self.shard_ids = shard_ids
+        self.instance_id = f'{socket.gethostname()}:{os.getpid()}:{shard_ids or "all"}'
+        self.reddit_factory = reddit_factory
+        self.search_index_path = search_index_path
+        self.created_at = time.perf_counter()
+        self._bot = None
+        self._reddit_api = None
+        self._search_index = None
+
+        # subreddits that each guild gets its posts from, persisted in Redis
+        self.guild_subreddits = GuildSubreddits(subs,
+                                                redis_connector.get_guild_subreddits_async,
+                                                redis_connector.store_guild_subreddits_async,
+                                                redis_connector.delete_guild_subreddits_async)
+        # warm pool of unused posts from the default subreddits, so commands don't have to wait on Reddit
+        self.candidate_pool = CandidatePool(self.fetch_candidate_posts, redis_connector.filter_unused_posts_async,
+                                            logger=logger)
+        # channel that the bot posts to in each guild, persisted in Redis
+        self.channel_cache = ChannelCache(redis_connector.get_posting_channel_async,
+                                          redis_connector.store_posting_channel_async,
+                                          redis_connector.delete_posting_channel_async)
+        # drops candidates whose image can't be embedded, with the results cached in Redis
+        self.image_resolver = ImageResolver(redis_connector.get_image_checks_async,
+                                            redis_connector.store_image_checks_async,
+                                            logger=logger)
+        # results of recent searches, shared with other processes through Redis
+        self.search_cache = SearchCache(redis_connector.get_search_results_async,
+                                        redis_connector.store_search_results_async)
+        # decides when each server gets its scheduled post
+        self.broadcast_scheduler = BroadcastScheduler(redis_connector.get_broadcast_slots_async,
+                                                      redis_connector.store_broadcast_slots_async,
+                                                      redis_connector.get_broadcast_cadences_async,
+                                                      redis_connector.store_broadcast_cadence_async,
+                                                      self.claim_broadcast_slots,
+                                                      logger=logger)
+        # makes every shard process post the same candidates for a broadcast
+        self.shared_selection = broadcast.SharedSelection(self.acquire_lease,
+                                                          redis_connector.get_broadcast_selection_async,
+                                                          redis_connector.store_broadcast_selection_async)
+        # sends the queued scheduled posts to the servers
+        self.delivery_worker = delivery.DeliveryWorker(redis_connector.read_deliveries_async,
+                                                       redis_connector.claim_stale_deliveries_async,
+                                                       redis_connector.ack_deliveries_async,
+                                                       redis_connector.dead_letter_deliveries_async,
+                                                       self.deliver,
+                                                       partial(redis_connector.store_posts_async, logger=logger),
+                                                       self.instance_id,
+                                                       logger=logger)
+
+    # the Discord client, with the bot's commands, listeners and hooks added to it.
+    # Creating it doesn't connect to Discord, see `run`
+    @property
+    def bot(self) -> commands.Bot:
+        if self._bot is None:
+            bot_presence = discord.Activity(
+                name=f"Serving good food from {' and '.join(['r/' + s for s in self.subs])}",
+                type=discord.ActivityType.playing)
+            if self.shard_count is None:
+                bot = commands.Bot(command_prefix="!food ", description=bot_description(), activity=bot_presence)
+            else:
+                # each process only connects the given shards, and so only sees (and posts to) their guilds
+                bot = commands.AutoShardedBot(command_prefix="!food ", description=bot_description(),
+                                              activity=bot_presence, shard_count=self.shard_count,
+                                              shard_ids=self.shard_ids)
+            # the hooks measure the end to end latency of every command
+            bot.before_invoke(self.start_command_timer)
+            bot.after_invoke(self.record_command_latency)
+            bot.add_cog(FoodCommands(self))
+            self._bot = bot
+        return self._bot
+
+    # the Reddit client, created on the first request to Reddit
+    @property
+    def reddit_api(self) -> reddit_client.RedditClient:
+        if self._reddit_api is None:
+            self._reddit_api = self.reddit_factory()
+        return self._reddit_api
+
+    # full-text index of every submission the bot has seen, for answering searches locally
+    @property
+    def search_index(self) -> SearchIndex:
+        if self._search_index is None:
+            self._search_index = SearchIndex(self.search_index_path)
+        return self._search_index
+
+    # fetches hot submissions from the default subreddits that haven't been posted yet, to fill the candidate pool.
+    # each subreddit is fetched on its own, so the requests are shared with the guilds that configured it
+    async def fetch_candidate_posts(self) -> List[FoodPost]:
+        listings = await asyncio.gather(*[self.reddit_api.hot([sub], CANDIDATE_FETCH_SIZE)
+                                          for sub in self.guild_subreddits.default])
+        listing = interleave(listings)
+        await self.search_index.add_submissions_async(listing)
+        posts = await self.filter_unused_posts([FoodPost.from_submission(s) for s in listing])
+        return await self.image_resolver.resolve(posts)
+
+    # claims the given slots for this process, so no other shard process posts them too
+    async def claim_broadcast_slots(self, slots: Dict[int, float], ttl: float) -> List[int]:
+        return await redis_connector.claim_broadcast_slots_async(slots, self.instance_id, ttl)
+
+    # takes the lease on selecting a broadcast's candidates for this process
+    async def acquire_lease(self, key: str, ttl: float) -> bool:
+        return await redis_connector.acquire_lease_async(f'broadcast_selection:{key}', self.instance_id, ttl)
+
+    # function that posts a picture to the server on a timer
+    async def post_new_picture(self):
+        bot = self.bot
+        await bot.wait_until_ready()  # doesn't execute until the client is ready
+        while not bot.is_closed():
+            try:
+                # sleeps until the next server is due for a post
+                groups = await self.broadcast_scheduler.wait_for_due(lambda: [guild.id for guild in bot.guilds])
+                for guild_ids in groups:
+                    if not await self.post_to_guilds(guild_ids):
+                        await asyncio.sleep(30)  # wait 30 seconds before trying again
+                        break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # such as Redis being down. Slots only fire once their posts are queued,
+                # so the servers are still due, and are posted to once it's back
+                self.logger.error(f'Failed to send the scheduled posts: {repr(e)}')
+                await asyncio.sleep(30)
+
+    # posts a picture to each of the given servers, sharing posts between them where possible.
+    # returns False if the posts couldn't be fetched, so the servers are still due
+    async def post_to_guilds(self, guild_ids: List[int]) -> bool:
+        subreddits = await self.guild_subreddits.get_many(guild_ids)
+        try:
+            # a single batch of posts is selected from each subreddit for the broadcast, and shared
+            # by every server that uses the subreddit, including the servers on the other shard processes
+            key = self.broadcast_scheduler.broadcast_key(guild_ids[0])
+            distinct = sorted({sub for subs in subreddits.values() for sub in subs})
+            selections = await asyncio.gather(*[
+                self.shared_selection.get(f'{key}:{sub}', partial(self.select_broadcast_candidates, [sub]))
+                for sub in distinct])
+        except asyncio.TimeoutError:
+            self.logger.error('Timed out fetching the scheduled post from Reddit')
+            return False
+        selections = dict(zip(distinct, selections))
+        # only the servers whose slots this process claimed are posted to
+        guild_ids = await self.broadcast_scheduler.claim(guild_ids)
+        if len(guild_ids) < 1:
+            return True
+        await self.queue_broadcast({g: subreddits[g] for g in guild_ids}, selections)
+        # the slots only fire once their posts are queued, so if that fails, the servers are still due
+        await self.broadcast_scheduler.mark_fired(guild_ids)
+        return True
+
+    # picks a post for each of the given server ID -> subreddits from the selected
+    # candidates of each subreddit, and queues them for the delivery workers
+    async def queue_broadcast(self, subreddits: Dict[int, List[str]],
+                              selections: Dict[str, Tuple[List[FoodPost], Optional[float]]]) -> None:
+        # the servers with the same subreddits share their candidates, which are merged from each subreddit's
+        assignments = {}
+        shared = set()
+        for subs, group in group_by_subreddits(subreddits).items():
+            candidates = interleave(selections[sub][0] for sub in subs)
+            if len(candidates) < 1:
+                continue
+            seen = await self.get_seen_posts(group, [selections[sub] for sub in subs])
+            assignments.update(broadcast.assign_posts(group, candidates, seen))
+            shared.add(candidates[0].id)
+        channels = {}
+        for guild_id in subreddits:
+            guild = self.bot.get_guild(guild_id)
+            if guild is None or guild_id not in assignments:
+                self.logger.error(f'No unseen post available for guild {guild_id}')
+                continue
+            channel = await self.channel_cache.get(guild)
+            if channel is None:
+                self.logger.error(f'No text channel to post to in guild {guild_id}')
+                continue
+            channels[guild_id] = channel.id  # post to the default text channel
+        # the posts are queued for the delivery workers, which record them once they're sent.
+        # the first candidate of each group may have been posted by other processes too
+        assignments = {guild_id: assignments[guild_id] for guild_id in channels}
+        records = broadcast.records_for(assignments, shared=shared)
+        jobs = [delivery.DeliveryJob(guild_id, channels[guild_id], post, records[post.id])
+                for guild_id, post in assignments.items()]
+        await redis_connector.enqueue_deliveries_async([job.to_fields() for job in jobs])
+        self.logger.info(f'Queued {len(jobs)} scheduled posts for delivery')
+
+    # sends a scheduled post job. The channel is looked up over the API if this
+    # process isn't connected to its guild's shard, so any process can deliver any job
+    async def deliver(self, job: delivery.DeliveryJob) -> None:
+        try:
+            channel = self.bot.get_channel(job.channel_id) or await self.bot.fetch_channel(job.channel_id)
+            await send(channel, embed=job.to_embed())
+        except (discord.NotFound, discord.Forbidden) as e:
+            self.channel_cache.invalidate(job.guild_id)
+            raise delivery.PermanentDeliveryError(f'Cannot post to channel {job.channel_id}: {repr(e)}') from e
+
+    async def deliver_scheduled_posts(self):
+        await self.bot.wait_until_ready()
+        await redis_connector.create_delivery_group_async()
+        await self.delivery_worker.run(self.bot.is_closed)
+
+    # fetches the candidates for a broadcast from the given subreddits, in the order they should be used
+    async def select_broadcast_candidates(self, subs: List[str]) -> List[FoodPost]:
+        candidates = await self.get_unused_submissions(subs)
+        random.shuffle(candidates)
+        return candidates
+
+    # takes the guilds for a broadcast and the (candidate posts, time selected) from
+    # each of their subreddits, and returns the IDs of the candidates that each guild has already seen.
+    # the candidates were unused when they were selected, so this only catches
+    # posts that were used by a command in the meantime. Those are used everywhere.
+    # Posts recorded after the selection was made were recorded by this broadcast
+    # (on another shard process), so they don't count.
+    async def get_seen_posts(self, guild_ids: List[int],
+                             selections: List[Tuple[List[FoodPost], Optional[float]]]) -> Dict[int, Set[str]]:
+        used = set()
+        for candidates, selected_at in selections:
+            unused = set(await redis_connector.filter_unused_posts_async([p.id for p in candidates], self.logger,
+                                                                         selected_at))
+            used.update(p.id for p in candidates if p.id not in unused)
+        return {guild_id: used for guild_id in guild_ids}
+
+    # returns a discord.Embed with all of the necessary information for an embedded message
+    # this function accepts a guild parameter so that the ID can be written for the specific guild
+    # If a server ID is passed in, then the post is persisted in Redis,
+    # associated with the given server ID so that it doesn't get reposted
+    # elsewhere later
+    async def get_random_embedded_post(self, server=None) -> Tuple[str, discord.Embed]:
+        subs = self.guild_subreddits.default if server is None else await self.guild_subreddits.get(server)
+        # the pool only holds posts from the default subreddits
+        post = await self.candidate_pool.take() if subs == self.guild_subreddits.default else None
+        if post is None:
+            # the pool ran dry, so fall back to fetching from Reddit directly
+            post = await self.get_submission_from_subs(subs)
+        # need to write the id of this post into our file so we don't post it again later
+        if server is not None:
+            await redis_connector.store_post_from_server_async(post.id, server, self.logger)
+        return post.id, post.to_embed()
+
+    # takes a search query and returns the first result within the given
+    # subreddits. no duplicates are allowed
+    async def search_posts(self, query: str, server: str) -> Optional[discord.Embed]:
+        # This searches, and returns a new post that isn't already persisted
+        # to Redis
+        post = await self.search_submission_from_subs(await self.guild_subreddits.get(server), query)
+        # if post is None, then the search returned no results
+        if post is None:
+            return None
+        await redis_connector.store_post_from_server_async(post.id, server, self.logger)
+        return post.to_embed()
+
+    # returns the results of a search across the given subreddits, as FoodPosts.
+    # results are cached, so repeated searches don't go to Reddit
+    async def cached_search(self, subs: List[str], query: str, time_filter: Optional[str] = None) -> List[FoodPost]:
+        async def search_reddit() -> List[FoodPost]:
+            kwargs = {} if time_filter is None else {'time_filter': time_filter}
+            submissions = await self.reddit_api.search(subs, query, sort='relevance', syntax='lucene', **kwargs)
+            await self.search_index.add_submissions_async(submissions)
+            return [FoodPost.from_submission(s) for s in submissions]
+        return await self.search_cache.get_or_search(subs, query, search_reddit, time_filter)
+
+    # find the first, most relevant result from the search. do not include duplicates
+    # the local search index is checked first, and Reddit is only searched if it has nothing new
+    async def search_submission_from_subs(self, subs: List[str], query: str) -> Optional[FoodPost]:
+        local_results = await self.search_index.search_async(subs, query)
+        if local_results is not None:
+            post = await self.first_unused_post(local_results)
+            if post is not None:
+                return post
+        post = await self.first_unused_post(await self.cached_search(subs, query))
+        if post is not None:
+            return post
+        # if we didn't return from the first search, just return the first relevant one this month
+        results = await self.cached_search(subs, query, 'month')
+        # an empty list means there were no results for this search
+        if len(results) < 1:
+            self.logger.error(f'No results found for {query} in subs: {subs}')
+            return None
+        return results[0]
+
+    # returns the first of the given posts that hasn't been posted yet and has a valid image, or None
+    async def first_unused_post(self, posts: List[FoodPost]) -> Optional[FoodPost]:
+        return await self.image_resolver.first_valid(await self.filter_unused_posts(posts))
+
+    # returns a random unused post from the given list of subreddits.
+    # the unused posts are shuffled, and only checked for a valid image until the first one is found
+    async def get_submission_from_subs(self, subs) -> FoodPost:
+        async def pick_one(posts: List[FoodPost]) -> List[FoodPost]:
+            random.shuffle(posts)
+            post = await self.image_resolver.first_valid(posts)
+            return [] if post is None else [post]
+        return (await self.get_unused_submissions(subs, pick_one))[0]
+
+    # returns the posts from the given list of subreddits that weren't posted already, and have a valid image.
+    # starts with the top 20 hot submissions, and pages further into the hot,
+    # new and top listings until it finds at least one.
+    # `select` takes the unused posts of a page, and returns the ones with a valid image that should be kept.
+    # each page of submissions is converted to FoodPosts as soon as it arrives,
+    # so the PRAW Submission objects aren't kept around.
+    # each subreddit is paged on its own, so the requests are shared with every guild that uses it
+    async def get_unused_submissions(
+            self, subs, select: Optional[Callable[[List[FoodPost]], Awaitable[List[FoodPost]]]] = None
+    ) -> List[FoodPost]:
+        if select is None:
+            select = self.image_resolver.resolve
+        pager = reddit_client.MergedPager(self.reddit_api, subs, max_items=MAX_ALLOWED_SEARCH_SIZE)
+        start = time.perf_counter()
+        while True:
+            page = await pager.next_page()
+            candidate_listing_requests.set(pager.api_calls)
+            candidate_items_fetched.set(pager.items_fetched)
+            await self.search_index.add_submissions_async(page)
+            if len(page) < 1:
+                candidate_exhaustions_total.inc()
+                raise Exception("Exhausted all listings, but couldn't find a new post")
+            posts = await self.filter_unused_posts([FoodPost.from_submission(s) for s in page])
+            posts = await select(posts)
+            if len(posts) > 0:
+                # one summary line for the whole sweep, instead of one per page or per post
+                self.logger.info('Checked %d posts in %d listing requests, %d selected, %.0f ms', pager.items_fetched,
+                                 pager.api_calls, len(posts), (time.perf_counter() - start) * 1000)
+                return posts
+
+    # takes a list of posts and returns the ones that haven't been
+    # posted yet, checking all of them against Redis in one batch
+    async def filter_unused_posts(self, candidates: List[FoodPost]) -> List[FoodPost]:
+        unused = set(await redis_connector.filter_unused_posts_async([p.id for p in candidates], self.logger))
+        return [p for p in candidates if p.id in unused]
+
+    # restarts the bot using pm2's restart functionality.
+    # if the bot restarts successfully, then the bot will have been
+    # abruptly stopped, not gracefully.
+    def restart_bot(self):
+        # first, need to get this process's ID from pm2.
+        # then, invoke restart on it.
+        id_output = subprocess.run(["pm2", "id", "Food Bot"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.logger.info(id_output)
+        # the output of the above command would be in the form of "[ id ]" with the intended whitespace illustrated
+        # need to strip the characters around the ID
+        pm2_id = id_output.stdout.decode('utf-8').replace("[", "").replace("]", "").strip()
+        if len(pm2_id) == 0:
+            self.logger.error('Could not find pm2 ID for this bot')
+            return False
+        self.logger.info(pm2_id)
+
+        # attempt to restart the bot
+        subprocess.run(["pm2", "restart", str(pm2_id)])
+        return False
+
+    # moves any records from the old Redis layout, then loads the dedup filter.
+    # this has to finish before anything deduplicates posts, or the posts in the old layout look unused
+    async def prepare_redis(self):
+        try:
+            await redis_connector.migrate_flat_keys_async(self.logger)
+            await redis_connector.warm_used_posts_filter_async(self.logger)
+        except Exception as e:
+            # such as Redis being down. Without a warm filter every post is checked in Redis,
+            # and the migration is tried again on the next start
+            self.logger.error(f'Failed to prepare the Redis records: {repr(e)}')
+
+    # serves the metrics on a local port, unless it is disabled. Shard processes run side by side
+    # on one host, so each one serves them on METRICS_PORT plus its first shard ID
+    async def start_metrics_server(self):
+        if metrics.PORT < 1:
+            return
+        port = metrics.PORT + (self.shard_ids[0] if self.shard_ids else 0)
+        try:
+            await metrics.start_server(port=port)
+        except OSError as e:
+            # such as another process (or an overlapping deployment) already using the port
+            self.logger.error(f'Failed to serve metrics on port {port}: {repr(e)}')
+            return
+        self.logger.info(f'Serving metrics on http://{metrics.HOST}:{port}/metrics')
+
+    # checks on Redis in the background, so that the posts recorded while it was
+    # down are written to it once it recovers
+    async def watch_redis(self):
+        while not self.bot.is_closed():
+            await asyncio.sleep(redis_connector.HEALTH_CHECK_INTERVAL)
+            await redis_connector.check_health_async(self.logger)
+
+    # closes the app's own clients once the bot shuts down. When the bot stops, it cancels
+    # the tasks that are still running, and waits for them, so this runs on every way out
+    async def close_on_shutdown(self):
+        try:
+            await asyncio.Event().wait()  # until it's cancelled
+        finally:
+            await self.close()
+
+    async def close(self):
+        await self.image_resolver.close()
+
+    # keeps the candidate pool filled in the background, once the bot is ready
+    async def start_candidate_pool(self):
+        await self.bot.wait_until_ready()
+        await self.candidate_pool.run()
+
+    async def start_command_timer(self, context):
+        context.started_at = time.perf_counter()
+
+    async def record_command_latency(self, context):
+        command = context.command.qualified_name
+        command_seconds.observe(time.perf_counter() - context.started_at, command=command)
+        commands_total.inc(command=command, outcome='error' if context.command_failed else 'ok')
+
+    # prepares Redis, then starts the background tasks, and runs the bot until it is closed.
+    # the bot only connects to Discord once Redis is prepared, so no command can run before that either
+    def run(self, token: str) -> None:
+        bot = self.bot
+        bot.loop.run_until_complete(self.prepare_redis())
+        self.logger.info("Creating looped task")
+        bot.loop.create_task(self.post_new_picture())  # looped task
+        bot.loop.create_task(self.deliver_scheduled_posts())
+        bot.loop.create_task(self.start_candidate_pool())
+        bot.loop.create_task(self.watch_redis())
+        bot.loop.create_task(self.close_on_shutdown())
+        bot.loop.create_task(self.start_metrics_server())
+        self.logger.info("Finished creating looped task")
+        bot.run(token)
+
+
+# The bot's commands and the events it listens to, which hand off to the app
+class FoodCommands(commands.Cog, name='Food'):
+    # Attributes
+    # app - the FoodWaifu that the commands act on
+    def __init__(self, app: FoodWaifu):
+        self.app = app
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        bot = self.app.bot
+        if startup_seconds.value() == 0:
+            startup_seconds.set(time.perf_counter() - self.app.created_at)
+        self.app.logger.info(f"Username: {bot.user.name}")
+        self.app.logger.info(f"ID: {bot.user.id}")
+
+    # The events below can change which channel the bot is able to post to in a guild,
+    # so they invalidate the guild's cached posting channel.
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel):
+        self.app.channel_cache.invalidate(channel.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        self.app.channel_cache.invalidate(after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        self.app.channel_cache.invalidate(channel.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        self.app.channel_cache.invalidate(after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        self.app.channel_cache.invalidate(role.guild.id)
+
+    # only fires when the members intent is enabled
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if after.id == self.app.bot.user.id:
+            self.app.channel_cache.invalidate(after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        await self.app.channel_cache.remove(guild.id)
+        await self.app.guild_subreddits.forget(guild.id)
+
+    @commands.command(
+        description="Post a new food picture into the channel",
+        help=help_bot_random(),
+        brief="Post food picture"
+    )
+    async def new(self, context):
+        try:
+            post_id, em = await self.app.get_random_embedded_post(context.guild.id)
+        except asyncio.TimeoutError:
+            self.app.logger.error('Timed out fetching a new post from Reddit')
+            await send(context, "Reddit took too long to respond. Please try again later.")
+            return
+        await send(context, embed=em)
+
+    @commands.command(
+        description="Searches for a new food picture to post into the channel",
+        help=help_bot_search(),
+        usage="something I want to search separated by spaces",
+        brief="Search for new food picture"
+    )
+    async def search(self, context, *search_terms: str):
+        try:
+            query = build_query(search_terms)
+        except ValueError:
+            self.app.logger.exception('Exception occurred building search query')
+            await send(context, "Specify at least one term to search for")
+            return
+        try:
+            em = await self.app.search_posts(query, context.guild.id)
+        except asyncio.TimeoutError:
+            self.app.logger.error(f'Timed out searching Reddit for {query}')
+            await send(context, "Reddit took too long to respond. Please try again later.")
+            return
+        if em is None:
+            await send(context, f"No titles containing {search_terms} found in defined subreddits")
+            return
+        else:
+            await send(context, embed=em)
+            return
+
+    @commands.command(
+        description="Clears all of the Reddit post IDs that are persisted for deduplication",
+        help=help_bot_clear(),
+        brief="Flushes Redis keys"
+    )
+    @commands.guild_only()  # restrict this command to Guild channels
+    @is_admin()
+    async def clear(self, context):
+        await redis_connector.flush_all_records_async(self.app.logger)
+        await send(context, "Successfully cleared contents")
+
+    @commands.command(
+        description="Restarts the bot on request",
+        help=help_bot_restart(),
+        brief="Restarts bot"
+    )
+    @commands.guild_only()  # restrict this command to Guild channels
+    @is_admin()
+    async def restart(self, context):
+        if not self.app.restart_bot():
+            await send(context, "Error when attempting to restart bot. Please restart manually.")
+
+    @commands.command(
+        description="Sets how many hours apart the scheduled posts to this server are",
+        help=help_bot_cadence(),
+        brief="Sets scheduled post cadence",
+        usage="hours"
+    )
+    @commands.guild_only()  # restrict this command to Guild channels
+    @is_admin()
+    async def cadence(self, context, hours: int):
+        try:
+            await self.app.broadcast_scheduler.set_cadence(context.guild.id, hours)
+        except ValueError:
+            await send(context, "Scheduled posts need to be at least 1 hour apart")
+            return
+        await send(context, f"Scheduled posts will be sent every {hours} hours")
+
+    @commands.group(
+        description="Shows or changes the subreddits that this server's posts come from",
+        help=help_bot_subreddits(),
+        brief="Shows or changes subreddits",
+        invoke_without_command=True
+    )
+    @commands.guild_only()  # restrict this command to Guild channels
+    async def subreddits(self, context):
+        subs = await self.app.guild_subreddits.get(context.guild.id)
+        await send(context, f"Posts come from {', '.join('r/' + s for s in subs)}")
+
+    @subreddits.command(name='set', usage="subreddit [subreddit...]")
+    @is_admin()
+    async def set_subreddits(self, context, *names: str):
+        await self.change_subreddits(context, self.app.guild_subreddits.set, names)
+
+    @subreddits.command(name='add', usage="subreddit [subreddit...]")
+    @is_admin()
+    async def add_subreddits(self, context, *names: str):
+        await self.change_subreddits(context, self.app.guild_subreddits.add, names)
+
+    @subreddits.command(name='remove', usage="subreddit [subreddit...]")
+    @is_admin()
+    async def remove_subreddits(self, context, *names: str):
+        await self.change_subreddits(context, self.app.guild_subreddits.remove, names)
+
+    @subreddits.command(name='reset')
+    @is_admin()
+    async def reset_subreddits(self, context):
+        await self.app.guild_subreddits.reset(context.guild.id)
+        subs = self.app.guild_subreddits.default
+        await send(context, f"Posts will come from the default subreddits, {', '.join('r/' + s for s in subs)}")
+
+    # applies one of the GuildSubreddits changes to the context's guild, and replies with the outcome
+    async def change_subreddits(self, context, change, names: Tuple[str, ...]):
+        try:
+            subs = await change(context.guild.id, names)
+        except ValueError as e:
+            await send(context, str(e))
+            return
+        await send(context, f"Posts will come from {', '.join('r/' + s for s in subs)}")
+
+    @commands.command(
+        description="Print a page of the stored Redis keys to log",
+        help=help_bot_list_keys(),
+        brief="Logs Redis keys",
+        usage="[cursor]"
+    )
+    @is_admin()
+    async def keys(self, context, cursor: int = 0):
+        next_cursor = await redis_connector.enumerate_keys_page_async(self.app.logger, cursor)
+        if next_cursor is None:
+            await send(context, "Error occurred when printing Redis keys to log")
+        elif next_cursor == 0:
+            await send(context, "Successfully printed Redis keys to log")
+        else:
+            await send(context, f"Printed a page of Redis keys to log. Use `!food keys {next_cursor}` for the next page")
+
+    @commands.command(
+        description="Get and print the server where a Reddit submission was posted",
+        help=help_bot_fetch_value_from_redis(),
+        brief="Print Redis key-value pair",
+        usage="some_reddit_post_id"
+    )
+    @is_admin()
+    async def fetch(self, context, *ids: str):
+        if len(ids) != 1:
+            await send(context, "Only allowed to fetch one value from Redis at a time.")
+            return
+        reddit_id = ids[0]
+        val = await redis_connector.get_value_async(reddit_id)
+        if val is not None:
+            await send(context, f"{reddit_id} -> {val}")
+        else:
+            await send(context, f"Couldn't find key {reddit_id} in Redis.")
+
+
+# creates the bot from the environment: the subreddits to post from ("SUBREDDITS"),
+# and the shards that this process runs ("SHARD_COUNT" and "SHARD_IDS").
+# Nothing is connected to until the bot is run, or a client is first used
+def create_app(logger: Optional[logging.Logger] = None, **kwargs) -> FoodWaifu:
+    # read a list of subreddits from the environment, and use that
+    # for the search criteria
+    subs_list = read_subreddits_from_env()
+    shard_count, shard_ids = read_shards_from_env()
+    return FoodWaifu(subs_list, logger or logging.getLogger(__name__), shard_count, shard_ids, **kwargs)
+
+
+def main():
+    # log records are written to the console by a background thread, not the event loop
+    logger, log_listener = logging_config.configure()
+    try:
+        app = create_app(logger)
+        import auths
+        app.run(auths.discord_token)
+    except Exception as e:
+        logger.error(repr(e))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# Which subreddits each guild gets its posts from. A guild uses the bot's
+# default subreddits (SUBREDDITS) until an admin configures its own with
+# `!food subreddits`. The configured subreddits are persisted (see
+# redis_connector), and each guild's are loaded once, by the process that
+# serves its shard, so commands never wait on Redis for them after that.
+# Guilds are grouped by their subreddits, so that every guild with the same
+# subreddits shares one selection of posts, and every subreddit is fetched from
+# Reddit once no matter how many guilds use it.
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+import re
+
+
+# Maximum number of subreddits that a guild can configure
+MAX_SUBREDDITS = 10
+# Subreddit names are 3 to 21 letters, digits and underscores. A few older ones are 2 letters long
+NAME_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_]{1,20}$')
+
+
+# takes subreddit names as an admin typed them, with or without the "r/" and
+# separated by spaces or commas, and returns them in lowercase without duplicates.
+# Raises a ValueError if a name isn't valid, or there are none or more than `max_subreddits`
+def parse_subreddits(names: Iterable[str], max_subreddits: Optional[int] = MAX_SUBREDDITS) -> List[str]:
+    subs = []
+    for name in ' '.join(names).replace(',', ' ').split():
+        name = name.lower()
+        if name.startswith('/'):
+            name = name[1:]
+        if name.startswith('r/'):
+            name = name[2:]
+        if NAME_PATTERN.match(name) is None:
+            raise ValueError(f'{name} is not a valid subreddit name')
+        if name not in subs:
+            subs.append(name)
+    if len(subs) < 1:
+        raise ValueError('Specify at least one subreddit')
+    if max_subreddits is not None and len(subs) > max_subreddits:
+        raise ValueError(f'A server can use at most {max_subreddits} subreddits')
+    return subs
+
+
+# takes guild ID -> subreddits, and returns the guilds that use each set of subreddits.
+# the order the subreddits were configured in doesn't matter, so each set is keyed in sorted order
+def group_by_subreddits(subreddits: Dict[int, List[str]]) -> Dict[Tuple[str, ...], List[int]]:
+    groups = {}
+    for guild_id, subs in subreddits.items():
+        groups.setdefault(tuple(sorted(subs)), []).append(guild_id)
+    return groups
+
+
+class GuildSubreddits:
+    # Attributes
+    # default - subreddits of the guilds that didn't configure their own, in lowercase
+    # load - coroutine function that takes guild IDs, and returns guild ID -> subreddits for the ones that have them
+    # save - coroutine function that takes a guild ID and its subreddits, and persists them
+    # delete - coroutine function that takes a guild ID, and forgets its subreddits
+    def __init__(self,
+                 default: List[str],
+                 load: Callable[[List[int]], Awaitable[Dict[int, List[str]]]],
+                 save: Callable[[int, List[str]], Awaitable],
+                 delete: Callable[[int], Awaitable],
+                 max_subreddits: int = MAX_SUBREDDITS):
+        self.default = [s.lower() for s in default]  # Reddit doesn't care, but the shared requests do
+        self.load = load
+        self.save = save
+        self.delete = delete
+        self.max_subreddits = max_subreddits
+        self._subs = {}  # guild ID -> configured subreddits, or None if it uses the default
+
+    # returns guild ID -> subreddits for each of the given guilds
+    async def get_many(self, guild_ids: Iterable[int]) -> Dict[int, List[str]]:
+        guild_ids = list(guild_ids)
+        unknown = [g for g in guild_ids if g not in self._subs]
+        if len(unknown) > 0:
+            configured = await self.load(unknown)
+            for guild_id in unknown:
+                self._subs[guild_id] = configured.get(guild_id)
+        return {g: self._subs[g] or self.default for g in guild_ids}
+
+    async def get(self, guild_id: int) -> List[str]:
+        return (await self.get_many([guild_id]))[guild_id]
+
+    # returns True if the guild configured its own subreddits
+    async def is_configured(self, guild_id: int) -> bool:
+        await self.get_many([guild_id])
+        return self._subs[guild_id] is not None
+
+    # sets the subreddits that a guild gets its posts from, and returns them as
+    # they were saved. Raises a ValueError if they aren't valid (see parse_subreddits)
+    async def set(self, guild_id: int, names: Iterable[str]) -> List[str]:
+        subs = parse_subreddits(names, self.max_subreddits)
+        await self.save(guild_id, subs)
+        self._subs[guild_id] = subs
+        return subs
+
+    # adds subreddits to the ones a guild uses, starting from the default if it has none configured
+    async def add(self, guild_id: int, names: Iterable[str]) -> List[str]:
+        return await self.set(guild_id, await self.get(guild_id) + list(names))
+
+    # removes subreddits from the ones a guild uses. Raises a ValueError if none would be left
+    async def remove(self, guild_id: int, names: Iterable[str]) -> List[str]:
+        removed = set(parse_subreddits(names, None))
+        return await self.set(guild_id, [s for s in await self.get(guild_id) if s not in removed])
+
+    # makes a guild use the default subreddits again
+    async def reset(self, guild_id: int) -> None:
+        await self.delete(guild_id)
+        self._subs[guild_id] = None
+
+    # forget the guild entirely, including its persisted subreddits
+    async def forget(self, guild_id: int) -> None:
+        self._subs.pop(guild_id, None)
+        await self.delete(guild_id)
@@ -27,9 +27,23 @@ def help_bot_restart() -> str:
     return 'The bot restarts itself. *Administrator Only*'
 
 
+# returns a string that details the usage of the 'cadence' function of the bot
+def help_bot_cadence() -> str:
+    return 'The bot sets how many hours apart its scheduled posts to this server are. ' \
+           'The default is one post every hour. *Administrator Only*'
+
+
+# returns a string that details the usage of the 'subreddits' function of the bot
+def help_bot_subreddits() -> str:
+    return 'The bot shows the subreddits that the posts to this server come from. ' \
+           'Use "set", "add" or "remove" followed by subreddit names to change them, ' \
+           'or "reset" to go back to the default ones. Changing them is *Administrator Only*'
+
+
 def help_bot_list_keys() -> str:
-    return 'The bot enumerates all of the current keys stored in Redis, ' \
-           'printing the values to the logger for debugging. *Administrator Only*'
+    return 'The bot enumerates the Reddit post IDs stored in Redis, a page at a time, ' \
+           'printing the values to the logger for debugging. Pass the cursor it replies ' \
+           'with to print the next page. *Administrator Only*'
 
 
 def help_bot_fetch_value_from_redis() -> str:
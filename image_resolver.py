@@ -0,0 +1,178 @@
+# Makes sure that the image of each candidate post can actually be embedded.
+# A submission's URL can be a hosted image, but it can also be a gallery, an
+# imgur page, a v.redd.it video or the permalink of a self post, which all
+# produce broken embeds. `get_image_url` maps a submission to a direct image
+# URL when it arrives, and `ImageResolver` checks the URLs of a batch of
+# candidates concurrently over HTTP, and drops the ones that definitely aren't
+# images. A check that can't tell (a timeout, a rate limit, a server error or
+# blocked egress) keeps the post, so one flaky host can't drop every candidate.
+# Both valid and invalid results are cached in Redis, so each URL is only
+# checked once in a while, no matter how many processes see it.
+from hashlib import sha1
+from html import unescape
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+from urllib.parse import urlsplit
+import aiohttp
+import asyncio
+import logging
+import os
+
+
+# Maximum number of image checks in flight at once
+CONCURRENCY = int(os.environ.get('IMAGE_CHECK_CONCURRENCY', '10'))
+# Seconds before a single image check is abandoned
+TIMEOUT = float(os.environ.get('IMAGE_CHECK_TIMEOUT', '5'))
+# Seconds that a URL that is a valid image is remembered for
+POSITIVE_TTL = float(os.environ.get('IMAGE_CHECK_POSITIVE_TTL', str(7 * 24 * 60 * 60)))
+# Seconds that a URL that isn't a valid image is remembered for
+NEGATIVE_TTL = float(os.environ.get('IMAGE_CHECK_NEGATIVE_TTL', str(24 * 60 * 60)))
+# Number of candidates checked at once when only the first valid one is needed
+FIRST_VALID_BATCH_SIZE = int(os.environ.get('IMAGE_CHECK_BATCH_SIZE', '5'))
+
+IMGUR_HOSTS = ('imgur.com', 'www.imgur.com', 'm.imgur.com')
+
+
+# takes a Reddit submission, and returns the URL of the image that should be
+# embedded for it, or an empty string if it doesn't have one.
+# only the data that came with the listing is read (through `vars`), because
+# reading a missing attribute of a PRAW submission fetches it from Reddit
+def get_image_url(submission) -> str:
+    data = vars(submission)
+    url = data.get('url') or ''
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+
+    # galleries link to reddit.com/gallery/<id>, so embed the first image
+    if data.get('is_gallery'):
+        metadata = data.get('media_metadata') or {}
+        items = (data.get('gallery_data') or {}).get('items') or []
+        for item in items:
+            source = metadata.get(item.get('media_id'), {}).get('s', {})
+            if 'u' in source:
+                return unescape(source['u'])
+        return ''
+
+    # videos and self posts don't link to an image, but Reddit usually generates a preview
+    is_permalink = host.endswith('reddit.com') and '/comments/' in parts.path
+    if host == 'v.redd.it' or data.get('is_video') or data.get('is_self') or is_permalink:
+        images = (data.get('preview') or {}).get('images') or [{}]
+        return unescape(images[0].get('source', {}).get('url', ''))
+
+    # imgur pages have a direct image at the same ID. albums don't, so they're left alone
+    segments = [s for s in parts.path.split('/') if s != '']
+    if host in IMGUR_HOSTS and len(segments) == 1:
+        return f'https://i.imgur.com/{segments[0]}.jpg'
+    if host == 'i.imgur.com' and parts.path.endswith('.gifv'):
+        return url[:-len('.gifv')] + '.gif'
+
+    return url
+
+
+class ImageResolver:
+    # Attributes
+    # load - coroutine function that takes cache keys, and returns key -> cached result
+    #        for the keys that are cached
+    # save - coroutine function that takes key -> result, and the positive and negative TTLs, and caches them
+    # checks - number of URLs that were checked over HTTP
+    # cache_hits - number of URLs whose result came from the cache
+    def __init__(self,
+                 load: Callable[[List[str]], Awaitable[Dict[str, bool]]],
+                 save: Callable[[Dict[str, bool], float, float], Awaitable],
+                 concurrency: int = CONCURRENCY,
+                 timeout: float = TIMEOUT,
+                 positive_ttl: float = POSITIVE_TTL,
+                 negative_ttl: float = NEGATIVE_TTL,
+                 logger: Optional[logging.Logger] = None):
+        self.load = load
+        self.save = save
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.logger = logger
+        self.checks = 0
+        self.cache_hits = 0
+        self._session = None
+
+    # the cache key for a URL. URLs can be long, so they are hashed
+    @staticmethod
+    def key(url: str) -> str:
+        return sha1(url.encode('utf-8')).hexdigest()
+
+    # the HTTP session is created on first use, so that it belongs to the running event loop.
+    # its connection pool bounds the number of checks in flight
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    # returns True if the URL is an image, False if it definitely isn't (it's gone,
+    # or it isn't an image), and None if that couldn't be determined right now
+    # (i.e.: a timeout, or the server had an error), in which case the result shouldn't be cached
+    async def check(self, url: str) -> Optional[bool]:
+        self.checks += 1
+        session = self._get_session()
+        try:
+            async with session.head(url, allow_redirects=True) as response:
+                status, content_type = response.status, response.content_type
+            # some hosts don't support HEAD requests, so fall back to a GET.
+            # only the headers are read, the body is discarded
+            if status == 405:
+                async with session.get(url, allow_redirects=True) as response:
+                    status, content_type = response.status, response.content_type
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            if self.logger is not None:
+                self.logger.warn('Failed to check image %s: %r', url, e)
+            return None
+        if status in (404, 410):
+            return False
+        if 200 <= status < 300:
+            return content_type.startswith('image/')
+        return None
+
+    # returns URL -> whether it is an image, for each of the given URLs.
+    # URLs whose check couldn't tell are treated as valid, but aren't cached
+    async def validate(self, urls: Iterable[str]) -> Dict[str, bool]:
+        urls = [url for url in dict.fromkeys(urls) if url != '']
+        keys = {url: ImageResolver.key(url) for url in urls}
+        cached = await self.load(list(keys.values()))
+        results = {url: cached[keys[url]] for url in urls if keys[url] in cached}
+        self.cache_hits += len(results)
+        results[''] = False  # posts without an image URL are never valid
+
+        unchecked = [url for url in urls if url not in results]
+        checked = await asyncio.gather(*[self.check(url) for url in unchecked])
+        to_save = {}
+        for url, valid in zip(unchecked, checked):
+            results[url] = valid is not False
+            if valid is not None:
+                to_save[keys[url]] = valid
+        await self.save(to_save, self.positive_ttl, self.negative_ttl)
+        return results
+
+    # takes candidate posts, and returns the ones whose image is valid, in the same order
+    async def resolve(self, posts: list) -> list:
+        if len(posts) < 1:
+            return []
+        results = await self.validate(p.image_url or '' for p in posts)
+        valid = [p for p in posts if results[p.image_url or '']]
+        if self.logger is not None and len(valid) < len(posts):
+            self.logger.info(f'Dropped {len(posts) - len(valid)} of {len(posts)} posts without a valid image')
+        return valid
+
+    # returns the first of the candidate posts whose image is valid, or None.
+    # candidates are checked in order, a small batch at a time, so a single post
+    # doesn't wait on the checks of every candidate after it
+    async def first_valid(self, posts: list, batch_size: int = FIRST_VALID_BATCH_SIZE):
+        for start in range(0, len(posts), batch_size):
+            valid = await self.resolve(posts[start:start + batch_size])
+            if len(valid) > 0:
+                return valid[0]
+        return None
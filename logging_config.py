@@ -0,0 +1,46 @@
+# Sets up the bot's logging, so that log records are written to the console
+# by a background thread instead of the thread that logged them. The event
+# loop only puts each record on a queue, and never blocks on writing it.
+# https://docs.python.org/3/howto/logging-cookbook.html#dealing-with-handlers-that-block
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, TextIO, Tuple
+import atexit
+import logging
+import os
+import queue
+
+
+# Level of the messages that are logged. Per post messages are only logged at DEBUG
+LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# listeners that `configure` started, and that haven't been stopped yet
+_running = set()
+
+
+# configures the root logger to log through a queue, and starts the thread
+# that writes the queued records to `stream` (stderr by default).
+# returns the root logger, and the listener that owns the thread. The listener
+# is stopped when the process exits, which writes out anything still queued.
+def configure(level: str = LEVEL, stream: Optional[TextIO] = None) -> Tuple[logging.Logger, QueueListener]:
+    records = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(logging.Formatter(FORMAT))
+
+    logger = logging.getLogger()
+    logger.setLevel(level)
+    logger.addHandler(QueueHandler(records))
+
+    listener = QueueListener(records, stream_handler)
+    listener.start()
+    _running.add(listener)
+    atexit.register(stop, listener)
+    return logger, listener
+
+
+# stops the listener's thread, once everything that was queued has been written.
+# QueueListener.stop can't be called twice, so this does nothing if it was already stopped
+def stop(listener: QueueListener) -> None:
+    if listener in _running:
+        _running.discard(listener)
+        listener.stop()
@@ -0,0 +1,194 @@
+# In-process metrics for the bot: counters, gauges and latency histograms,
+# rendered in the Prometheus text format and served over HTTP on a local port,
+# so they can be scraped (or just curl'd) without any external service.
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+# Metrics are registered by name, and registering the same name again returns
+# the existing metric, so modules can declare the metrics they use at import time.
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+import math
+import os
+import threading
+import time
+
+
+# Address that the metrics endpoint listens on. Setting METRICS_PORT to 0 disables it
+HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+PORT = int(os.environ.get('METRICS_PORT', '9108'))
+# Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if len(names) < 1:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+# Common behavior of every metric: a name, a description, and a value per
+# combination of label values. Metrics are updated from the Redis and Reddit
+# worker threads, so updates hold a lock.
+class _Metric:
+    kind = ''
+
+    # Attributes
+    # name - name of the metric, as it is exported
+    # description - what the metric measures
+    # labels - names of the labels that each value is keyed by
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}  # tuple of label values -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labels):
+            raise ValueError(f'{self.name} takes the labels {self.labels}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            return [(self.name, _format_labels(self.labels, k), v) for k, v in sorted(self._values.items())]
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(f'{name}{labels} {_format_value(value)}' for name, labels, value in self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if amount < 0:
+            raise ValueError('Counters can only go up')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    # Attributes
+    # buckets - upper bounds of the buckets, in increasing order
+    # clock - returns the current time, used to time blocks of code
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, clock: Callable[[], float] = time.perf_counter):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.clock = clock
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    # times the block of code that it wraps, and observes the duration, even if the block raises
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.observe(self.clock() - start, **labels)
+
+    def count(self, **labels) -> int:
+        counts, _ = self._values.get(self._key(labels), ([0] * len(self.buckets), 0.0))
+        return counts[-1]
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    labels = _format_labels(self.labels + ('le',), key + (_format_value(bound),))
+                    samples.append((f'{self.name}_bucket', labels, count))
+                labels = _format_labels(self.labels, key)
+                samples.append((f'{self.name}_sum', labels, total))
+                samples.append((f'{self.name}_count', labels, counts[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}  # name -> metric, in the order they were registered
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name: str, description: str, labels: Sequence[str], **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, description, labels, **kwargs)
+            elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+                raise ValueError(f'{name} is already registered as a different metric')
+            return metric
+
+    def counter(self, name: str, description: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, description, labels)
+
+    def gauge(self, name: str, description: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, name, description, labels)
+
+    def histogram(self, name: str, description: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, description, labels, buckets=buckets)
+
+    # returns every metric in the Prometheus text format
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return ''.join(metric.render() + '\n' for metric in metrics)
+
+
+# The registry that the bot's modules register their metrics with
+registry = Registry()
+
+
+# starts serving the registry's metrics on http://host:port/metrics, and
+# returns the runner, which should be cleaned up to stop serving
+async def start_server(metrics_registry: Registry = registry, host: str = HOST,
+                       port: int = PORT):
+    # only the bot itself serves the metrics, so the modules that just record them don't need aiohttp
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(body=metrics_registry.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
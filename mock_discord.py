@@ -0,0 +1,34 @@
+# Stand-ins for the discord.py channels and guilds that the bot looks at,
+# shared by the tests and the benchmarks. DummyChannel is a TextChannel,
+# so that code which checks for text channels accepts it.
+from discord import TextChannel
+
+
+class DummyPermissions:
+    def __init__(self, send_messages: bool):
+        self.send_messages = send_messages
+
+
+class DummyChannel(TextChannel):
+    def __init__(self, channel_id: int, position: int, can_send: bool = True):
+        self.id = channel_id
+        self.position = position
+        self.can_send = can_send
+        self.checks = 0
+
+    def permissions_for(self, member):
+        self.checks += 1
+        return DummyPermissions(self.can_send)
+
+
+class DummyGuild:
+    def __init__(self, guild_id: int, channels):
+        self.id = guild_id
+        self.me = object()
+        self.channels = channels
+
+    def get_channel(self, channel_id: int):
+        for channel in self.channels:
+            if channel.id == channel_id:
+                return channel
+        return None
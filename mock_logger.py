@@ -6,23 +6,33 @@
 # See: https://docs.pytest.org/en/stable/logging.html
 class MockLogger:
     def __init__(self):
+        self.debug_messages = []
         self.info_messages = []
         self.warn_messages = []
         self.error_messages = []
     
-    def info(self, msg: str):
-        self.info_messages.append(msg)
+    # messages can be formatted lazily, the same way as with logging.Logger
+    @staticmethod
+    def _format(msg: str, args: tuple) -> str:
+        return msg % args if len(args) > 0 else msg
+
+    def debug(self, msg: str, *args):
+        self.debug_messages.append(MockLogger._format(msg, args))
+
+    def info(self, msg: str, *args):
+        self.info_messages.append(MockLogger._format(msg, args))
     
-    def warn(self, msg: str):
-        self.warn_messages.append(msg)
+    def warn(self, msg: str, *args):
+        self.warn_messages.append(MockLogger._format(msg, args))
 
-    def error(self, msg: str):
-        self.error_messages.append(msg)
+    def error(self, msg: str, *args):
+        self.error_messages.append(MockLogger._format(msg, args))
 
     # Flush all of the log messages so the mock logger
     # can be used fresh for each test execution, without
     # always creating a new logger object for each test case
     def flush(self) -> None:
+        self.debug_messages.clear()
         self.info_messages.clear()
         self.warn_messages.clear()
         self.error_messages.clear()
@@ -0,0 +1,320 @@
+# Mock Redis client that keeps its data in memory, shared by the tests of the
+# modules that store their state in Redis. Also has the helpers that point
+# `redis_connector` at a mock client, or run processes against a real server.
+from bloom_filter import BloomFilter
+from circuit_breaker import CircuitBreaker
+from fnmatch import fnmatch
+from typing import Callable, Optional
+import os
+import redis_connector
+
+
+# Mock Redis pipeline that buffers commands and runs them against
+# the owning client on execute()
+class MockPipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, command: str):
+        method = getattr(self.client, command)
+        return lambda *args, **kwargs: self.commands.append(lambda: method(*args, **kwargs))
+
+    def execute(self):
+        if self.client.down:
+            import redis
+            raise redis.ConnectionError('Connection refused')
+        round_trips = self.client.round_trips
+        if self.client.should_fail:
+            import redis
+            raise redis.RedisError('Oops')
+        results = [command() for command in self.commands]
+        # the commands in a pipeline all share one round trip
+        self.client.round_trips = round_trips + 1
+        return results
+
+
+# Sorted set stored in the mock client, as member -> score
+class MockSortedSet(dict):
+    def ordered(self) -> list:
+        return sorted(self, key=lambda m: (self[m], m))
+
+    # checks a score against Redis-style bounds, where '(' makes a bound exclusive
+    @staticmethod
+    def in_range(score: float, low, high) -> bool:
+        def above(bound) -> bool:
+            bound = str(bound)
+            return score > float(bound[1:]) if bound.startswith('(') else score >= float(bound)
+
+        def below(bound) -> bool:
+            bound = str(bound)
+            return score < float(bound[1:]) if bound.startswith('(') else score <= float(bound)
+        return above(low) and below(high)
+
+
+# Stream stored in the mock client, with its consumer groups
+class MockStream(dict):  # entry ID -> fields
+    def __init__(self):
+        super().__init__()
+        self.sequence = 0
+        self.groups = {}  # group -> {'last': last delivered entry number, 'pending': entry ID -> [consumer, ms, count]}
+
+
+# Mock Redis client to use for testing.
+# The `should_fail` flag is used to force specific code branches for
+# consistent testing and more code coverage.
+class MockRedisClient:
+    def __init__(self, should_fail: bool = False):
+        self.cache = {}  # store a cache internally: key -> string, dict (hash) or set
+        self.should_fail = should_fail
+        self.round_trips = 0
+        self.lookups = 0  # number of post IDs looked up in the posts hash
+        self.now_ms = 0  # the time, as seen by the streams' pending entries
+        self.down = False  # set to make every command fail to connect, as if Redis was down
+
+    def _call(self):
+        if self.down:
+            import redis
+            raise redis.ConnectionError('Connection refused')
+        self.round_trips += 1
+
+    def ping(self) -> bool:
+        self._call()
+        return True
+
+    def pipeline(self, transaction: bool = True):
+        return MockPipeline(self)
+
+    def set(self, key: str, value, nx: bool = False, ex: int = None) -> bool:
+        self._call()
+        if nx and key in self.cache:
+            return False
+        self.cache[key] = str(value)
+        return True
+
+    def get(self, key: str) -> Optional[str]:
+        self._call()
+        return self.cache.get(key)
+
+    def mget(self, keys) -> list:
+        self._call()
+        return [self.cache.get(key) for key in keys]
+
+    def exists(self, *keys: str) -> int:
+        self._call()
+        return sum(1 for key in keys if key in self.cache)
+
+    def type(self, key: str) -> str:
+        self._call()
+        value = self.cache.get(key)
+        if value is None:
+            return 'none'
+        return {dict: 'hash', set: 'set', MockSortedSet: 'zset', MockStream: 'stream'}.get(type(value), 'string')
+
+    def unlink(self, *keys: str) -> int:
+        self._call()
+        if self.should_fail:
+            import redis
+            raise redis.RedisError('Oops')
+        return sum(1 for key in keys if self.cache.pop(key, None) is not None)
+
+    def scan_iter(self, match: str = None, count: int = None):
+        self._call()
+        return iter([key for key in list(self.cache.keys()) if match is None or fnmatch(key, match)])
+
+    def hget(self, name: str, key) -> Optional[str]:
+        self._call()
+        return self.cache.get(name, {}).get(str(key))
+
+    def hset(self, name: str, key=None, value=None, mapping=None) -> int:
+        self._call()
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        for k, v in items.items():
+            self.cache.setdefault(name, {})[str(k)] = str(v)
+        return len(items)
+
+    def hmget(self, name: str, keys) -> list:
+        self._call()
+        self.lookups += len(keys)
+        return [self.cache.get(name, {}).get(str(key)) for key in keys]
+
+    def hscan(self, name: str, cursor: int = 0, count: int = 10):
+        self._call()
+        if self.should_fail:
+            raise Exception('Oops')
+        items = list(self.cache.get(name, {}).items())
+        page = dict(items[cursor:cursor + count])
+        next_cursor = cursor + count if cursor + count < len(items) else 0
+        return next_cursor, page
+
+    def hscan_iter(self, name: str, count: int = 10):
+        self._call()
+        return iter(list(self.cache.get(name, {}).items()))
+
+    def hdel(self, name: str, *keys) -> int:
+        self._call()
+        return sum(1 for key in keys if self.cache.get(name, {}).pop(str(key), None) is not None)
+
+    def zadd(self, name: str, mapping: dict, nx: bool = False) -> int:
+        self._call()
+        zset = self.cache.setdefault(name, MockSortedSet())
+        added = 0
+        for member, score in mapping.items():
+            if member not in zset:
+                added += 1
+            elif nx:
+                continue
+            zset[member] = float(score)
+        return added
+
+    def zscore(self, name: str, member: str) -> Optional[float]:
+        self._call()
+        self.lookups += 1
+        return self.cache.get(name, {}).get(member)
+
+    def zcard(self, name: str) -> int:
+        self._call()
+        return len(self.cache.get(name, {}))
+
+    def zrange(self, name: str, start: int, end: int) -> list:
+        self._call()
+        members = self.cache.get(name, MockSortedSet()).ordered()
+        return members[start:end + 1 if end != -1 else None]
+
+    def zrangebyscore(self, name: str, low, high, start: int = None, num: int = None) -> list:
+        self._call()
+        zset = self.cache.get(name, MockSortedSet())
+        members = [m for m in zset.ordered() if MockSortedSet.in_range(zset[m], low, high)]
+        if start is not None:
+            members = members[start:start + num]
+        return members
+
+    def zrem(self, name: str, *members) -> int:
+        self._call()
+        return sum(1 for m in members if self.cache.get(name, {}).pop(m, None) is not None)
+
+    def xadd(self, name: str, fields: dict, maxlen: int = None, approximate: bool = True) -> str:
+        self._call()
+        stream = self.cache.setdefault(name, MockStream())
+        stream.sequence += 1
+        entry_id = f'{stream.sequence}-0'
+        stream[entry_id] = {k: str(v) for k, v in fields.items()}
+        return entry_id
+
+    def xrange(self, name: str, min: str = '-', max: str = '+', count: int = None) -> list:
+        self._call()
+        return list(self.cache.get(name, MockStream()).items())[:count]
+
+    def xrevrange(self, name: str, max: str = '+', min: str = '-', count: int = None) -> list:
+        self._call()
+        return list(reversed(self.cache.get(name, MockStream()).items()))[:count]
+
+    def xread(self, streams: dict, count: int = None, block: int = None) -> list:
+        self._call()
+        name, last = list(streams.items())[0]
+        stream = self.cache.get(name, MockStream())
+        entries = [(e, fields) for e, fields in stream.items() if int(e.split('-')[0]) > int(last.split('-')[0])][:count]
+        return [[name, entries]] if len(entries) > 0 else []
+
+    def xgroup_create(self, name: str, group: str, id: str = '$', mkstream: bool = False) -> bool:
+        self._call()
+        stream = self.cache.setdefault(name, MockStream())
+        if group in stream.groups:
+            import redis
+            raise redis.ResponseError('BUSYGROUP Consumer Group name already exists')
+        stream.groups[group] = {'last': 0 if id == '0' else stream.sequence, 'pending': {}}
+        return True
+
+    def xreadgroup(self, group: str, consumer: str, streams: dict, count: int = None, block: int = None) -> list:
+        self._call()
+        name = list(streams)[0]
+        stream = self.cache[name]
+        state = stream.groups[group]
+        entries = [e for e in stream if int(e.split('-')[0]) > state['last']][:count]
+        if len(entries) < 1:
+            return []
+        for entry_id in entries:
+            state['pending'][entry_id] = [consumer, self.now_ms, 1]
+        state['last'] = int(entries[-1].split('-')[0])
+        return [[name, [(entry_id, stream[entry_id]) for entry_id in entries]]]
+
+    def xpending_range(self, name: str, group: str, min: str, max: str, count: int) -> list:
+        self._call()
+        pending = self.cache[name].groups[group]['pending']
+        return [{'message_id': entry_id, 'consumer': consumer, 'time_since_delivered': self.now_ms - delivered_at,
+                 'times_delivered': times} for entry_id, (consumer, delivered_at, times) in list(pending.items())[:count]]
+
+    def xclaim(self, name: str, group: str, consumer: str, min_idle_time: int, message_ids: list) -> list:
+        self._call()
+        stream = self.cache[name]
+        pending = stream.groups[group]['pending']
+        claimed = []
+        for entry_id in message_ids:
+            if entry_id in pending and self.now_ms - pending[entry_id][1] >= min_idle_time:
+                pending[entry_id] = [consumer, self.now_ms, pending[entry_id][2] + 1]
+                claimed.append((entry_id, stream.get(entry_id)))
+        return claimed
+
+    def xack(self, name: str, group: str, *ids) -> int:
+        self._call()
+        pending = self.cache[name].groups[group]['pending']
+        return sum(1 for entry_id in ids if pending.pop(entry_id, None) is not None)
+
+    def xdel(self, name: str, *ids) -> int:
+        self._call()
+        return sum(1 for entry_id in ids if self.cache[name].pop(entry_id, None) is not None)
+
+    def sadd(self, name: str, *values) -> int:
+        self._call()
+        members = self.cache.setdefault(name, set())
+        added = len(set(values) - members)
+        members.update(values)
+        return added
+
+
+# points `redis_connector` at a new client, which is created by whichever `redis.from_url`
+# the test mocked the first time it's used, with a closed circuit breaker and an empty dedup filter
+def reset_redis_connector(monkeypatch, clock: Callable[[], float] = lambda: 0) -> None:
+    monkeypatch.setenv('REDIS_URL', 'something')
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=clock)
+    monkeypatch.setattr(redis_connector, 'breaker', breaker)
+    monkeypatch.setattr(redis_connector, 'r', redis_connector.GuardedClient(redis_connector.LazyClient(
+        redis_connector.connect), breaker))
+    monkeypatch.setattr(redis_connector, 'pending_posts', redis_connector.PendingPosts(100))
+    monkeypatch.setattr(redis_connector, 'used_posts', BloomFilter(10000))
+    monkeypatch.setattr(redis_connector, 'used_posts_warm', False)
+    monkeypatch.setattr(redis_connector, 'used_posts_synced_to', None)
+    monkeypatch.setattr(redis_connector, 'used_posts_synced_at', None)
+    monkeypatch.setattr(redis_connector, 'used_posts_behind', False)
+    monkeypatch.setattr(redis_connector, 'filter_stats', {'skipped': 0, 'checked': 0})
+
+
+# runs `target(name, results)` in `count` new processes, which use the Redis server
+# given by REDIS_TEST_URL, under a key prefix of their own. Returns what each of
+# them put on the results queue. The keys under the prefix are removed afterwards
+def run_against_redis(monkeypatch, target, count: int) -> list:
+    import multiprocessing
+    import uuid
+    import redis
+    url = os.environ['REDIS_TEST_URL']
+    prefix = f'food_waifu_test_{uuid.uuid4().hex}'
+    # the new processes import redis_connector with these set
+    monkeypatch.setenv('REDIS_URL', url)
+    monkeypatch.setenv('REDIS_KEY_PREFIX', prefix)
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [context.Process(target=target, args=(f'process{i}', results)) for i in range(count)]
+    try:
+        for process in processes:
+            process.start()
+        outcomes = [results.get(timeout=30) for _ in processes]
+        for process in processes:
+            process.join(timeout=30)
+        return outcomes
+    finally:
+        client = redis.from_url(url)
+        keys = list(client.scan_iter(match=f'{prefix}:*'))
+        if len(keys) > 0:
+            client.delete(*keys)
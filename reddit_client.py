@@ -0,0 +1,319 @@
+# Runs the blocking PRAW calls that the bot makes on a dedicated, bounded
+# thread pool, so that a slow response from Reddit only holds up the command
+# that made the request, instead of the whole Discord event loop.
+# Every call has a timeout, and awaiting callers can be cancelled. Note that
+# a request that is already in flight keeps its worker thread until prawcore's
+# own socket timeout expires; cancelling only frees up the caller.
+# `RedditClient` wraps the PRAW client to spend Reddit's rate limit carefully:
+# it waits for budget on the event loop, shares identical requests that are
+# already in flight between their callers, and reuses listing pages briefly.
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Hashable, Iterable, List, Optional, Sequence, Tuple
+import asyncio
+import metrics
+import time
+from utility import interleave
+
+
+# Maximum number of Reddit requests that can be in flight at the same time
+MAX_WORKERS = int(os.environ.get('REDDIT_MAX_WORKERS', '4'))
+# Number of seconds to wait on a single listing or search before giving up
+TIMEOUT = float(os.environ.get('REDDIT_TIMEOUT', '20'))
+# Reddit returns at most this many submissions for a single listing request
+MAX_PAGE_SIZE = 100
+# Number of seconds that a listing page is reused for, instead of being requested again
+LISTING_CACHE_TTL = float(os.environ.get('REDDIT_LISTING_CACHE_TTL', '30'))
+# Maximum number of listing pages kept in the cache
+LISTING_CACHE_SIZE = 256
+# Reddit allows each OAuth client this many requests per window of this many seconds
+RATE_LIMIT = 600
+RATE_LIMIT_WINDOW = 600
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='reddit')
+
+requests_total = metrics.registry.counter('food_waifu_reddit_requests_total',
+                                          'Listing and search requests made to Reddit', ('operation', 'outcome'))
+request_seconds = metrics.registry.histogram('food_waifu_reddit_request_seconds',
+                                             'Time taken by listing and search requests to Reddit', ('operation',))
+saved_calls_total = metrics.registry.counter('food_waifu_reddit_saved_calls_total',
+                                             'Listing and search calls answered without a request to Reddit',
+                                             ('reason',))
+rate_limit_remaining = metrics.registry.gauge('food_waifu_reddit_rate_limit_remaining',
+                                              'Requests left in the current rate limit window, as reported by Reddit')
+
+
+# takes a function that returns a PRAW listing generator, and fully consumes
+# it on the Reddit executor. Raises asyncio.TimeoutError if Reddit does not
+# respond within the timeout. `operation` names the request in the metrics.
+async def run(fetch: Callable[[], Iterable], timeout: Optional[float] = TIMEOUT, operation: str = 'other') -> list:
+    loop = asyncio.get_running_loop()
+    outcome = 'error'
+    try:
+        with request_seconds.time(operation=operation):
+            future = loop.run_in_executor(executor, lambda: list(fetch()))
+            result = await asyncio.wait_for(future, timeout)
+        outcome = 'ok'
+        return result
+    except asyncio.TimeoutError:
+        outcome = 'timeout'
+        raise
+    finally:
+        requests_total.inc(operation=operation, outcome=outcome)
+
+
+# returns up to `limit` submissions from the named listing ('hot', 'new', 'top', ...)
+# across all of the given subreddits. If `after` is the fullname of a submission,
+# the listing resumes right after it.
+async def listing(reddit, subs: List[str], name: str, limit: int,
+                  after: Optional[str] = None, timeout: Optional[float] = TIMEOUT) -> list:
+    joined_subs = '+'.join(subs)  # should have a string like "a+b+c"
+    params = {} if after is None else {'after': after}
+    return await run(lambda: getattr(reddit.subreddit(joined_subs), name)(limit=limit, params=params), timeout, name)
+
+
+# returns the hot submissions across all of the given subreddits
+async def hot(reddit, subs: List[str], limit: int, timeout: Optional[float] = TIMEOUT) -> list:
+    return await listing(reddit, subs, 'hot', limit, timeout=timeout)
+
+
+# returns the search results for the query across all of the given subreddits.
+# Extra keyword arguments (sort, syntax, time_filter, limit) are passed to PRAW.
+async def search(reddit, subs: List[str], query: str, timeout: Optional[float] = TIMEOUT, **kwargs) -> list:
+    joined_subs = '+'.join(subs)
+    return await run(lambda: reddit.subreddit(joined_subs).search(query=query, **kwargs), timeout, 'search')
+
+
+# Walks through the given listings page by page, resuming each request from the
+# last submission it saw instead of refetching the listing from the start.
+# When one listing runs out (or reaches max_items), it moves on to the next one.
+# Submissions that already showed up in an earlier page or listing are skipped,
+# so every page only holds submissions the caller has not checked yet.
+class ListingPager:
+    # Attributes
+    # listings - names of the listings to page through, in order
+    # first_page_size - number of submissions requested for the first page of each listing
+    # max_items - maximum number of submissions read from a single listing
+    # api_calls - number of listing pages requested so far
+    # items_fetched - number of submissions transferred from Reddit so far
+    def __init__(self, reddit: 'RedditClient', subs: List[str], listings: Sequence[str] = ('hot', 'new', 'top'),
+                 first_page_size: int = 20, max_items: int = 500, timeout: Optional[float] = TIMEOUT):
+        self.reddit = reddit
+        self.subs = subs
+        self.listings = list(listings)
+        self.first_page_size = first_page_size
+        self.max_items = max_items
+        self.timeout = timeout
+        self.api_calls = 0
+        self.items_fetched = 0
+        self._listing_index = 0
+        self._listing_count = 0  # submissions read from the current listing
+        self._after = None
+        self._seen = set()
+
+    # returns True once every listing has been exhausted
+    def exhausted(self) -> bool:
+        return self._listing_index >= len(self.listings)
+
+    def _next_listing(self) -> None:
+        self._listing_index += 1
+        self._listing_count = 0
+        self._after = None
+
+    # returns the next page of submissions that haven't been returned before.
+    # An empty list means that all of the listings are exhausted.
+    async def next_page(self) -> list:
+        while not self.exhausted():
+            name = self.listings[self._listing_index]
+            page_size = self.first_page_size if self._after is None else MAX_PAGE_SIZE
+            page_size = min(page_size, self.max_items - self._listing_count)
+            page = await self.reddit.listing(self.subs, name, page_size, self._after, self.timeout)
+            self.api_calls += 1  # page_size never exceeds one request's worth
+            self.items_fetched += len(page)
+            self._listing_count += len(page)
+            if len(page) < page_size or self._listing_count >= self.max_items:
+                self._next_listing()
+            else:
+                self._after = page[-1].fullname
+            new_items = [s for s in page if s.id not in self._seen]
+            self._seen.update(s.id for s in new_items)
+            if len(new_items) > 0:
+                return new_items
+        return []
+
+
+# Pages through the listings of several subreddits like a ListingPager, but
+# pages each subreddit on its own, and interleaves their pages. The requests
+# for a subreddit are then the same no matter which other subreddits it is
+# paged with, so RedditClient shares them between every guild that uses it,
+# instead of each combination of subreddits being a multireddit of its own.
+# Takes the same keyword arguments as ListingPager
+class MergedPager:
+    def __init__(self, reddit: 'RedditClient', subs: List[str], **kwargs):
+        self.pagers = [ListingPager(reddit, [sub], **kwargs) for sub in subs]
+        self._seen = set()
+
+    @property
+    def api_calls(self) -> int:
+        return sum(p.api_calls for p in self.pagers)
+
+    @property
+    def items_fetched(self) -> int:
+        return sum(p.items_fetched for p in self.pagers)
+
+    def exhausted(self) -> bool:
+        return all(p.exhausted() for p in self.pagers)
+
+    # returns the next page of every subreddit that isn't exhausted yet, interleaved,
+    # without the submissions returned before. An empty list means every listing is exhausted
+    async def next_page(self) -> list:
+        while not self.exhausted():
+            pages = await asyncio.gather(*[p.next_page() for p in self.pagers if not p.exhausted()])
+            new_items = [s for s in interleave(pages) if s.id not in self._seen]
+            self._seen.update(s.id for s in new_items)
+            if len(new_items) > 0:
+                return new_items
+        return []
+
+
+# Token bucket for Reddit's rate limit. Every request takes a token, and the
+# bucket is refilled when Reddit's rate limit window resets. Reddit reports the
+# requests remaining in the window, and the seconds until it resets, in the
+# X-Ratelimit-* headers of every response, and those replace the bucket's own
+# count. When the bucket is empty, requests wait here, on the event loop,
+# instead of holding a worker thread while prawcore sleeps.
+class RateBudget:
+    # Attributes
+    # capacity - number of requests allowed in a window
+    # window - length of the window, in seconds
+    # tokens - number of requests that can still be started in the current window
+    # reset_at - when the current window ends, according to `clock`
+    def __init__(self, capacity: int = RATE_LIMIT, window: float = RATE_LIMIT_WINDOW,
+                 clock: Callable[[], float] = time.monotonic):
+        self.capacity = capacity
+        self.window = window
+        self.clock = clock
+        self.tokens = capacity
+        self.reset_at = clock() + window
+        self.in_flight = 0
+
+    def _refill(self) -> None:
+        now = self.clock()
+        if now >= self.reset_at:
+            self.tokens = self.capacity
+            self.reset_at = now + self.window
+
+    # waits until a request can be made in the current window, and takes a token for it
+    async def acquire(self) -> None:
+        self._refill()
+        while self.tokens < 1:
+            await asyncio.sleep(max(0.0, self.reset_at - self.clock()))
+            self._refill()
+        self.tokens -= 1
+        self.in_flight += 1
+
+    # marks a request as finished, with what Reddit reported in its response, if anything
+    def release(self, reported: Optional[Tuple[float, float]] = None) -> None:
+        self.in_flight -= 1
+        if reported is not None:
+            remaining, seconds_to_reset = reported
+            # the requests still in flight were taken out of the budget already
+            self.tokens = max(0, int(remaining) - self.in_flight)
+            self.reset_at = self.clock() + seconds_to_reset
+            rate_limit_remaining.set(remaining)
+
+
+# returns the (requests remaining, seconds until reset) that Reddit last reported
+# to the PRAW client, or None if it hasn't reported any. prawcore parses them
+# from the X-Ratelimit-* headers of every response, into its rate limiter
+def reported_rate_limit(reddit) -> Optional[Tuple[float, float]]:
+    limiter = getattr(getattr(reddit, '_core', None), '_rate_limiter', None)
+    if limiter is None or limiter.remaining is None or limiter.reset_timestamp is None:
+        return None
+    return limiter.remaining, max(0.0, limiter.reset_timestamp - time.time())
+
+
+# Access to Reddit for the whole bot, around a single PRAW client.
+# Identical listing and search calls that are made while one of them is in
+# flight share its response, so a burst of the same command from many guilds
+# only makes one request. Listing pages are also cached for `cache_ttl` seconds.
+# Search results aren't cached here, because `SearchCache` already caches them.
+class RedditClient:
+    # Attributes
+    # reddit - the PRAW client
+    # budget - the rate limit budget that every request is made within
+    # cache_ttl - number of seconds that a listing page is reused for
+    # requests - number of requests made to Reddit
+    # saved - number of calls that were answered without a request to Reddit
+    def __init__(self, reddit, budget: Optional[RateBudget] = None, cache_ttl: float = LISTING_CACHE_TTL,
+                 cache_size: int = LISTING_CACHE_SIZE, clock: Callable[[], float] = time.monotonic):
+        self.reddit = reddit
+        self.budget = budget if budget is not None else RateBudget(clock=clock)
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.clock = clock
+        self.requests = 0
+        self.saved = 0
+        self._in_flight = {}  # call -> task that makes its request
+        self._pages = {}  # listing call -> (when it expires, page)
+
+    def _save(self, reason: str) -> None:
+        self.saved += 1
+        saved_calls_total.inc(reason=reason)
+
+    async def _request(self, fetch: Callable[[], Awaitable[list]]) -> list:
+        await self.budget.acquire()
+        self.requests += 1
+        try:
+            return await fetch()
+        finally:
+            self.budget.release(reported_rate_limit(self.reddit))
+
+    # makes the request for `call`, or waits on the same request if it's already
+    # in flight. A caller that is cancelled doesn't cancel the request for the others
+    async def _shared(self, call: Hashable, fetch: Callable[[], Awaitable[list]]) -> list:
+        task = self._in_flight.get(call)
+        if task is None:
+            task = asyncio.ensure_future(self._request(fetch))
+            self._in_flight[call] = task
+            task.add_done_callback(lambda t: self._finished(call, t))
+        else:
+            self._save('coalesced')
+        return list(await asyncio.shield(task))
+
+    def _finished(self, call: Hashable, task: asyncio.Future) -> None:
+        self._in_flight.pop(call, None)
+        if not task.cancelled():
+            task.exception()  # the error is raised to the callers, if any are still waiting
+
+    def _cache_page(self, call: Hashable, page: tuple) -> None:
+        now = self.clock()
+        if len(self._pages) >= self.cache_size:
+            self._pages = {k: v for k, v in self._pages.items() if v[0] > now}
+            while len(self._pages) >= self.cache_size:
+                del self._pages[next(iter(self._pages))]  # the oldest page
+        self._pages[call] = (now + self.cache_ttl, page)
+
+    # same as `listing`, within the rate limit, and shared with identical calls
+    async def listing(self, subs: List[str], name: str, limit: int,
+                      after: Optional[str] = None, timeout: Optional[float] = TIMEOUT) -> list:
+        call = ('listing', tuple(subs), name, limit, after)
+        cached = self._pages.get(call)
+        if cached is not None and cached[0] > self.clock():
+            self._save('cached')
+            return list(cached[1])
+        page = await self._shared(call, lambda: listing(self.reddit, subs, name, limit, after, timeout))
+        if self.cache_ttl > 0:
+            self._cache_page(call, tuple(page))
+        return page
+
+    async def hot(self, subs: List[str], limit: int, timeout: Optional[float] = TIMEOUT) -> list:
+        return await self.listing(subs, 'hot', limit, timeout=timeout)
+
+    # same as `search`, within the rate limit, and shared with identical calls
+    async def search(self, subs: List[str], query: str, timeout: Optional[float] = TIMEOUT, **kwargs) -> list:
+        call = ('search', tuple(subs), query, tuple(sorted(kwargs.items())))
+        return await self._shared(call, lambda: search(self.reddit, subs, query, timeout, **kwargs))
+
+    def __str__(self):
+        return f'{self.requests} requests made to Reddit, {self.saved} calls saved'
@@ -4,40 +4,494 @@
 # This probably could have been put in the main script, but
 # I think it's already too messy.
 import os
-from typing import Optional
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import asyncio
 import redis
 import logging
+import threading
+import time
+import metrics
+from bloom_filter import BloomFilter
+from circuit_breaker import OPEN, CircuitBreaker
 
 
-# Long-lived Redis client
-r = redis.from_url(os.environ['REDIS_URL'], decode_responses=True)
+# Number of connections kept in the client's pool. This is also the number
+# of worker threads that service the awaitable API below, so that every
+# in-flight command has a connection available without blocking on the pool.
+MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', '8'))
+# Seconds to wait for a connection to Redis to be made, and for a reply to a command.
+# Without them, a command sent while Redis is unreachable can hang for minutes.
+# The socket timeout has to be longer than the longest blocking read (see delivery.BLOCK)
+CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', '2'))
+SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', '5'))
+# Seconds after which a pooled connection that has been idle is checked with a PING before
+# it is used again. This is also how often `check_health` is run in the background
+HEALTH_CHECK_INTERVAL = int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', '30'))
+# Number of failed round trips in a row after which Redis is treated as down, and the
+# seconds until it is tried again (see CircuitBreaker)
+FAILURE_THRESHOLD = int(os.environ.get('REDIS_FAILURE_THRESHOLD', '5'))
+RESET_TIMEOUT = float(os.environ.get('REDIS_RESET_TIMEOUT', '30'))
+# Maximum number of posts kept in memory while Redis is down (see PendingPosts)
+FALLBACK_MAX_POSTS = int(os.environ.get('REDIS_FALLBACK_MAX_POSTS', '10000'))
+
+
+# creates the Redis client for REDIS_URL, backed by a connection pool that is
+# shared by the worker threads
+def connect() -> redis.Redis:
+    return redis.from_url(os.environ['REDIS_URL'], decode_responses=True, max_connections=MAX_CONNECTIONS,
+                          socket_connect_timeout=CONNECT_TIMEOUT, socket_timeout=SOCKET_TIMEOUT,
+                          socket_keepalive=True, health_check_interval=HEALTH_CHECK_INTERVAL)
+
+
+# Stands in for the Redis client, and only creates it when it's first used,
+# so that importing this module doesn't need REDIS_URL or set up a connection pool
+class LazyClient:
+    def __init__(self, create: Callable[[], redis.Redis]):
+        self._create = create
+        self._client = None
+        self._lock = threading.Lock()
+
+    # only called for attributes that aren't set on the stand in itself
+    def __getattr__(self, name: str):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._create()
+        return getattr(self._client, name)
+
+
+# Raised instead of making a round trip to Redis while the circuit breaker is open.
+# It is a ConnectionError, so it's handled wherever failing to reach Redis already is
+class RedisUnavailable(redis.ConnectionError):
+    pass
+
+
+# makes a round trip through the circuit breaker. Connection errors and timeouts
+# count as failures, and any reply from Redis (even an error reply) as a success
+def _guarded(breaker: CircuitBreaker, func, *args, **kwargs):
+    if not breaker.allow():
+        raise RedisUnavailable('Redis is unavailable, not trying again yet')
+    try:
+        result = func(*args, **kwargs)
+    except (redis.ConnectionError, redis.TimeoutError):
+        breaker.record_failure()
+        raise
+    except Exception:
+        breaker.record_success()
+        raise
+    breaker.record_success()
+    return result
+
+
+# makes the round trips of an iterator (such as `scan_iter`) through the circuit breaker
+def _guarded_iter(breaker: CircuitBreaker, iterator: Iterator) -> Iterator:
+    while True:
+        try:
+            item = _guarded(breaker, next, iterator)
+        except StopIteration:
+            return
+        yield item
+
+
+# Stands in for a pipeline, whose commands are only sent to Redis on `execute`
+class GuardedPipeline:
+    def __init__(self, pipeline, breaker: CircuitBreaker):
+        self._pipeline = pipeline
+        self._breaker = breaker
+
+    def __getattr__(self, name: str):
+        return getattr(self._pipeline, name)
+
+    def execute(self, *args, **kwargs):
+        return _guarded(self._breaker, self._pipeline.execute, *args, **kwargs)
+
+
+# Stands in for the Redis client, and sends every command through the circuit breaker,
+# so that while Redis is down, commands fail fast instead of waiting on a timeout
+class GuardedClient:
+    def __init__(self, client, breaker: CircuitBreaker):
+        self._client = client
+        self._breaker = breaker
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._client, name)
+        if name == 'pipeline':
+            return lambda *args, **kwargs: GuardedPipeline(attr(*args, **kwargs), self._breaker)
+        if name.endswith('_iter'):
+            return lambda *args, **kwargs: _guarded_iter(self._breaker, attr(*args, **kwargs))
+        if callable(attr):
+            return partial(_guarded, self._breaker, attr)
+        return attr
+
+
+# Dedicated executor for Redis round trips. The bot's coroutines await the
+# `*_async` functions, which run the blocking redis-py calls here instead of
+# on the Discord event loop.
+executor = ThreadPoolExecutor(max_workers=MAX_CONNECTIONS, thread_name_prefix='redis')
+
+operations_total = metrics.registry.counter('food_waifu_redis_operations_total',
+                                            'Operations run against Redis', ('operation', 'outcome'))
+operation_seconds = metrics.registry.histogram('food_waifu_redis_operation_seconds',
+                                               'Time taken by operations against Redis', ('operation',))
+circuit_open = metrics.registry.gauge('food_waifu_redis_circuit_open',
+                                      '1 while Redis is treated as down, and commands fail fast')
+pending_posts_count = metrics.registry.gauge('food_waifu_redis_pending_posts',
+                                             'Posts kept in memory until they can be written to Redis')
+
+# Opens once Redis keeps failing, so the bot stops waiting on it
+breaker = CircuitBreaker(FAILURE_THRESHOLD, RESET_TIMEOUT,
+                         on_change=lambda state: circuit_open.set(1 if state == OPEN else 0))
+# Long-lived Redis client, created on first use
+r = GuardedClient(LazyClient(connect), breaker)
+
+# Maximum number of commands sent in a single pipelined round trip.
+PIPELINE_CHUNK_SIZE = 100
+# Number of entries returned by each page of `!food keys`
+KEYS_PAGE_SIZE = 100
+
+# All of the bot's keys live under a versioned prefix, so that they don't
+# collide with anything else in the instance, and so the layout can change
+# without mixing old and new records.
+NAMESPACE = f"{os.environ.get('REDIS_KEY_PREFIX', 'food_waifu')}:v1"
+# Hash of post ID -> server that it was posted to ('all' for scheduled posts)
+POSTS_KEY = f'{NAMESPACE}:posts'
+# Sorted set of post ID -> time it was last posted (epoch seconds).
+# This is the record that deduplication checks against.
+POSTED_AT_KEY = f'{NAMESPACE}:posted_at'
+# Hash of guild ID -> ID of the channel that the bot posts to in that guild
+CHANNELS_KEY = f'{NAMESPACE}:channels'
+# Hash of guild ID -> start time (epoch seconds) of the last scheduled post slot that fired
+BROADCAST_SLOTS_KEY = f'{NAMESPACE}:broadcast_slots'
+# Hash of guild ID -> number of hours between scheduled posts, for guilds that changed the default
+BROADCAST_CADENCE_KEY = f'{NAMESPACE}:broadcast_cadence'
+# Hash of guild ID -> comma separated subreddits, for guilds that changed the default
+GUILD_SUBREDDITS_KEY = f'{NAMESPACE}:guild_subreddits'
+# Prefix of the claims on scheduled post slots, as <prefix><guild ID>:<slot start>.
+# Only the process that claims a guild's slot posts to it, so each slot fires once
+# even when several shard processes (or an old and a new deployment) see the guild
+SLOT_CLAIM_PREFIX = f'{NAMESPACE}:slot_claim:'
+# Prefix of the leases that decide which process selects the candidates for a broadcast
+LEASE_PREFIX = f'{NAMESPACE}:lease:'
+# Prefix of the candidates selected for a broadcast, which every shard process posts from
+SELECTION_PREFIX = f'{NAMESPACE}:broadcast_selection:'
+# Stream of the scheduled posts waiting to be sent, which the delivery workers read
+# through the DELIVERY_GROUP consumer group. Entries are removed once they are acknowledged
+DELIVERY_STREAM_KEY = f'{NAMESPACE}:deliveries'
+# Stream of the scheduled posts that couldn't be delivered, kept to be inspected
+DEAD_LETTER_STREAM_KEY = f'{NAMESPACE}:deliveries:dead'
+DELIVERY_GROUP = 'delivery'
+# Approximate number of entries that each stream is trimmed to, in case no workers are reading
+DELIVERY_STREAM_MAX_LEN = int(os.environ.get('DELIVERY_STREAM_MAX_LEN', '100000'))
+DEAD_LETTER_MAX_LEN = 10000
+# Prefix of the cached search results, which are shared between processes
+SEARCH_KEY_PREFIX = f'{NAMESPACE}:search:'
+# Prefix of the cached image URL checks, keyed by a hash of the URL.
+# The value is '1' if the URL is a valid image, and '0' if it isn't
+IMAGE_KEY_PREFIX = f'{NAMESPACE}:image:'
+# Set once the records from the flat, unprefixed layout have been migrated
+MIGRATED_KEY = f'{NAMESPACE}:migrated'
+# Stream of the post IDs that every process recorded, as one entry of comma separated IDs per write.
+# Each process reads it to keep its local filter in sync with the posts the other processes record
+RECORDED_POSTS_KEY = f'{NAMESPACE}:recorded_posts'
+# Keys and values of the flat layout's post records: a Reddit post ID (base 36) -> a server ID or 'all'.
+# Other keys in the database don't belong to the bot, and are left alone by the migration
+LEGACY_POST_ID_PATTERN = re.compile(r'^[0-9a-z]{1,13}$')
+LEGACY_SERVER_PATTERN = re.compile(r'^(all|[0-9]+)$')
+
+# Deduplication only looks back this many days, so a post can be posted again
+# once it is older than that. 0 means posts are never repeated.
+DEDUP_WINDOW = float(os.environ.get('DEDUP_WINDOW_DAYS', '30')) * 24 * 60 * 60
+# Deduplication only remembers this many of the most recent posts. 0 means no limit.
+DEDUP_MAX_POSTS = int(os.environ.get('DEDUP_MAX_POSTS', '100000'))
+# Maximum number of old posts removed from the history by a single write.
+# Trimming a few posts on every write keeps each write cheap, and keeps the
+# history close to its bounds.
+TRIM_BATCH_SIZE = 100
+# Approximate number of writes kept in the recorded posts stream. A process whose
+# filter falls further behind than this warms its filter again from scratch
+RECORDED_POSTS_MAXLEN = int(os.environ.get('DEDUP_SYNC_MAXLEN', '100000'))
+# Maximum number of stream entries read by a single round trip, when syncing the filter
+SYNC_BATCH_SIZE = 1000
+# Seconds that the filter may go without reading the posts that the other processes recorded.
+# Until then, lookups are answered by the filter without a round trip to Redis
+SYNC_INTERVAL = float(os.environ.get('DEDUP_SYNC_INTERVAL', '5'))
+
+# Source of the current time, in epoch seconds
+clock = time.time
+
+# Local Bloom filter of every post ID persisted to Redis. Once it has been warmed
+# with the posts that are already in Redis, a post ID that isn't in the filter is
+# known to be unused without looking it up. A post ID that is in the filter is
+# confirmed with Redis, since it might be a false positive. Other processes (shards,
+# or an overlapping deployment) record posts too, so the filter reads the posts they
+# recorded at least every SYNC_INTERVAL seconds (see sync_used_posts).
+used_posts = BloomFilter(int(os.environ.get('DEDUP_FILTER_CAPACITY', '1000000')))
+used_posts_warm = False
+# ID of the last entry of the recorded posts stream that has been read into the filter
+used_posts_synced_to = None
+# time.monotonic() of the last sync. The filter has every post that was recorded before then
+used_posts_synced_at = None
+# set when the stream was trimmed past that entry, so the filter has to be warmed again
+used_posts_behind = False
+_sync_lock = threading.Lock()
+# number of dedup lookups that the filter answered without a round trip to Redis,
+# and number of round trips that dedup lookups made (to sync the filter, or to look posts up)
+filter_stats = {'skipped': 0, 'checked': 0}
+
+
+# Posts that were recorded while Redis couldn't be written to. They are kept
+# in memory so that they still count as used, until `reconcile_pending_posts`
+# writes them to Redis. Holds at most `capacity` posts, and forgets the oldest
+# ones past that, so an outage that goes on for long can repeat a few old posts
+class PendingPosts:
+    # Attributes
+    # capacity - maximum number of posts kept
+    # dropped - number of posts that were forgotten, because there were more than `capacity`
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.dropped = 0
+        self._posts = OrderedDict()  # post ID -> (server, time posted), oldest first
+        # the posts are recorded and checked from several worker threads
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._posts)
+
+    # keeps the given post ID -> server, posted at `posted_at`
+    def add(self, records: Dict[str, str], posted_at: float) -> None:
+        with self._lock:
+            for post_id, server in records.items():
+                self._posts.pop(post_id, None)
+                self._posts[post_id] = (server, posted_at)
+            while len(self._posts) > self.capacity:
+                self._posts.popitem(last=False)
+                self.dropped += 1
+            pending_posts_count.set(len(self._posts))
+
+    # returns the time that the post was posted at, or None if it isn't pending
+    def posted_at(self, post_id: str) -> Optional[float]:
+        record = self._posts.get(post_id)
+        return record[1] if record is not None else None
+
+    # returns the pending post ID -> (server, time posted), oldest first
+    def items(self) -> List[Tuple[str, Tuple[str, float]]]:
+        with self._lock:
+            return list(self._posts.items())
+
+    # forgets the given posts, once they're written to Redis. A post that was
+    # recorded again in the meantime is kept, since that record wasn't written
+    def remove(self, records: Dict[str, Tuple[str, float]]) -> None:
+        with self._lock:
+            for post_id, record in records.items():
+                if self._posts.get(post_id) == record:
+                    del self._posts[post_id]
+            pending_posts_count.set(len(self._posts))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._posts.clear()
+            pending_posts_count.set(0)
+
+
+pending_posts = PendingPosts(FALLBACK_MAX_POSTS)
+
+
+# returns the oldest post time that still counts as used
+def _window_start(now: float) -> float:
+    return now - DEDUP_WINDOW if DEDUP_WINDOW > 0 else float('-inf')
+
+
+# returns True if a post time from the history still counts as used
+def _in_window(posted_at: Optional[float], now: float) -> bool:
+    return posted_at is not None and float(posted_at) >= _window_start(now)
 
 
 # store the post_id, and the server it's associated with
 def store_post_from_server(post_id: str, server: str, logger: Optional[logging.Logger] = None) -> bool:
-    res = r.set(post_id, server)
+    return store_posts({post_id: server}, logger)
+
+
+# store a batch of post_id -> server records in a single pipelined round trip,
+# and return True if every record was persisted. If Redis couldn't be written
+# to, the records are kept in memory until it can (see PendingPosts)
+def store_posts(records: Dict[str, str], logger: Optional[logging.Logger] = None) -> bool:
+    used_posts.update(records.keys())
+    now = clock()
+    try:
+        _write_posts({post_id: (server, now) for post_id, server in records.items()}, now)
+        res = True
+    except redis.RedisError:
+        pending_posts.add(records, now)
+        res = False
+    # a single record is logged per key, so it is only logged at DEBUG.
+    # the messages are formatted lazily, so they cost nothing when they are filtered out
     if logger is not None:
-        if res:
-            logger.info(f'Successfully persisted {post_id} -> {server} to Redis')
+        if len(records) == 1:
+            post_id, server = next(iter(records.items()))
+            if res:
+                logger.debug('Successfully persisted %s -> %s to Redis', post_id, server)
+            else:
+                logger.warn('Failed to persist %s -> %s to Redis', post_id, server)
+        elif res:
+            logger.info('Successfully persisted %d posts to Redis', len(records))
         else:
-            logger.warn(f'Failed to persist {post_id} -> {server} to Redis')
+            logger.warn('Failed to persist some of %d posts to Redis', len(records))
     return res
 
 
-# check if a key is already persisted in Redis
+# writes the given post_id -> (server, time posted) records, and trims the
+# history that they were added to. Raises a RedisError if they weren't written
+def _write_posts(records: Dict[str, Tuple[str, float]], now: float) -> None:
+    pipe = r.pipeline(transaction=True)
+    for post_id, (server, posted_at) in records.items():
+        pipe.hset(POSTS_KEY, post_id, server)
+        pipe.zadd(POSTED_AT_KEY, {post_id: posted_at})
+    pipe.xadd(RECORDED_POSTS_KEY, {'ids': ','.join(records)}, maxlen=RECORDED_POSTS_MAXLEN, approximate=True)
+    pipe.execute()
+    try:
+        _trim_history(now)
+    except redis.RedisError:
+        pass  # whatever wasn't trimmed is picked up by the next write
+
+
+# writes the posts that were kept in memory while Redis was down back to Redis,
+# with the times they were posted at. Returns the number of posts written.
+# Raises a RedisError if Redis still can't be written to
+def reconcile_pending_posts(logger: Optional[logging.Logger] = None) -> int:
+    pending = pending_posts.items()
+    for start in range(0, len(pending), PIPELINE_CHUNK_SIZE):
+        chunk = dict(pending[start:start + PIPELINE_CHUNK_SIZE])
+        _write_posts(chunk, clock())
+        pending_posts.remove(chunk)
+    if logger is not None and len(pending) > 0:
+        logger.info('Wrote %d posts that were recorded while Redis was down to Redis (%d were dropped)',
+                    len(pending), pending_posts.dropped)
+    return len(pending)
+
+
+# pings Redis, and once it answers, writes back the posts that were recorded while it was down.
+# While the circuit breaker is open, this is the trial call that finds out whether Redis is back.
+# Returns True if Redis is healthy
+def check_health(logger: Optional[logging.Logger] = None) -> bool:
+    try:
+        r.ping()
+        reconcile_pending_posts(logger)
+        if used_posts_behind:
+            warm_used_posts_filter(logger)
+        return True
+    except redis.RedisError as e:
+        if logger is not None:
+            logger.warn('Redis is unhealthy (%d posts kept in memory until it recovers): %r', len(pending_posts), e)
+        return False
+
+
+# check if a post is already persisted in Redis
 def post_already_used(post_id: str, logger: Optional[logging.Logger] = None) -> bool:
-    res = r.exists(post_id) > 0
+    # the filter only rules the post out if it has the posts that the other processes recorded
+    synced = _synced_recently()
+    if post_id not in used_posts and (synced or sync_used_posts()) and post_id not in used_posts:
+        if synced:
+            filter_stats['skipped'] += 1
+        res = False
+    else:
+        filter_stats['checked'] += 1
+        try:
+            res = _in_window(r.zscore(POSTED_AT_KEY, post_id), clock())
+        except redis.RedisError:
+            # the filter has every post this process recorded, even if it isn't warm
+            res = post_id in used_posts
+    res = res or _in_window(pending_posts.posted_at(post_id), clock())
     if logger is not None:
         if res:
-            logger.info(f'Found {post_id} already in Redis')
+            logger.debug('Found %s already in Redis', post_id)
         else:
-            logger.info(f'Key {post_id} not currently in Redis')
+            logger.debug('Key %s not currently in Redis', post_id)
     return res
 
 
-# delete all of the keys stored in Redis
+# check a batch of posts in as few round trips as possible, and return the
+# post IDs that are not persisted in Redis yet. The input order is preserved,
+# and repeated IDs are only checked (and returned) once.
+# If `before` is given, posts that were recorded at or after that time are also returned.
+def filter_unused_posts(post_ids: Iterable[str], logger: Optional[logging.Logger] = None,
+                        before: Optional[float] = None) -> List[str]:
+    start_time = time.perf_counter()
+    unique_ids = list(dict.fromkeys(post_ids))
+    to_check = _filter_possibly_used(unique_ids)
+    now = clock()
+    used = _find_used_in_redis(to_check, now, before, logger)
+    used.update(_find_used_in_pending(unique_ids, now, before))
+    unused = [p for p in unique_ids if p not in used]
+    # callers usually check several batches per sweep, and log their own summary of it
+    if logger is not None:
+        logger.debug('Checked %d posts, %d unused, %d looked up in Redis, %.0f ms', len(unique_ids), len(unused),
+                     len(to_check), (time.perf_counter() - start_time) * 1000)
+    return unused
+
+
+# returns the post IDs that the local filter can't rule out, which are the
+# only ones that need to be checked in Redis
+def _filter_possibly_used(post_ids: List[str]) -> List[str]:
+    synced = _synced_recently()
+    if all(p in used_posts for p in post_ids) or not (synced or sync_used_posts()):
+        return post_ids
+    to_check = [p for p in post_ids if p in used_posts]
+    if synced and len(to_check) < 1:
+        filter_stats['skipped'] += 1
+    return to_check
+
+
+# returns the given post IDs that were recorded in Redis within the dedup window (and before `before`)
+def _find_used_in_redis(post_ids: List[str], now: float, before: Optional[float],
+                        logger: Optional[logging.Logger]) -> Set[str]:
+    used = set()
+    try:
+        for start in range(0, len(post_ids), PIPELINE_CHUNK_SIZE):
+            chunk = post_ids[start:start + PIPELINE_CHUNK_SIZE]
+            pipe = r.pipeline(transaction=False)
+            for post_id in chunk:
+                pipe.zscore(POSTED_AT_KEY, post_id)
+            filter_stats['checked'] += 1
+            for post_id, posted_at in zip(chunk, pipe.execute()):
+                if _in_window(posted_at, now) and (before is None or float(posted_at) < before):
+                    used.add(post_id)
+    except redis.RedisError as e:
+        # fall back to the filter, which has every post this process recorded, and every post in
+        # Redis if it's warm. A false positive only skips a post that could have been used
+        used = {p for p in post_ids if p in used_posts}
+        if logger is not None:
+            logger.warn('Checked %d posts against the local records, since Redis is unavailable: %r',
+                        len(post_ids), e)
+    return used
+
+
+# returns the given post IDs that were recorded while Redis was down, within the dedup window (and before `before`)
+def _find_used_in_pending(post_ids: List[str], now: float, before: Optional[float]) -> Set[str]:
+    if len(pending_posts) < 1:
+        return set()
+    used = set()
+    for post_id in post_ids:
+        posted_at = pending_posts.posted_at(post_id)
+        if _in_window(posted_at, now) and (before is None or posted_at < before):
+            used.add(post_id)
+    return used
+
+
+# delete all of the post records used for deduplication. The keys are removed
+# with UNLINK, so Redis frees the memory in the background instead of blocking
+# other clients, and nothing outside of the post records is touched.
 def flush_all_records(logger: Optional[logging.Logger] = None) -> bool:
-    res = r.flushall(asynchronous=False)
+    try:
+        r.unlink(POSTS_KEY, POSTED_AT_KEY)
+        used_posts.clear()
+        pending_posts.clear()
+        res = True
+    except redis.RedisError:
+        res = False
     if logger is not None:
         if res:
             logger.info('Successfully flushed all keys in Redis')
@@ -46,19 +500,551 @@ def flush_all_records(logger: Optional[logging.Logger] = None) -> bool:
     return res
 
 
-# for debugging purposes only, print all of the existing
-# keys stored in Redis
-def enumerate_keys(logger: logging.Logger) -> bool:
+# removes up to TRIM_BATCH_SIZE posts that fell out of the dedup window, or
+# past the maximum number of posts, from the global history and the posts hash
+def _trim_history(now: float) -> None:
+    pipe = r.pipeline(transaction=False)
+    if DEDUP_WINDOW > 0:
+        pipe.zrangebyscore(POSTED_AT_KEY, '-inf', f'({_window_start(now)}', start=0, num=TRIM_BATCH_SIZE)
+    pipe.zcard(POSTED_AT_KEY)
+    results = pipe.execute()
+    expired = results[0] if DEDUP_WINDOW > 0 else []
+    size = results[-1]
+    overflow = []
+    if DEDUP_MAX_POSTS > 0 and size - len(expired) > DEDUP_MAX_POSTS:
+        # the oldest posts are first, so skip over the ones that already expired
+        extra = min(size - len(expired) - DEDUP_MAX_POSTS, TRIM_BATCH_SIZE)
+        overflow = r.zrange(POSTED_AT_KEY, len(expired), len(expired) + extra - 1)
+    stale = list(expired) + list(overflow)
+    if len(stale) > 0:
+        pipe = r.pipeline(transaction=True)
+        pipe.zrem(POSTED_AT_KEY, *stale)
+        pipe.hdel(POSTS_KEY, *stale)
+        pipe.execute()
+
+
+# one-shot migration of the records from before the keys were namespaced,
+# where every post was a top level post_id -> server string key. Moves them
+# into the new layout, then removes them. Returns the number of posts migrated.
+# Only string keys that look like those records are touched. Raises a RedisError
+# if the records can't be written, and leaves them in place to migrate on the next start
+def migrate_flat_keys(logger: Optional[logging.Logger] = None) -> int:
+    if r.exists(MIGRATED_KEY):
+        return 0  # already migrated
+    migrated = 0
+    batch = []
+    for key in r.scan_iter(count=1000):
+        if LEGACY_POST_ID_PATTERN.match(key) is None:
+            continue
+        batch.append(key)
+        if len(batch) >= PIPELINE_CHUNK_SIZE:
+            migrated += _migrate_batch(batch)
+            batch = []
+    if len(batch) > 0:
+        migrated += _migrate_batch(batch)
+    r.set(MIGRATED_KEY, 1)
+    if logger is not None:
+        logger.info(f'Migrated {migrated} posts to the {NAMESPACE} keyspace')
+    return migrated
+
+
+def _migrate_batch(keys: List[str]) -> int:
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.type(key)
+        pipe.get(key)
+    results = pipe.execute()
+    # anything that isn't a string key of a server wasn't written by the flat layout
+    records = {key: value for key, key_type, value in zip(keys, results[::2], results[1::2])
+               if key_type == 'string' and value is not None and LEGACY_SERVER_PATTERN.match(value) is not None}
+    if len(records) > 0:
+        # the old keys are only removed once their records are written
+        now = clock()
+        _write_posts({post_id: (server, now) for post_id, server in records.items()}, now)
+        used_posts.update(records.keys())
+        r.unlink(*records.keys())
+    return len(records)
+
+
+# returns the ID of the last entry of the recorded posts stream. If the stream is
+# empty, an empty entry is added, so that there is an entry to read on from
+def _recorded_posts_position() -> str:
+    last = r.xrevrange(RECORDED_POSTS_KEY, '+', '-', count=1)
+    if len(last) > 0:
+        return last[0][0]
+    return r.xadd(RECORDED_POSTS_KEY, {'ids': ''}, maxlen=RECORDED_POSTS_MAXLEN, approximate=True)
+
+
+# stream entry IDs are <milliseconds>-<sequence number>
+def _entry_order(entry_id: str) -> Tuple[int, int]:
+    ms, sequence = entry_id.split('-')
+    return int(ms), int(sequence)
+
+
+# returns True if the filter is warm, and was synced within the last SYNC_INTERVAL seconds
+def _synced_recently() -> bool:
+    synced_at = used_posts_synced_at
+    return used_posts_warm and synced_at is not None and time.monotonic() - synced_at < SYNC_INTERVAL
+
+
+# reads the posts that every process recorded since the filter was last synced into the filter,
+# unless it was synced within the last SYNC_INTERVAL seconds.
+# returns True if the filter has every post recorded up to then, so that a post ID it doesn't have is unused.
+# returns False if the filter isn't warm, Redis can't be read, or the filter fell so far
+# behind that the stream was trimmed past it. It's then warmed again by `check_health`
+def sync_used_posts() -> bool:
+    global used_posts_warm, used_posts_synced_to, used_posts_synced_at, used_posts_behind
+    if not used_posts_warm:
+        return False
+    with _sync_lock:
+        if _synced_recently():
+            return True  # another thread synced it while this one waited
+        started = time.monotonic()
+        try:
+            while True:
+                pipe = r.pipeline(transaction=False)
+                pipe.xrange(RECORDED_POSTS_KEY, '-', '+', count=1)
+                pipe.xread({RECORDED_POSTS_KEY: used_posts_synced_to}, count=SYNC_BATCH_SIZE)
+                filter_stats['checked'] += 1
+                first, new = pipe.execute()
+                if len(first) < 1 or _entry_order(first[0][0]) > _entry_order(used_posts_synced_to):
+                    # the entries after the filter's position may have been trimmed before they were read
+                    used_posts_warm = False
+                    used_posts_behind = True
+                    return False
+                entries = new[0][1] if len(new) > 0 else []
+                for entry_id, fields in entries:
+                    if fields.get('ids'):
+                        used_posts.update(fields['ids'].split(','))
+                    used_posts_synced_to = entry_id
+                if len(entries) < SYNC_BATCH_SIZE:
+                    used_posts_synced_at = started
+                    return True
+        except redis.RedisError:
+            return False
+
+
+# load every post that is currently in Redis into the local filter, so that
+# lookups for post IDs that aren't in it can skip Redis from then on.
+# uses HSCAN, so that Redis isn't blocked while the posts are enumerated
+def warm_used_posts_filter(logger: Optional[logging.Logger] = None) -> int:
+    global used_posts_warm, used_posts_synced_to, used_posts_synced_at, used_posts_behind
+    # the posts that are recorded while the hash is scanned are read from the stream by the next sync
+    started = time.monotonic()
+    position = _recorded_posts_position()
+    count = 0
+    for post_id, _ in r.hscan_iter(POSTS_KEY, count=1000):
+        used_posts.add(post_id)
+        count += 1
+    with _sync_lock:
+        used_posts_synced_to = position
+        used_posts_synced_at = started
+        used_posts_behind = False
+        used_posts_warm = True
+    if logger is not None:
+        logger.info(f'Loaded {count} keys into the dedup filter '
+                    f'({used_posts.memory_bytes} bytes, {used_posts.false_positive_rate:.4%} false positive rate)')
+    return count
+
+
+# get the persisted posting channel for a guild, if there is one
+def get_posting_channel(guild_id: int) -> Optional[int]:
+    res = r.hget(CHANNELS_KEY, guild_id)
+    return int(res) if res is not None else None
+
+
+# persist the channel that the bot posts to in a guild
+def store_posting_channel(guild_id: int, channel_id: int) -> None:
+    r.hset(CHANNELS_KEY, guild_id, channel_id)
+
+
+# forget the persisted posting channel for a guild
+def delete_posting_channel(guild_id: int) -> None:
+    r.hdel(CHANNELS_KEY, guild_id)
+
+
+# get the start of the last scheduled post slot that fired for each of the guilds.
+# guilds that never had a scheduled post are left out
+def get_broadcast_slots(guild_ids: List[int]) -> Dict[int, float]:
+    if len(guild_ids) < 1:
+        return {}
+    values = r.hmget(BROADCAST_SLOTS_KEY, guild_ids)
+    return {g: float(v) for g, v in zip(guild_ids, values) if v is not None}
+
+
+# persist the start of the last scheduled post slot that fired for each guild
+def store_broadcast_slots(slots: Dict[int, float]) -> None:
+    if len(slots) > 0:
+        r.hset(BROADCAST_SLOTS_KEY, mapping=slots)
+
+
+# claim the given guild ID -> slot start for `owner`, and return the guilds whose
+# slot `owner` holds. A slot that another process already claimed is left out,
+# and a slot that `owner` claimed before is kept, so a failed broadcast can be retried.
+# The claims expire after `ttl` seconds, which should outlast the slot
+def claim_broadcast_slots(slots: Dict[int, float], owner: str, ttl: float) -> List[int]:
+    if len(slots) < 1:
+        return []
+    guild_ids = list(slots)
+    pipe = r.pipeline(transaction=False)
+    for guild_id in guild_ids:
+        key = f'{SLOT_CLAIM_PREFIX}{guild_id}:{int(slots[guild_id])}'
+        pipe.set(key, owner, nx=True, ex=max(1, int(ttl)))
+        pipe.get(key)
+    holders = pipe.execute()[1::2]
+    return [g for g, holder in zip(guild_ids, holders) if holder == owner]
+
+
+# take the named lease for `owner`, if nobody holds it. Returns True if the
+# lease was taken. Leases aren't released, they expire after `ttl` seconds
+def acquire_lease(name: str, owner: str, ttl: float) -> bool:
+    return bool(r.set(LEASE_PREFIX + name, owner, nx=True, ex=max(1, int(ttl))))
+
+
+# get the candidates selected for a broadcast, if they were published yet
+def get_broadcast_selection(key: str) -> Optional[str]:
+    return r.get(SELECTION_PREFIX + key)
+
+
+# publish the candidates selected for a broadcast, for `ttl` seconds
+def store_broadcast_selection(key: str, payload: str, ttl: float) -> None:
+    r.set(SELECTION_PREFIX + key, payload, ex=max(1, int(ttl)))
+
+
+# add the given jobs to the end of the delivery stream, in one round trip
+def enqueue_deliveries(jobs: List[Dict[str, str]]) -> None:
+    if len(jobs) < 1:
+        return
+    pipe = r.pipeline(transaction=False)
+    for job in jobs:
+        pipe.xadd(DELIVERY_STREAM_KEY, job, maxlen=DELIVERY_STREAM_MAX_LEN, approximate=True)
+    pipe.execute()
+
+
+# create the consumer group that the delivery workers read through, along with
+# the stream. The group starts from the beginning of the stream, so jobs that
+# were queued before it existed are delivered too. Does nothing if it exists
+def create_delivery_group() -> None:
     try:
-        res = r.keys()
-        logger.info(', '.join(res))
-        return True
+        r.xgroup_create(DELIVERY_STREAM_KEY, DELIVERY_GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+# read up to `count` jobs that haven't been given to any worker yet, as
+# (entry ID, job). They are pending for `consumer` until they are acknowledged.
+# Waits up to `block` seconds for a job to arrive, or returns right away if it's 0
+def read_deliveries(consumer: str, count: int, block: float = 0) -> List[Tuple[str, Dict[str, str]]]:
+    response = r.xreadgroup(DELIVERY_GROUP, consumer, {DELIVERY_STREAM_KEY: '>'}, count=count,
+                            block=int(block * 1000) if block > 0 else None)
+    if not response:
+        return []
+    return [(entry_id, fields) for entry_id, fields in response[0][1]]
+
+
+# take over up to `count` jobs that were given to a worker at least `min_idle`
+# seconds ago, and never acknowledged, because the worker failed to send them
+# or died. Returns (entry ID, job, number of times the job was given to a worker)
+def claim_stale_deliveries(consumer: str, min_idle: float, count: int) -> List[Tuple[str, Dict[str, str], int]]:
+    min_idle_ms = int(min_idle * 1000)
+    pending = r.xpending_range(DELIVERY_STREAM_KEY, DELIVERY_GROUP, '-', '+', count)
+    stale = {p['message_id']: p['times_delivered'] for p in pending if p['time_since_delivered'] >= min_idle_ms}
+    if len(stale) < 1:
+        return []
+    claimed = r.xclaim(DELIVERY_STREAM_KEY, DELIVERY_GROUP, consumer, min_idle_ms, list(stale))
+    # jobs that were deleted from the stream come back without their fields. They are acknowledged,
+    # or they would stay pending, and be claimed again on every pass
+    deleted = [entry_id for entry_id, fields in claimed if fields is None]
+    if len(deleted) > 0:
+        r.xack(DELIVERY_STREAM_KEY, DELIVERY_GROUP, *deleted)
+    # claiming a job counts as giving it to a worker again
+    return [(entry_id, fields, stale[entry_id] + 1) for entry_id, fields in claimed if fields is not None]
+
+
+# acknowledge the given jobs, and remove them from the stream
+def ack_deliveries(entry_ids: List[str]) -> None:
+    if len(entry_ids) < 1:
+        return
+    pipe = r.pipeline(transaction=False)
+    pipe.xack(DELIVERY_STREAM_KEY, DELIVERY_GROUP, *entry_ids)
+    pipe.xdel(DELIVERY_STREAM_KEY, *entry_ids)
+    pipe.execute()
+
+
+# move the given entry ID -> job to the dead letter stream, and acknowledge them
+def dead_letter_deliveries(jobs: Dict[str, Dict[str, str]]) -> None:
+    if len(jobs) < 1:
+        return
+    pipe = r.pipeline(transaction=False)
+    for job in jobs.values():
+        pipe.xadd(DEAD_LETTER_STREAM_KEY, job, maxlen=DEAD_LETTER_MAX_LEN, approximate=True)
+    pipe.xack(DELIVERY_STREAM_KEY, DELIVERY_GROUP, *jobs)
+    pipe.xdel(DELIVERY_STREAM_KEY, *jobs)
+    pipe.execute()
+
+
+# get the configured number of hours between scheduled posts for each of the guilds.
+# guilds that use the default cadence are left out
+def get_broadcast_cadences(guild_ids: List[int]) -> Dict[int, int]:
+    if len(guild_ids) < 1:
+        return {}
+    values = r.hmget(BROADCAST_CADENCE_KEY, guild_ids)
+    return {g: int(v) for g, v in zip(guild_ids, values) if v is not None}
+
+
+# persist the number of hours between scheduled posts for a guild
+def store_broadcast_cadence(guild_id: int, hours: int) -> None:
+    r.hset(BROADCAST_CADENCE_KEY, guild_id, hours)
+
+
+# get the configured subreddits for each of the guilds.
+# guilds that use the default subreddits are left out
+def get_guild_subreddits(guild_ids: List[int]) -> Dict[int, List[str]]:
+    if len(guild_ids) < 1:
+        return {}
+    values = r.hmget(GUILD_SUBREDDITS_KEY, guild_ids)
+    return {g: v.split(',') for g, v in zip(guild_ids, values) if v is not None}
+
+
+# persist the subreddits that a guild gets its posts from
+def store_guild_subreddits(guild_id: int, subs: List[str]) -> None:
+    r.hset(GUILD_SUBREDDITS_KEY, guild_id, ','.join(subs))
+
+
+# forget the configured subreddits for a guild, so it uses the default again
+def delete_guild_subreddits(guild_id: int) -> None:
+    r.hdel(GUILD_SUBREDDITS_KEY, guild_id)
+
+
+# get the cached results of a search, if they haven't expired yet
+def get_search_results(key: str) -> Optional[str]:
+    return r.get(SEARCH_KEY_PREFIX + key)
+
+
+# cache the results of a search, for `ttl` seconds
+def store_search_results(key: str, payload: str, ttl: float) -> None:
+    r.set(SEARCH_KEY_PREFIX + key, payload, ex=max(1, int(ttl)))
+
+
+# get the cached image checks for the given keys. Keys that haven't been
+# checked (or whose check expired) are left out
+def get_image_checks(keys: List[str]) -> Dict[str, bool]:
+    if len(keys) < 1:
+        return {}
+    values = r.mget([IMAGE_KEY_PREFIX + key for key in keys])
+    return {key: value == '1' for key, value in zip(keys, values) if value is not None}
+
+
+# cache the results of image checks, valid ones for `positive_ttl` seconds and
+# invalid ones for `negative_ttl` seconds, in one round trip
+def store_image_checks(results: Dict[str, bool], positive_ttl: float, negative_ttl: float) -> None:
+    if len(results) < 1:
+        return
+    pipe = r.pipeline(transaction=False)
+    for key, valid in results.items():
+        ttl = positive_ttl if valid else negative_ttl
+        pipe.set(IMAGE_KEY_PREFIX + key, '1' if valid else '0', ex=max(1, int(ttl)))
+    pipe.execute()
+
+
+# for debugging purposes only, print one page of the post IDs stored in
+# Redis, starting at the given cursor. Returns the cursor of the next page
+# (0 once the last page has been printed), or None if an error occurred.
+def enumerate_keys_page(logger: logging.Logger, cursor: int = 0, count: int = KEYS_PAGE_SIZE) -> Optional[int]:
+    try:
+        cursor, page = r.hscan(POSTS_KEY, cursor, count=count)
+        logger.info(', '.join(page.keys()))
+        return cursor
     except Exception as e:
         logger.error(repr(e))
-        return False
+        return None
+
+
+# for debugging purposes only, print all of the post IDs stored in
+# Redis, one page per log line
+def enumerate_keys(logger: logging.Logger) -> bool:
+    cursor = 0
+    while True:
+        cursor = enumerate_keys_page(logger, cursor)
+        if cursor is None:
+            return False
+        if cursor == 0:
+            return True
 
 
 # for debugging purposes only, get the server associated
 # with a Reddit submission ID
 def get_value(post_id: str) -> Optional[str]:
-    return r.get(post_id)
+    return r.hget(POSTS_KEY, post_id)
+
+
+# runs one of the synchronous functions above, and records its latency and outcome
+def _measured(func, *args):
+    outcome = 'error'
+    try:
+        with operation_seconds.time(operation=func.__name__):
+            result = func(*args)
+        outcome = 'ok'
+        return result
+    except RedisUnavailable:
+        outcome = 'unavailable'
+        raise
+    finally:
+        operations_total.inc(operation=func.__name__, outcome=outcome)
+
+
+# runs one of the synchronous functions above on the Redis executor, so the
+# calling coroutine yields to the event loop while the round trip is in flight
+async def _run_in_executor(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(_measured, func, *args))
+
+
+# Awaitable versions of the functions above. These have the same semantics as
+# their synchronous counterparts, and are what the bot should call from coroutines.
+async def store_post_from_server_async(post_id: str, server: str, logger: Optional[logging.Logger] = None) -> bool:
+    return await _run_in_executor(store_post_from_server, post_id, server, logger)
+
+
+async def store_posts_async(records: Dict[str, str], logger: Optional[logging.Logger] = None) -> bool:
+    return await _run_in_executor(store_posts, records, logger)
+
+
+async def post_already_used_async(post_id: str, logger: Optional[logging.Logger] = None) -> bool:
+    return await _run_in_executor(post_already_used, post_id, logger)
+
+
+async def filter_unused_posts_async(post_ids: Iterable[str], logger: Optional[logging.Logger] = None,
+                                    before: Optional[float] = None) -> List[str]:
+    return await _run_in_executor(filter_unused_posts, list(post_ids), logger, before)
+
+
+async def reconcile_pending_posts_async(logger: Optional[logging.Logger] = None) -> int:
+    return await _run_in_executor(reconcile_pending_posts, logger)
+
+
+async def check_health_async(logger: Optional[logging.Logger] = None) -> bool:
+    return await _run_in_executor(check_health, logger)
+
+
+async def migrate_flat_keys_async(logger: Optional[logging.Logger] = None) -> int:
+    return await _run_in_executor(migrate_flat_keys, logger)
+
+
+async def warm_used_posts_filter_async(logger: Optional[logging.Logger] = None) -> int:
+    return await _run_in_executor(warm_used_posts_filter, logger)
+
+
+async def flush_all_records_async(logger: Optional[logging.Logger] = None) -> bool:
+    return await _run_in_executor(flush_all_records, logger)
+
+
+async def enumerate_keys_async(logger: logging.Logger) -> bool:
+    return await _run_in_executor(enumerate_keys, logger)
+
+
+async def enumerate_keys_page_async(logger: logging.Logger, cursor: int = 0,
+                                    count: int = KEYS_PAGE_SIZE) -> Optional[int]:
+    return await _run_in_executor(enumerate_keys_page, logger, cursor, count)
+
+
+async def get_value_async(post_id: str) -> Optional[str]:
+    return await _run_in_executor(get_value, post_id)
+
+
+async def get_posting_channel_async(guild_id: int) -> Optional[int]:
+    return await _run_in_executor(get_posting_channel, guild_id)
+
+
+async def store_posting_channel_async(guild_id: int, channel_id: int) -> None:
+    await _run_in_executor(store_posting_channel, guild_id, channel_id)
+
+
+async def delete_posting_channel_async(guild_id: int) -> None:
+    await _run_in_executor(delete_posting_channel, guild_id)
+
+
+async def get_broadcast_slots_async(guild_ids: List[int]) -> Dict[int, float]:
+    return await _run_in_executor(get_broadcast_slots, guild_ids)
+
+
+async def store_broadcast_slots_async(slots: Dict[int, float]) -> None:
+    await _run_in_executor(store_broadcast_slots, slots)
+
+
+async def claim_broadcast_slots_async(slots: Dict[int, float], owner: str, ttl: float) -> List[int]:
+    return await _run_in_executor(claim_broadcast_slots, slots, owner, ttl)
+
+
+async def acquire_lease_async(name: str, owner: str, ttl: float) -> bool:
+    return await _run_in_executor(acquire_lease, name, owner, ttl)
+
+
+async def get_broadcast_selection_async(key: str) -> Optional[str]:
+    return await _run_in_executor(get_broadcast_selection, key)
+
+
+async def store_broadcast_selection_async(key: str, payload: str, ttl: float) -> None:
+    await _run_in_executor(store_broadcast_selection, key, payload, ttl)
+
+
+async def enqueue_deliveries_async(jobs: List[Dict[str, str]]) -> None:
+    await _run_in_executor(enqueue_deliveries, jobs)
+
+
+async def create_delivery_group_async() -> None:
+    await _run_in_executor(create_delivery_group)
+
+
+async def read_deliveries_async(consumer: str, count: int, block: float = 0) -> List[Tuple[str, Dict[str, str]]]:
+    return await _run_in_executor(read_deliveries, consumer, count, block)
+
+
+async def claim_stale_deliveries_async(consumer: str, min_idle: float,
+                                       count: int) -> List[Tuple[str, Dict[str, str], int]]:
+    return await _run_in_executor(claim_stale_deliveries, consumer, min_idle, count)
+
+
+async def ack_deliveries_async(entry_ids: List[str]) -> None:
+    await _run_in_executor(ack_deliveries, entry_ids)
+
+
+async def dead_letter_deliveries_async(jobs: Dict[str, Dict[str, str]]) -> None:
+    await _run_in_executor(dead_letter_deliveries, jobs)
+
+
+async def get_broadcast_cadences_async(guild_ids: List[int]) -> Dict[int, int]:
+    return await _run_in_executor(get_broadcast_cadences, guild_ids)
+
+
+async def store_broadcast_cadence_async(guild_id: int, hours: int) -> None:
+    await _run_in_executor(store_broadcast_cadence, guild_id, hours)
+
+
+async def get_guild_subreddits_async(guild_ids: List[int]) -> Dict[int, List[str]]:
+    return await _run_in_executor(get_guild_subreddits, guild_ids)
+
+
+async def store_guild_subreddits_async(guild_id: int, subs: List[str]) -> None:
+    await _run_in_executor(store_guild_subreddits, guild_id, subs)
+
+
+async def delete_guild_subreddits_async(guild_id: int) -> None:
+    await _run_in_executor(delete_guild_subreddits, guild_id)
+
+
+async def get_search_results_async(key: str) -> Optional[str]:
+    return await _run_in_executor(get_search_results, key)
+
+
+async def store_search_results_async(key: str, payload: str, ttl: float) -> None:
+    await _run_in_executor(store_search_results, key, payload, ttl)
+
+
+async def get_image_checks_async(keys: List[str]) -> Dict[str, bool]:
+    return await _run_in_executor(get_image_checks, keys)
+
+
+async def store_image_checks_async(results: Dict[str, bool], positive_ttl: float, negative_ttl: float) -> None:
+    await _run_in_executor(store_image_checks, results, positive_ttl, negative_ttl)
@@ -0,0 +1,169 @@
+# Decides when each guild gets its scheduled post.
+# Each guild posts once per slot, where a slot is its cadence (every N hours)
+# long. Slots are aligned to the hour in UTC, plus a per-guild offset that
+# spreads guilds over a window past the hour, so that the bot doesn't post to
+# every guild at :00. Guilds with the same offset share a bucket, and are
+# posted to together.
+# The start of the last slot that fired for each guild is persisted, so a
+# restart neither posts twice in the same slot, nor skips a slot that came
+# due while the bot was down (it is posted late, once).
+# When the bot runs as several shard processes, slots are also claimed in
+# Redis before they are posted, so that only one process posts each guild's slot.
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+from zlib import crc32
+import asyncio
+import logging
+import os
+import time
+
+
+SECONDS_PER_HOUR = 3600
+# Default number of hours between scheduled posts to a guild
+DEFAULT_CADENCE = int(os.environ.get('BROADCAST_CADENCE_HOURS', '1'))
+# Number of seconds past the hour that guild posts are spread over
+SPREAD_WINDOW = float(os.environ.get('BROADCAST_SPREAD_SECONDS', '300'))
+# Number of distinct offsets within the window. Guilds in the same bucket are
+# posted to together, so this bounds the number of broadcasts per hour.
+SPREAD_BUCKETS = int(os.environ.get('BROADCAST_SPREAD_BUCKETS', '10'))
+
+
+class BroadcastScheduler:
+    # Attributes
+    # load_slots - coroutine function that takes guild IDs, and returns guild ID -> start of the last slot fired
+    # save_slots - coroutine function that takes guild ID -> slot start, and persists them
+    # load_cadences - coroutine function that takes guild IDs, and returns guild ID -> cadence in hours,
+    #                 for the guilds that have one configured
+    # save_cadence - coroutine function that takes a guild ID and a cadence in hours, and persists them
+    # claim_slots - optional coroutine function that takes guild ID -> slot start and a TTL in seconds,
+    #               claims the slots, and returns the guilds whose slots this process holds.
+    #               Without it, every due slot is posted by this process
+    # max_sleep - upper bound on a single sleep, so new guilds and clock changes are picked up
+    def __init__(self,
+                 load_slots: Callable[[List[int]], Awaitable[Dict[int, float]]],
+                 save_slots: Callable[[Dict[int, float]], Awaitable],
+                 load_cadences: Callable[[List[int]], Awaitable[Dict[int, int]]],
+                 save_cadence: Callable[[int, int], Awaitable],
+                 claim_slots: Optional[Callable[[Dict[int, float], float], Awaitable[List[int]]]] = None,
+                 window: float = SPREAD_WINDOW,
+                 buckets: int = SPREAD_BUCKETS,
+                 default_cadence: int = DEFAULT_CADENCE,
+                 max_sleep: float = 300,
+                 logger: Optional[logging.Logger] = None,
+                 clock: Callable[[], float] = time.time):
+        self.load_slots = load_slots
+        self.save_slots = save_slots
+        self.load_cadences = load_cadences
+        self.save_cadence = save_cadence
+        self.claim_slots = claim_slots
+        self.window = window
+        self.buckets = max(1, buckets)
+        self.default_cadence = default_cadence
+        self.max_sleep = max_sleep
+        self.logger = logger
+        self.clock = clock
+        self._last_fired = {}  # guild ID -> start of the last slot that fired
+        self._cadences = {}  # guild ID -> hours between posts
+
+    # returns the number of seconds past the hour that the guild's slots start.
+    # this only depends on the guild ID, so it is the same across restarts
+    def offset(self, guild_id: int) -> float:
+        bucket = crc32(str(guild_id).encode('utf-8')) % self.buckets
+        return bucket * self.window / self.buckets
+
+    def cadence(self, guild_id: int) -> int:
+        return self._cadences.get(guild_id, self.default_cadence)
+
+    # returns the start time of the guild's slot that contains `now`
+    def slot_start(self, guild_id: int, now: float) -> float:
+        period = self.cadence(guild_id) * SECONDS_PER_HOUR
+        offset = self.offset(guild_id)
+        return (now - offset) // period * period + offset
+
+    # returns the time that the guild's next slot starts after `now`
+    def next_deadline(self, guild_id: int, now: float) -> float:
+        return self.slot_start(guild_id, now) + self.cadence(guild_id) * SECONDS_PER_HOUR
+
+    # loads the persisted state of the guilds that haven't been seen yet.
+    # a guild without a persisted slot is treated as if its current slot already
+    # fired, so it gets its first post at its next deadline instead of right away
+    async def _load(self, guild_ids: List[int]) -> None:
+        unknown = [g for g in guild_ids if g not in self._last_fired]
+        if len(unknown) < 1:
+            return
+        self._cadences.update(await self.load_cadences(unknown))
+        slots = await self.load_slots(unknown)
+        now = self.clock()
+        new_slots = {}
+        for guild_id in unknown:
+            if guild_id in slots:
+                self._last_fired[guild_id] = slots[guild_id]
+            else:
+                new_slots[guild_id] = self.slot_start(guild_id, now)
+        if len(new_slots) > 0:
+            self._last_fired.update(new_slots)
+            await self.save_slots(new_slots)
+
+    # returns the guilds whose current slot hasn't fired yet
+    async def due_guilds(self, guild_ids: Iterable[int]) -> List[int]:
+        guild_ids = list(guild_ids)
+        await self._load(guild_ids)
+        now = self.clock()
+        return [g for g in guild_ids if self.slot_start(g, now) > self._last_fired[g]]
+
+    # returns the guilds whose current slot this process should post to, which
+    # is all of them unless the slots are claimed. Guilds whose slot another
+    # process claimed are left out of the result, and are treated as fired here.
+    # The claimed slots only fire once `mark_fired` is called after their posts
+    # are queued, so a broadcast that fails part way through is retried
+    async def claim(self, guild_ids: Iterable[int]) -> List[int]:
+        now = self.clock()
+        slots = {g: self.slot_start(g, now) for g in guild_ids}
+        if self.claim_slots is None or len(slots) < 1:
+            return list(slots)
+        # the claims only need to outlast the slots they are for
+        ttl = 2 * max(self.cadence(g) for g in slots) * SECONDS_PER_HOUR
+        claimed = await self.claim_slots(slots, ttl)
+        self._last_fired.update({g: start for g, start in slots.items() if g not in claimed})
+        return claimed
+
+    # records that the given guilds' current slots fired, and persists them, so
+    # that a restart doesn't post the same slot twice
+    async def mark_fired(self, guild_ids: Iterable[int]) -> None:
+        now = self.clock()
+        slots = {g: self.slot_start(g, now) for g in guild_ids}
+        self._last_fired.update(slots)
+        if len(slots) > 0:
+            await self.save_slots(slots)
+
+    # identifies the broadcast that the guild's current slot belongs to. Guilds
+    # in the same bucket share it regardless of their cadence, so every process
+    # that posts to the bucket's guilds within the hour agrees on it
+    def broadcast_key(self, guild_id: int) -> str:
+        offset = self.offset(guild_id)
+        return str(int((self.clock() - offset) // SECONDS_PER_HOUR * SECONDS_PER_HOUR + offset))
+
+    # change how often a guild gets scheduled posts
+    async def set_cadence(self, guild_id: int, hours: int) -> None:
+        if hours < 1:
+            raise ValueError('Cadence must be at least one hour')
+        self._cadences[guild_id] = hours
+        await self.save_cadence(guild_id, hours)
+
+    # sleeps until at least one of the guilds returned by `get_guild_ids` is due,
+    # then returns the due guilds grouped by bucket, so that each group can share a post
+    async def wait_for_due(self, get_guild_ids: Callable[[], List[int]]) -> List[List[int]]:
+        while True:
+            guild_ids = get_guild_ids()
+            due = await self.due_guilds(guild_ids)
+            if len(due) > 0:
+                groups = {}
+                for guild_id in due:
+                    groups.setdefault(self.offset(guild_id), []).append(guild_id)
+                if self.logger is not None:
+                    self.logger.info(f'{len(due)} guilds due for a scheduled post, in {len(groups)} groups')
+                return [groups[k] for k in sorted(groups)]
+            now = self.clock()
+            deadlines = [self.next_deadline(g, now) for g in guild_ids]
+            # wake up just past the deadline, so the new slot has definitely started
+            delay = min(deadlines) - now + 1 if len(deadlines) > 0 else self.max_sleep
+            await asyncio.sleep(min(max(delay, 0), self.max_sleep))
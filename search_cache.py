@@ -0,0 +1,100 @@
+# Caches the results of `!food search` queries, so that repeated and popular
+# searches don't go to Reddit every time. Results are kept in a local LRU
+# cache, and optionally shared with other processes through Redis. Both
+# expire after a TTL, so new submissions show up in searches eventually.
+# Only the ordered, lightweight FoodPost metadata is cached, not the
+# Reddit submissions themselves.
+from collections import OrderedDict
+from hashlib import sha1
+from typing import Awaitable, Callable, List, Optional
+import json
+import os
+import time
+from food_post import FoodPost
+
+
+# Number of seconds that cached search results are served for
+TTL = float(os.environ.get('SEARCH_CACHE_TTL', '900'))
+# Maximum number of searches kept in the local cache
+MAX_ENTRIES = int(os.environ.get('SEARCH_CACHE_SIZE', '256'))
+
+
+class SearchCache:
+    # Attributes
+    # load - optional coroutine function that takes a cache key, and returns the shared payload for it
+    # save - optional coroutine function that takes a cache key, payload and TTL in seconds, and shares it
+    # hits - number of searches answered from the cache (local or shared)
+    # misses - number of searches that had to go to Reddit
+    def __init__(self,
+                 load: Optional[Callable[[str], Awaitable[Optional[str]]]] = None,
+                 save: Optional[Callable[[str, str, float], Awaitable]] = None,
+                 max_entries: int = MAX_ENTRIES,
+                 ttl: float = TTL,
+                 clock: Callable[[], float] = time.monotonic):
+        self.load = load
+        self.save = save
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (time cached, posts), least recently used first
+
+    # returns the cache key for a search. Queries that only differ in case or
+    # whitespace, and the same subreddits in any order, share a key
+    @staticmethod
+    def key(subs: List[str], query: str, time_filter: Optional[str] = None) -> str:
+        normalized = '|'.join([
+            '+'.join(sorted(s.lower() for s in subs)),
+            ' '.join(query.lower().split()),
+            time_filter or 'all',
+        ])
+        return sha1(normalized.encode('utf-8')).hexdigest()
+
+    def _get_local(self, key: str) -> Optional[List[FoodPost]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        cached_at, posts = entry
+        if self.clock() - cached_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return posts
+
+    def _put_local(self, key: str, posts: List[FoodPost]) -> None:
+        self._entries[key] = (self.clock(), posts)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # returns the cached results of a search, or None if it isn't cached
+    async def get(self, subs: List[str], query: str, time_filter: Optional[str] = None) -> Optional[List[FoodPost]]:
+        key = SearchCache.key(subs, query, time_filter)
+        posts = self._get_local(key)
+        if posts is None and self.load is not None:
+            payload = await self.load(key)
+            if payload is not None:
+                posts = [FoodPost.from_dict(d) for d in json.loads(payload)]
+                self._put_local(key, posts)
+        return posts
+
+    # caches the results of a search
+    async def put(self, subs: List[str], query: str, posts: List[FoodPost], time_filter: Optional[str] = None) -> None:
+        key = SearchCache.key(subs, query, time_filter)
+        self._put_local(key, posts)
+        if self.save is not None:
+            await self.save(key, '[' + ', '.join(p.to_json() for p in posts) + ']', self.ttl)
+
+    # returns the cached results of a search, or runs `search` and caches what it returns
+    async def get_or_search(self, subs: List[str], query: str,
+                            search: Callable[[], Awaitable[List[FoodPost]]],
+                            time_filter: Optional[str] = None) -> List[FoodPost]:
+        posts = await self.get(subs, query, time_filter)
+        if posts is not None:
+            self.hits += 1
+            return posts
+        self.misses += 1
+        posts = await search()
+        await self.put(subs, query, posts, time_filter)
+        return posts
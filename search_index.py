@@ -0,0 +1,134 @@
+# Local full-text index over every submission the bot has seen (hot listings,
+# pool refills and search results), so that `!food search` can usually be
+# answered from disk instead of waiting on Reddit's search API, and keeps
+# working while Reddit is rate limiting us.
+# The index is a SQLite database with an FTS5 table over the titles,
+# subreddits and image URLs. It only understands the queries that
+# `utility.build_query` produces (a title phrase, optionally excluding self
+# posts), and anything else falls through to Reddit.
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Iterable, List, Optional, Tuple
+import asyncio
+import os
+import re
+import sqlite3
+import time
+from food_post import FoodPost
+
+
+# Location of the index on disk
+PATH = os.environ.get('SEARCH_INDEX_PATH', 'search_index.db')
+# Local results are only trusted if one of them was seen this recently (seconds)
+STALE_AFTER = float(os.environ.get('SEARCH_INDEX_STALE_SECONDS', str(6 * 60 * 60)))
+# Submissions that haven't been seen in this many days are removed from the index
+RETENTION = float(os.environ.get('SEARCH_INDEX_RETENTION_DAYS', '90')) * 24 * 60 * 60
+# Maximum number of results returned for a search
+MAX_RESULTS = 100
+
+# matches the queries built by utility.build_query
+QUERY_PATTERN = re.compile(r'^title:"(?P<phrase>.*)"(?P<self_no> self:no)?$')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS posts (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT UNIQUE NOT NULL,
+    title TEXT NOT NULL,
+    subreddit TEXT NOT NULL,
+    permalink TEXT NOT NULL,
+    image_url TEXT NOT NULL,
+    is_self INTEGER NOT NULL,
+    seen_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS posts_seen_at ON posts (seen_at);
+CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+    title, subreddit, image_url, content='posts', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS posts_ai AFTER INSERT ON posts BEGIN
+    INSERT INTO posts_fts (rowid, title, subreddit, image_url)
+    VALUES (new.rowid, new.title, new.subreddit, new.image_url);
+END;
+CREATE TRIGGER IF NOT EXISTS posts_ad AFTER DELETE ON posts BEGIN
+    INSERT INTO posts_fts (posts_fts, rowid, title, subreddit, image_url)
+    VALUES ('delete', old.rowid, old.title, old.subreddit, old.image_url);
+END;
+CREATE TRIGGER IF NOT EXISTS posts_au AFTER UPDATE ON posts BEGIN
+    INSERT INTO posts_fts (posts_fts, rowid, title, subreddit, image_url)
+    VALUES ('delete', old.rowid, old.title, old.subreddit, old.image_url);
+    INSERT INTO posts_fts (rowid, title, subreddit, image_url)
+    VALUES (new.rowid, new.title, new.subreddit, new.image_url);
+END;
+'''
+
+
+# takes a query built by utility.build_query, and returns the equivalent FTS5
+# match expression, and whether self posts are excluded. Returns None for
+# queries that the index can't answer.
+def parse_query(query: str) -> Optional[Tuple[str, bool]]:
+    match = QUERY_PATTERN.match(query)
+    if match is None or len(match.group('phrase').strip()) < 1:
+        return None
+    phrase = match.group('phrase').replace('"', '""')
+    return f'title : "{phrase}"', match.group('self_no') is not None
+
+
+class SearchIndex:
+    # Attributes
+    # path - location of the SQLite database, or ':memory:'
+    # stale_after - local results are only trusted if one of them was seen this recently
+    # retention - number of seconds a submission stays in the index after it was last seen
+    def __init__(self, path: str = PATH, stale_after: float = STALE_AFTER, retention: float = RETENTION,
+                 clock: Callable[[], float] = time.time):
+        self.stale_after = stale_after
+        self.retention = retention
+        self.clock = clock
+        # every query runs on this single thread, so the connection is never shared
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='search-index')
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    # adds (or refreshes) the given Reddit submissions in the index,
+    # and removes the ones that haven't been seen within the retention period
+    def add_submissions(self, submissions: Iterable) -> None:
+        now = self.clock()
+        rows = [(s.id, s.title, s.subreddit.display_name.lower(), f'https://www.reddit.com{s.permalink}',
+                 s.url, int(s.is_self), now) for s in submissions]
+        with self.db:
+            self.db.executemany('''
+                INSERT INTO posts (id, title, subreddit, permalink, image_url, is_self, seen_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    title = excluded.title, image_url = excluded.image_url, seen_at = excluded.seen_at
+            ''', rows)
+            self.db.execute('DELETE FROM posts WHERE seen_at < ?', (now - self.retention,))
+
+    # returns the most relevant posts for the query within the given subreddits.
+    # Returns None if the index can't answer the query, has no results, or
+    # only has results that haven't been seen recently, meaning Reddit should be searched instead
+    def search(self, subs: List[str], query: str, limit: int = MAX_RESULTS) -> Optional[List[FoodPost]]:
+        parsed = parse_query(query)
+        if parsed is None:
+            return None
+        match, exclude_self = parsed
+        subs = [s.lower() for s in subs]
+        placeholders = ', '.join('?' * len(subs))
+        rows = self.db.execute(f'''
+            SELECT posts.id, posts.title, posts.permalink, posts.image_url, posts.seen_at
+            FROM posts_fts JOIN posts ON posts.rowid = posts_fts.rowid
+            WHERE posts_fts MATCH ? AND posts.subreddit IN ({placeholders}) AND (? = 0 OR posts.is_self = 0)
+            ORDER BY bm25(posts_fts)
+            LIMIT ?
+        ''', [match] + subs + [int(exclude_self), limit]).fetchall()
+        if len(rows) < 1 or max(row[4] for row in rows) < self.clock() - self.stale_after:
+            return None
+        return [FoodPost(id=i, title=t, permalink=p, image_url=u) for i, t, p, u, _ in rows]
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args))
+
+    async def add_submissions_async(self, submissions: Iterable) -> None:
+        await self._run(self.add_submissions, list(submissions))
+
+    async def search_async(self, subs: List[str], query: str, limit: int = MAX_RESULTS) -> Optional[List[FoodPost]]:
+        return await self._run(self.search, subs, query, limit)
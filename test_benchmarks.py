@@ -0,0 +1,24 @@
+# Tests for the benchmark harness
+from benchmarks.harness import compare, measure
+import asyncio
+
+
+def test_measure_sync_and_async_benchmarks():
+    calls = []
+
+    async def async_benchmark():
+        await asyncio.sleep(0)
+        calls.append('async')
+
+    result = measure(lambda: lambda: calls.append('sync'), rounds=5, warmup=1)
+    assert result['rounds'] == 5
+    assert result['min'] <= result['median'] <= result['max']
+    measure(lambda: async_benchmark, rounds=5, warmup=1)
+    assert calls == ['sync'] * 6 + ['async'] * 6
+
+
+def test_compare_reports_regressions_past_tolerance():
+    baseline = {'a': {'median': 0.010}, 'b': {'median': 0.010}, 'c': {'median': 0.010}}
+    results = {'a': {'median': 0.014}, 'b': {'median': 0.016}, 'c': {'median': 0.005}, 'new': {'median': 1}}
+    regressions = compare(results, baseline, tolerance=0.5)
+    assert regressions == ['b: 16.000ms, was 10.000ms (+60%)']
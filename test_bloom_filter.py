@@ -0,0 +1,45 @@
+# Tests for the local Bloom filter
+from bloom_filter import BloomFilter
+from concurrent.futures import ThreadPoolExecutor
+
+
+def test_added_items_are_always_found():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    items = [f'post{i}' for i in range(1000)]
+    bloom.update(items)
+    assert all(item in bloom for item in items)
+    assert bloom.count == 1000
+
+
+def test_false_positive_rate_is_close_to_target():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    bloom.update(f'post{i}' for i in range(1000))
+    false_positives = sum(f'other{i}' in bloom for i in range(10000))
+    assert false_positives / 10000 < 0.02
+    assert 0.005 < bloom.false_positive_rate < 0.015
+
+
+def test_sizing_and_clear():
+    bloom = BloomFilter(capacity=1000000, error_rate=0.01)
+    # roughly 9.6 bits per item, with 7 hashes, for a 1% error rate
+    assert 1100000 < bloom.memory_bytes < 1300000
+    assert bloom.hash_count == 7
+    bloom.add('foo')
+    bloom.clear()
+    assert 'foo' not in bloom
+    assert bloom.false_positive_rate == 0
+
+
+def test_items_added_from_several_threads_are_all_found():
+    # a tiny filter, so that the threads keep setting bits in the same bytes
+    bloom = BloomFilter(capacity=100, error_rate=0.1)
+    batches = [[f'post{t}-{i}' for i in range(2000)] for t in range(8)]
+
+    def add_all(items):
+        for item in items:
+            bloom.add(item)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(add_all, batches))
+    assert all(item in bloom for items in batches for item in items)
+    assert bloom.count == 16000
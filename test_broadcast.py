@@ -0,0 +1,187 @@
+# Tests for assigning broadcast posts to guilds, and sharing broadcasts between processes through Redis
+from broadcast import assign_posts, records_for, fan_out, SharedSelection
+from food_post import FoodPost
+from functools import partial
+from mock_logger import MockLogger
+from mock_redis import MockRedisClient, reset_redis_connector, run_against_redis
+import asyncio
+import os
+import pytest
+import redis_connector
+import time
+
+
+a = FoodPost(id='a')
+b = FoodPost(id='b')
+c = FoodPost(id='c')
+
+
+def test_every_guild_shares_the_first_candidate():
+    assignments = assign_posts([1, 2, 3], [a, b], {})
+    assert assignments == {1: a, 2: a, 3: a}
+    assert records_for(assignments) == {'a': 'all'}
+
+
+def test_guilds_that_saw_a_post_get_the_next_one():
+    assignments = assign_posts([1, 2, 3], [a, b, c], {2: {'a'}, 3: {'a', 'b'}})
+    assert assignments == {1: a, 2: b, 3: c}
+    assert records_for(assignments) == {'a': '1', 'b': '2', 'c': '3'}
+
+
+def test_posts_are_reused_across_guilds():
+    assignments = assign_posts([1, 2, 3], [a, b], {1: {'a'}, 2: {'a'}})
+    assert assignments == {1: b, 2: b, 3: a}
+    assert records_for(assignments) == {'a': '3', 'b': 'all'}
+
+
+def test_guild_that_saw_every_candidate_is_left_out():
+    assignments = assign_posts([1, 2], [a], {2: {'a'}})
+    assert assignments == {1: a}
+    assert assign_posts([1], [], {}) == {}
+    assert records_for({}) == {}
+
+
+def test_fan_out_isolates_failures():
+    logger = MockLogger()
+    delivered = []
+
+    async def ok(guild_id):
+        delivered.append(guild_id)
+
+    async def broken():
+        raise RuntimeError('no access')
+
+    sends = {1: partial(ok, 1), 2: broken, 3: partial(ok, 3)}
+    result = asyncio.run(fan_out(sends, rate=0, logger=logger))
+    assert sorted(result.sent) == [1, 3]
+    assert sorted(delivered) == [1, 3]
+    assert list(result.failed) == [2]
+    assert logger.error_messages == [f"Failed to send broadcast to guild 2: {repr(RuntimeError('no access'))}"]
+
+
+def test_fan_out_respects_concurrency_cap():
+    in_flight = []
+    peak = []
+
+    async def send():
+        in_flight.append(1)
+        peak.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.pop()
+
+    result = asyncio.run(fan_out({i: send for i in range(20)}, concurrency=3, rate=0))
+    assert len(result.sent) == 20
+    assert max(peak) == 3
+
+
+def test_fan_out_runs_sends_concurrently():
+    async def slow_send():
+        await asyncio.sleep(0.1)
+
+    result = asyncio.run(fan_out({i: slow_send for i in range(10)}, concurrency=10, rate=0))
+    assert result.elapsed < 0.5
+    assert str(result).startswith('sent to 10 guilds, 0 failed, in ')
+
+
+def test_fan_out_paces_sends():
+    starts = []
+
+    async def send():
+        starts.append(time.monotonic())
+
+    asyncio.run(fan_out({i: send for i in range(3)}, rate=20))
+    assert starts[-1] - starts[0] >= 0.09
+
+
+def test_shared_post_is_recorded_as_broadcast_post():
+    assert records_for({1: a}, shared={'a'}) == {'a': 'all'}
+    assert records_for({1: b}, shared={'a'}) == {'b': '1'}
+    assert records_for({1: a, 2: b}, shared={'a', 'b'}) == {'a': 'all', 'b': 'all'}
+
+
+# in-memory stand-in for the leases and selections in Redis
+class DummySelectionStore:
+    def __init__(self):
+        self.leases = {}
+        self.selections = {}
+
+    async def acquire(self, key, ttl):
+        if key in self.leases:
+            return False
+        self.leases[key] = ttl
+        return True
+
+    async def load(self, key):
+        return self.selections.get(key)
+
+    async def save(self, key, payload, ttl):
+        self.selections[key] = payload
+
+
+def test_processes_share_one_selection():
+    store = DummySelectionStore()
+    selections = []
+
+    async def select():
+        selections.append(1)
+        await asyncio.sleep(0.01)
+        return [b, a]
+
+    async def run_processes():
+        processes = [SharedSelection(store.acquire, store.load, store.save, poll_interval=0.005, clock=lambda: 100.0)
+                     for _ in range(5)]
+        return await asyncio.gather(*(p.get('key', select) for p in processes))
+
+    results = asyncio.run(run_processes())
+    assert len(selections) == 1
+    for posts, selected_at in results:
+        assert [p.id for p in posts] == ['b', 'a']
+        assert selected_at == 100.0
+
+
+def test_slot_claims_are_exclusive(mocker, monkeypatch):
+    import redis
+    reset_redis_connector(monkeypatch)
+    mocker.patch.object(redis, 'from_url', lambda *args, **kwargs: MockRedisClient())
+
+    assert redis_connector.claim_broadcast_slots({}, 'a', 60) == []
+    assert asyncio.run(redis_connector.claim_broadcast_slots_async({1: 3600.0, 2: 3600.0}, 'a', 60)) == [1, 2]
+    assert redis_connector.claim_broadcast_slots({2: 3600.0, 3: 3600.0}, 'b', 60) == [3]
+    # the owner of a claim keeps it, so it can retry the slot
+    assert redis_connector.claim_broadcast_slots({1: 3600.0, 2: 3600.0, 3: 3600.0}, 'a', 60) == [1, 2]
+    # the next slot can be claimed again
+    assert redis_connector.claim_broadcast_slots({1: 7200.0}, 'b', 60) == [1]
+
+
+def test_broadcast_selection_round_trip(mocker, monkeypatch):
+    import redis
+    reset_redis_connector(monkeypatch)
+    mocker.patch.object(redis, 'from_url', lambda *args, **kwargs: MockRedisClient())
+
+    assert asyncio.run(redis_connector.acquire_lease_async('x', 'a', 60))
+    assert not asyncio.run(redis_connector.acquire_lease_async('x', 'b', 60))
+    assert asyncio.run(redis_connector.get_broadcast_selection_async('x')) is None
+    asyncio.run(redis_connector.store_broadcast_selection_async('x', '{}', 60))
+    assert asyncio.run(redis_connector.get_broadcast_selection_async('x')) == '{}'
+
+
+# acts as one shard process of the bot: claims the slots of every guild, and gets the broadcast selection
+def run_shard_process(owner: str, results) -> None:
+    async def select():
+        return [FoodPost(id=f'{owner}-{i}') for i in range(3)]
+
+    selection = SharedSelection(lambda key, ttl: redis_connector.acquire_lease_async(key, owner, ttl),
+                                redis_connector.get_broadcast_selection_async,
+                                redis_connector.store_broadcast_selection_async, poll_interval=0.05)
+    posts, _ = asyncio.run(selection.get('3600', select))
+    claimed = redis_connector.claim_broadcast_slots({g: 3600.0 for g in range(100)}, owner, 60)
+    results.put((owner, claimed, [p.id for p in posts]))
+
+
+@pytest.mark.skipif('REDIS_TEST_URL' not in os.environ,
+                    reason='needs a Redis server, given by REDIS_TEST_URL')
+def test_shard_processes_split_slots_and_share_selection(monkeypatch):
+    outcomes = run_against_redis(monkeypatch, run_shard_process, 4)
+    claimed = [g for _, guilds, _ in outcomes for g in guilds]
+    assert sorted(claimed) == list(range(100))
+    assert len({tuple(post_ids) for _, _, post_ids in outcomes}) == 1
@@ -0,0 +1,88 @@
+# Tests for the warm candidate pool
+from candidate_pool import CandidatePool
+from food_post import FoodPost
+from mock_logger import MockLogger
+from typing import List
+import asyncio
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_posts(*ids: str) -> List[FoodPost]:
+    return [FoodPost(id=i, title=i, permalink=i, image_url=i) for i in ids]
+
+
+def make_pool(fetched: List[FoodPost], used: set, clock=None, **kwargs) -> CandidatePool:
+    async def fetch():
+        return list(fetched)
+
+    async def filter_unused(ids):
+        return [i for i in ids if i not in used]
+
+    return CandidatePool(fetch, filter_unused, clock=clock or FakeClock(), **kwargs)
+
+
+def test_take_from_empty_pool_returns_none():
+    pool = make_pool([], set())
+    assert asyncio.run(pool.take()) is None
+
+
+def test_refill_skips_posts_already_in_pool():
+    logger = MockLogger()
+    pool = make_pool(make_posts('a', 'b', 'c'), set(), logger=logger)
+    assert asyncio.run(pool.refill()) == 3
+    assert asyncio.run(pool.refill()) == 0
+    assert len(pool) == 3
+    assert logger.info_messages[0] == 'Added 3 candidates to the pool, which now holds 3'
+
+
+def test_refill_respects_max_size():
+    pool = make_pool(make_posts('a', 'b', 'c'), set(), max_size=2)
+    assert asyncio.run(pool.refill()) == 2
+    assert len(pool) == 2
+
+
+def test_take_revalidates_against_redis():
+    used = set()
+    pool = make_pool(make_posts('a', 'b'), used)
+    asyncio.run(pool.refill())
+    used.update({'a', 'b'})
+    assert asyncio.run(pool.take()) is None
+    assert len(pool) == 0
+
+
+def test_take_returns_each_post_once():
+    pool = make_pool(make_posts('a', 'b'), set())
+    asyncio.run(pool.refill())
+    taken = {asyncio.run(pool.take()).id, asyncio.run(pool.take()).id}
+    assert taken == {'a', 'b'}
+    assert asyncio.run(pool.take()) is None
+
+
+def test_expired_entries_are_dropped():
+    clock = FakeClock()
+    pool = make_pool(make_posts('a'), set(), clock=clock, max_age=10)
+    asyncio.run(pool.refill())
+    clock.now = 11
+    assert asyncio.run(pool.take()) is None
+
+
+def test_background_task_refills_below_low_watermark():
+    pool = make_pool(make_posts('a', 'b', 'c'), set(), low_watermark=2, retry_delay=0)
+
+    async def run_then_take():
+        task = asyncio.ensure_future(pool.run())
+        await asyncio.sleep(0.01)
+        assert len(pool) == 3
+        await pool.take()
+        await pool.take()
+        task.cancel()
+        return len(pool)
+
+    assert asyncio.run(run_then_take()) == 1
@@ -0,0 +1,86 @@
+# Tests for caching the channel that the bot posts to in each guild
+from channel_cache import ChannelCache
+from mock_discord import DummyChannel, DummyGuild
+import asyncio
+
+
+# in-memory stand-in for the Redis hash of posting channels
+class DummyStore:
+    def __init__(self):
+        self.channels = {}
+
+    async def load(self, guild_id):
+        return self.channels.get(guild_id)
+
+    async def save(self, guild_id, channel_id):
+        self.channels[guild_id] = channel_id
+
+    async def delete(self, guild_id):
+        self.channels.pop(guild_id, None)
+
+
+def make_cache(store: DummyStore) -> ChannelCache:
+    return ChannelCache(store.load, store.save, store.delete)
+
+
+def test_resolves_channel_once():
+    first, second = DummyChannel(1, 0, can_send=False), DummyChannel(2, 1)
+    guild = DummyGuild(10, [second, first])
+    cache = ChannelCache()
+
+    assert asyncio.run(cache.get(guild)) is second
+    assert asyncio.run(cache.get(guild)) is second
+    assert first.checks == 1
+    assert second.checks == 1
+
+
+def test_caches_guild_without_channel():
+    cache = ChannelCache()
+    guild = DummyGuild(10, [DummyChannel(1, 0, can_send=False)])
+    assert asyncio.run(cache.get(guild)) is None
+    assert asyncio.run(cache.get(guild)) is None
+    assert guild.channels[0].checks == 1
+
+
+def test_invalidate_resolves_again_and_persists():
+    store = DummyStore()
+    channel = DummyChannel(1, 0)
+    guild = DummyGuild(10, [channel])
+    cache = make_cache(store)
+
+    assert asyncio.run(cache.get(guild)) is channel
+    assert store.channels == {10: 1}
+    channel.can_send = False
+    guild.channels.append(DummyChannel(2, 1))
+    cache.invalidate(guild.id)
+    assert asyncio.run(cache.get(guild)).id == 2
+    assert store.channels == {10: 2}
+
+
+def test_loads_persisted_channel_after_restart():
+    store = DummyStore()
+    store.channels[10] = 2
+    first, second = DummyChannel(1, 0), DummyChannel(2, 1)
+    guild = DummyGuild(10, [first, second])
+
+    assert asyncio.run(make_cache(store).get(guild)) is second
+    assert first.checks == 0
+
+
+def test_ignores_persisted_channel_that_is_gone():
+    store = DummyStore()
+    store.channels[10] = 3
+    channel = DummyChannel(1, 0)
+    guild = DummyGuild(10, [channel])
+
+    assert asyncio.run(make_cache(store).get(guild)) is channel
+    assert store.channels == {10: 1}
+
+
+def test_remove_forgets_persisted_channel():
+    store = DummyStore()
+    guild = DummyGuild(10, [DummyChannel(1, 0)])
+    cache = make_cache(store)
+    asyncio.run(cache.get(guild))
+    asyncio.run(cache.remove(guild.id))
+    assert store.channels == {}
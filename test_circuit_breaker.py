@@ -0,0 +1,49 @@
+# Tests for the circuit breaker in front of Redis
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+class FakeClock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_opens_after_failures_in_a_row():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=FakeClock(0))
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    # a success resets the count
+    assert breaker.allow()
+    breaker.record_success()
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+
+def test_lets_one_trial_through_after_reset_timeout():
+    clock = FakeClock(0)
+    states = []
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock, on_change=states.append)
+    breaker.allow()
+    breaker.record_failure()
+    clock.now = 29
+    assert not breaker.allow()
+    clock.now = 30
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()  # only while the trial is in flight
+    breaker.record_failure()
+
+    # the failed trial keeps it open for another reset_timeout
+    clock.now = 59
+    assert not breaker.allow()
+    clock.now = 60
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.allow() and breaker.allow()
+    assert states == [OPEN, HALF_OPEN, OPEN, HALF_OPEN, CLOSED]
@@ -0,0 +1,241 @@
+# Tests for delivering scheduled posts through the work queue
+from delivery import DeliveryJob, DeliveryWorker, PermanentDeliveryError
+from food_post import FoodPost
+from mock_logger import MockLogger
+from mock_redis import MockRedisClient, reset_redis_connector, run_against_redis
+import asyncio
+import os
+import pytest
+import redis_connector
+
+
+a = FoodPost(id='a', title='A', permalink='https://www.reddit.com/a', image_url='https://i.redd.it/a.jpg')
+b = FoodPost(id='b', title='B', permalink='https://www.reddit.com/b', image_url='')
+
+
+class FakeClock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+# in-memory stand-in for the delivery stream and its consumer group in Redis
+class FakeQueue:
+    def __init__(self, clock: FakeClock):
+        self.clock = clock
+        self.entries = {}  # entry ID -> fields
+        self.pending = {}  # entry ID -> [consumer, time delivered, times delivered]
+        self.new = []  # entry IDs that haven't been given to a consumer
+        self.dead = {}
+        self.records = {}
+
+    def enqueue(self, jobs):
+        for job in jobs:
+            entry_id = f'{len(self.entries) + len(self.dead)}-0'
+            self.entries[entry_id] = job.to_fields()
+            self.new.append(entry_id)
+
+    async def read(self, consumer, count, block):
+        taken, self.new = self.new[:count], self.new[count:]
+        for entry_id in taken:
+            self.pending[entry_id] = [consumer, self.clock(), 1]
+        return [(entry_id, self.entries[entry_id]) for entry_id in taken]
+
+    async def claim(self, consumer, min_idle, count):
+        stale = [e for e, (_, delivered_at, _) in self.pending.items() if self.clock() - delivered_at >= min_idle]
+        claimed = []
+        for entry_id in stale[:count]:
+            times = self.pending[entry_id][2] + 1
+            self.pending[entry_id] = [consumer, self.clock(), times]
+            claimed.append((entry_id, self.entries[entry_id], times))
+        return claimed
+
+    async def ack(self, entry_ids):
+        for entry_id in entry_ids:
+            del self.pending[entry_id]
+            del self.entries[entry_id]
+
+    async def dead_letter(self, jobs):
+        self.dead.update(jobs)
+        await self.ack(list(jobs))
+
+    async def record(self, records):
+        self.records.update(records)
+
+
+def make_worker(queue: FakeQueue, deliver, **kwargs) -> DeliveryWorker:
+    return DeliveryWorker(queue.read, queue.claim, queue.ack, queue.dead_letter, deliver, queue.record, 'worker',
+                          retry_after=60, max_attempts=3, rate=0, **kwargs)
+
+
+def test_job_round_trips_through_stream_fields():
+    job = DeliveryJob.from_fields(DeliveryJob(1, 2, a, 'all').to_fields())
+    assert (job.guild_id, job.channel_id, job.post.id, job.post.image_url, job.record) == \
+        (1, 2, 'a', 'https://i.redd.it/a.jpg', 'all')
+    embed = job.to_embed()
+    assert (embed.title, embed.description, embed.image.url) == ('A', 'https://www.reddit.com/a', 'https://i.redd.it/a.jpg')
+    assert DeliveryJob(1, 2, b, '1').to_embed().to_dict() == b.to_embed().to_dict()
+
+
+def test_sent_jobs_are_recorded_and_acknowledged():
+    clock = FakeClock(0)
+    queue = FakeQueue(clock)
+    queue.enqueue([DeliveryJob(1, 10, a, 'all'), DeliveryJob(2, 20, a, 'all'), DeliveryJob(3, 30, b, '3')])
+    sent = []
+
+    async def deliver(job):
+        sent.append(job.channel_id)
+        clock.now += 0.5
+
+    result = asyncio.run(make_worker(queue, deliver, clock=clock).run_once())
+    assert sorted(sent) == [10, 20, 30]
+    assert str(result) == 'sent 3 posts, 0 will be retried, 0 dead lettered, in 1.50s'
+    assert queue.records == {'a': 'all', 'b': '3'}
+    assert queue.entries == {} and queue.pending == {}
+
+
+def test_failed_jobs_are_retried_then_dead_lettered():
+    clock = FakeClock(0)
+    queue = FakeQueue(clock)
+    queue.enqueue([DeliveryJob(1, 10, a, '1'), DeliveryJob(2, 20, b, '2')])
+    logger = MockLogger()
+    attempts = []
+
+    async def deliver(job):
+        attempts.append(job.guild_id)
+        if job.guild_id == 2:
+            raise RuntimeError('Discord is down')
+
+    worker = make_worker(queue, deliver, logger=logger)
+    assert len(asyncio.run(worker.run_once()).failed) == 1
+    assert queue.records == {'a': '1'}
+    assert logger.warn_messages == ["Failed to deliver post b to guild 2 (attempt 1 of 3): RuntimeError('Discord is down')"]
+
+    # nothing is retried until the job has waited long enough
+    clock.now = 30
+    assert len(asyncio.run(worker.run_once())) == 0
+    for now in (60, 120):
+        clock.now = now
+        assert len(asyncio.run(worker.run_once()).failed) == 1
+    clock.now = 180
+    result = asyncio.run(worker.run_once())
+    assert result.dead == ['1-0']
+    assert attempts == [1, 2, 2, 2]
+    assert queue.dead['1-0']['error'] == 'Gave up after 3 attempts'
+    assert queue.entries == {} and queue.pending == {}
+
+
+def test_permanent_failures_and_invalid_jobs_are_dead_lettered():
+    queue = FakeQueue(FakeClock(0))
+    queue.enqueue([DeliveryJob(1, 10, a, '1')])
+    queue.entries['9-0'] = {'guild': 'not a number'}
+    queue.new.append('9-0')
+
+    async def deliver(job):
+        raise PermanentDeliveryError('Missing access')
+
+    result = asyncio.run(make_worker(queue, deliver).run_once())
+    assert sorted(result.dead) == ['0-0', '9-0']
+    assert queue.dead['0-0']['error'] == "PermanentDeliveryError('Missing access')"
+    assert queue.dead['9-0']['error'].startswith('Invalid job: ')
+    assert queue.records == {}
+
+
+def test_run_carries_on_after_errors(monkeypatch):
+    import delivery
+    monkeypatch.setattr(delivery, 'ERROR_BACKOFF', 0)
+    queue = FakeQueue(FakeClock(0))
+    queue.enqueue([DeliveryJob(1, 10, a, '1')])
+    logger = MockLogger()
+    calls = []
+
+    async def flaky_claim(consumer, min_idle, count):
+        calls.append(1)
+        if len(calls) == 1:
+            raise ConnectionError('Redis is down')
+        return await queue.claim(consumer, min_idle, count)
+
+    async def deliver(job):
+        pass
+
+    worker = DeliveryWorker(queue.read, flaky_claim, queue.ack, queue.dead_letter, deliver, queue.record, 'worker',
+                            rate=0, logger=logger, clock=FakeClock(0))
+    asyncio.run(worker.run(lambda: len(calls) >= 3))
+    assert logger.error_messages == ["Failed to handle scheduled post deliveries: ConnectionError('Redis is down')"]
+    assert logger.info_messages == ['Scheduled post deliveries: sent 1 posts, 0 will be retried, 0 dead lettered, in 0.00s']
+    assert queue.records == {'a': '1'}
+
+
+def test_delivery_stream_round_trip(mocker, monkeypatch):
+    import redis
+    reset_redis_connector(monkeypatch)
+    r = MockRedisClient()
+    mocker.patch.object(redis, 'from_url', lambda *args, **kwargs: r)
+
+    asyncio.run(redis_connector.enqueue_deliveries_async([{'guild': '1'}]))
+    asyncio.run(redis_connector.create_delivery_group_async())
+    asyncio.run(redis_connector.create_delivery_group_async())  # already exists
+    redis_connector.enqueue_deliveries([{'guild': '2'}, {'guild': '3'}])
+    redis_connector.enqueue_deliveries([])
+    # jobs queued before the group was created are read too
+    assert asyncio.run(redis_connector.read_deliveries_async('a', 2, 1)) == [('1-0', {'guild': '1'}), ('2-0', {'guild': '2'})]
+    assert redis_connector.read_deliveries('b', 10) == [('3-0', {'guild': '3'})]
+    assert redis_connector.read_deliveries('b', 10) == []
+
+    redis_connector.ack_deliveries(['1-0'])
+    # the others were never acknowledged, and are taken over once they're stale
+    r.now_ms = 30000
+    assert asyncio.run(redis_connector.claim_stale_deliveries_async('c', 60, 10)) == []
+    r.now_ms = 60000
+    assert redis_connector.claim_stale_deliveries('c', 60, 10) == [('2-0', {'guild': '2'}, 2), ('3-0', {'guild': '3'}, 2)]
+    asyncio.run(redis_connector.dead_letter_deliveries_async({'2-0': {'guild': '2', 'error': 'Oops'}}))
+    asyncio.run(redis_connector.ack_deliveries_async(['3-0']))
+    assert list(r.cache[redis_connector.DELIVERY_STREAM_KEY]) == []
+    assert list(r.cache[redis_connector.DEAD_LETTER_STREAM_KEY].values()) == [{'guild': '2', 'error': 'Oops'}]
+    assert redis_connector.claim_stale_deliveries('c', 0, 10) == []
+
+    # a pending job that was deleted from the stream is acknowledged, instead of being claimed forever
+    redis_connector.enqueue_deliveries([{'guild': '4'}])
+    assert [entry_id for entry_id, _ in redis_connector.read_deliveries('d', 10)] == ['4-0']
+    r.xdel(redis_connector.DELIVERY_STREAM_KEY, '4-0')
+    assert redis_connector.claim_stale_deliveries('c', 0, 10) == []
+    assert r.cache[redis_connector.DELIVERY_STREAM_KEY].groups[redis_connector.DELIVERY_GROUP]['pending'] == {}
+
+
+# queues five jobs, and delivers them with a worker whose first send to guild 2 fails
+def run_delivery_worker(name: str, results) -> None:
+    attempts = []
+
+    async def deliver(job):
+        attempts.append(job.guild_id)
+        if job.guild_id == 2 and attempts.count(2) == 1:
+            raise RuntimeError('Discord is down')
+
+    async def run():
+        await redis_connector.create_delivery_group_async()
+        jobs = [DeliveryJob(g, g, FoodPost(id=f'p{g}', title='Food'), 'all') for g in range(5)]
+        await redis_connector.enqueue_deliveries_async([job.to_fields() for job in jobs])
+        worker = DeliveryWorker(redis_connector.read_deliveries_async, redis_connector.claim_stale_deliveries_async,
+                                redis_connector.ack_deliveries_async, redis_connector.dead_letter_deliveries_async,
+                                deliver, redis_connector.store_posts_async, name, block=0.1, retry_after=0.2,
+                                rate=0)
+        first = await worker.run_once()
+        await asyncio.sleep(0.3)
+        return first, await worker.run_once()
+
+    first, retry = asyncio.run(run())
+    results.put(((len(first.sent), len(first.failed), len(retry.sent)), sorted(attempts),
+                 redis_connector.filter_unused_posts([f'p{g}' for g in range(5)]),
+                 redis_connector.r.xlen(redis_connector.DELIVERY_STREAM_KEY)))
+
+
+@pytest.mark.skipif('REDIS_TEST_URL' not in os.environ,
+                    reason='needs a Redis server, given by REDIS_TEST_URL')
+def test_delivery_worker_retries_against_redis(monkeypatch):
+    [(counts, attempts, unused, queued)] = run_against_redis(monkeypatch, run_delivery_worker, 1)
+    assert counts == (4, 1, 1)
+    assert attempts == [0, 1, 2, 2, 3, 4]
+    assert unused == []
+    assert queued == 0
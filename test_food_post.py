@@ -1,6 +1,8 @@
 # Tests for the FoodPost class
 from food_post import FoodPost
 from typing import Dict
+import json
+import pytest
 
 
 class DummySubmission:
@@ -62,3 +64,24 @@ def test_discord_embed_truncates_title():
     assert em.title == expected
     assert em.description == '2'
     assert em._image == {'url': '3'}
+
+
+def test_dict_round_trip():
+    fp = FoodPost(id='1', title='2', permalink='3', image_url='4')
+    copy = FoodPost.from_dict(fp.to_dict())
+    assert (copy.id, copy.title, copy.post_url, copy.image_url) == ('1', '2', '3', '4')
+
+
+def test_food_post_is_immutable():
+    fp = FoodPost(id='1', title='2', permalink='3', image_url='4')
+    assert not hasattr(fp, '__dict__')
+    with pytest.raises(AttributeError):
+        fp.title = 'something else'
+    assert fp.title == '2'
+
+
+def test_embed_and_json_are_built_once():
+    fp = FoodPost(id='1', title='2', permalink='3', image_url='4')
+    assert fp.to_embed() is fp.to_embed()
+    assert fp.to_json() is fp.to_json()
+    assert FoodPost.from_dict(json.loads(fp.to_json())).to_dict() == fp.to_dict()
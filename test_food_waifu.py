@@ -0,0 +1,121 @@
+# Tests for creating the bot
+from discord.ext import commands
+from mock_logger import MockLogger
+import asyncio
+import food_waifu
+import metrics
+import os
+import socket
+import subprocess
+import sys
+
+
+def test_import_has_no_side_effects():
+    # no SUBREDDITS or REDIS_URL, and nothing is connected to
+    env = {k: v for k, v in os.environ.items() if k not in ('SUBREDDITS', 'REDIS_URL')}
+    script = 'import food_waifu, sys; print(sorted(m for m in ("praw", "auths") if m in sys.modules))'
+    result = subprocess.run([sys.executable, '-c', script], env=env, cwd=os.path.dirname(__file__) or '.',
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    assert result.stdout.decode().strip() == '[]'
+
+
+def test_create_app_reads_environment(monkeypatch):
+    monkeypatch.setenv('SUBREDDITS', 'food,FoodPorn')
+    monkeypatch.setenv('SHARD_COUNT', '4')
+    monkeypatch.setenv('SHARD_IDS', '1,3')
+    app = food_waifu.create_app(MockLogger(), search_index_path=':memory:')
+    assert app.subs == ['food', 'FoodPorn']
+    assert (app.shard_count, app.shard_ids) == (4, [1, 3])
+    assert app.instance_id.endswith(':[1, 3]')
+
+
+def test_clients_are_created_when_first_used():
+    created = []
+
+    def reddit_factory():
+        created.append('reddit')
+        return 'reddit client'
+
+    app = food_waifu.FoodWaifu(['food'], MockLogger(), reddit_factory=reddit_factory, search_index_path=':memory:')
+    assert (app._bot, app._reddit_api, app._search_index) == (None, None, None)
+    assert app.reddit_api == 'reddit client'
+    assert app.reddit_api == 'reddit client'
+    assert created == ['reddit']
+
+    async def create_bot():
+        # the client takes the running event loop
+        return app.bot
+
+    bot = asyncio.run(create_bot())
+    assert type(bot) is commands.Bot
+    assert app.bot is bot
+    assert {c.name for c in bot.commands} == {'new', 'search', 'clear', 'restart', 'cadence', 'subreddits', 'keys',
+                                              'fetch', 'help'}
+    assert 'on_guild_remove' in {name for name, _ in bot.get_cog('Food').get_listeners()}
+
+
+def test_redis_is_prepared_before_anything_else_starts():
+    events = []
+
+    class FakeLoop:
+        def __init__(self):
+            self.loop = asyncio.new_event_loop()
+
+        def run_until_complete(self, coroutine):
+            return self.loop.run_until_complete(coroutine)
+
+        def create_task(self, coroutine):
+            events.append(coroutine.__name__)
+            coroutine.close()
+
+    class FakeBot:
+        loop = FakeLoop()
+
+        def run(self, token):
+            events.append('run')
+
+    async def prepare_redis():
+        await asyncio.sleep(0)
+        events.append('prepare_redis')
+
+    app = food_waifu.FoodWaifu(['food'], MockLogger(), search_index_path=':memory:')
+    app._bot = FakeBot()
+    app.prepare_redis = prepare_redis
+    app.run('token')
+    FakeBot.loop.loop.close()
+    assert events[0] == 'prepare_redis'
+    assert events[-1] == 'run'
+    assert 'start_candidate_pool' in events
+
+
+def test_clients_are_closed_when_the_bot_stops():
+    app = food_waifu.FoodWaifu(['food'], MockLogger(), search_index_path=':memory:')
+
+    async def run_and_stop():
+        session = app.image_resolver._get_session()
+        task = asyncio.ensure_future(app.close_on_shutdown())
+        await asyncio.sleep(0)
+        # the bot cancels the tasks that are still running when it stops
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return session
+
+    assert asyncio.run(run_and_stop()).closed
+    assert app.image_resolver._session is None
+
+
+def test_each_shard_process_serves_metrics_on_its_own_port(monkeypatch):
+    taken = socket.socket()
+    taken.bind((metrics.HOST, 0))
+    taken.listen()
+    port = taken.getsockname()[1]
+    monkeypatch.setattr(metrics, 'PORT', port - 2)
+    logger = MockLogger()
+    app = food_waifu.FoodWaifu(['food'], logger, shard_count=4, shard_ids=[2, 3], search_index_path=':memory:')
+    try:
+        # the port is already in use, so the bot carries on without serving the metrics
+        asyncio.run(app.start_metrics_server())
+    finally:
+        taken.close()
+    assert len(logger.error_messages) == 1
+    assert logger.error_messages[0].startswith(f'Failed to serve metrics on port {port}: ')
@@ -0,0 +1,70 @@
+# Tests for the subreddits that each guild gets its posts from
+from guild_subreddits import GuildSubreddits, group_by_subreddits, parse_subreddits
+import asyncio
+import pytest
+
+
+# in-memory stand-in for the configured subreddits in Redis
+class FakeStore:
+    def __init__(self, subs: dict = None):
+        self.subs = subs or {}
+        self.loads = []
+
+    async def load(self, guild_ids):
+        self.loads.append(guild_ids)
+        return {g: self.subs[g] for g in guild_ids if g in self.subs}
+
+    async def save(self, guild_id, subs):
+        self.subs[guild_id] = subs
+
+    async def delete(self, guild_id):
+        self.subs.pop(guild_id, None)
+
+
+def make_guild_subreddits(store: FakeStore) -> GuildSubreddits:
+    return GuildSubreddits(['food', 'FoodPorn'], store.load, store.save, store.delete, max_subreddits=3)
+
+
+def test_parse_accepts_what_admins_type():
+    assert parse_subreddits(['r/Ramen,', '/r/pho', 'ramen', 'sushi,tacos']) == ['ramen', 'pho', 'sushi', 'tacos']
+    for names in ([], ['r/'], ['no spaces!'], ['a' * 22]):
+        with pytest.raises(ValueError):
+            parse_subreddits(names)
+    with pytest.raises(ValueError):
+        parse_subreddits(['a1', 'b1', 'c1'], max_subreddits=2)
+
+
+def test_guilds_are_grouped_by_subreddits():
+    groups = group_by_subreddits({1: ['food'], 2: ['ramen', 'pho'], 3: ['food'], 4: ['pho', 'ramen']})
+    assert groups == {('food',): [1, 3], ('pho', 'ramen'): [2, 4]}
+
+
+def test_subreddits_are_loaded_once_per_guild():
+    store = FakeStore({2: ['ramen']})
+    guild_subreddits = make_guild_subreddits(store)
+    assert asyncio.run(guild_subreddits.get_many([1, 2])) == {1: ['food', 'foodporn'], 2: ['ramen']}
+    assert asyncio.run(guild_subreddits.get(1)) == ['food', 'foodporn']
+    assert asyncio.run(guild_subreddits.get_many([2, 3])) == {2: ['ramen'], 3: ['food', 'foodporn']}
+    assert store.loads == [[1, 2], [3]]
+    assert not asyncio.run(guild_subreddits.is_configured(1))
+    assert asyncio.run(guild_subreddits.is_configured(2))
+
+
+def test_admins_change_a_guilds_subreddits():
+    store = FakeStore()
+    guild_subreddits = make_guild_subreddits(store)
+    assert asyncio.run(guild_subreddits.add(1, ['r/Ramen'])) == ['food', 'foodporn', 'ramen']
+    with pytest.raises(ValueError):
+        asyncio.run(guild_subreddits.add(1, ['pho']))
+    assert asyncio.run(guild_subreddits.remove(1, ['food', 'FoodPorn'])) == ['ramen']
+    with pytest.raises(ValueError):
+        asyncio.run(guild_subreddits.remove(1, ['ramen']))
+    assert asyncio.run(guild_subreddits.set(2, ['pho'])) == ['pho']
+    assert store.subs == {1: ['ramen'], 2: ['pho']}
+
+    asyncio.run(guild_subreddits.reset(1))
+    asyncio.run(guild_subreddits.forget(2))
+    assert store.subs == {}
+    assert asyncio.run(guild_subreddits.get_many([1, 2])) == {1: ['food', 'foodporn'], 2: ['food', 'foodporn']}
+    # a forgotten guild is loaded again, if it comes back
+    assert store.loads == [[1], [2]]
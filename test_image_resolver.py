@@ -0,0 +1,173 @@
+# Tests for resolving and validating the images of candidate posts,
+# against a stub HTTP server running locally
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from food_post import FoodPost
+from image_resolver import ImageResolver, get_image_url
+from mock_logger import MockLogger
+from typing import Dict, List
+import asyncio
+
+
+class DummySubmission:
+    def __init__(self, url: str, **data):
+        self.url = url
+        for key, value in data.items():
+            setattr(self, key, value)
+
+
+# in-memory stand in for the Redis cache of image checks
+class DummyCache:
+    def __init__(self):
+        self.results = {}
+        self.ttls = {}
+
+    async def load(self, keys: List[str]) -> Dict[str, bool]:
+        return {k: self.results[k] for k in keys if k in self.results}
+
+    async def save(self, results: Dict[str, bool], positive_ttl: float, negative_ttl: float) -> None:
+        self.results.update(results)
+        self.ttls.update({k: positive_ttl if v else negative_ttl for k, v in results.items()})
+
+
+# stub image host, which counts the requests made for each path
+def make_app(requests: Dict[str, int]) -> web.Application:
+    async def handle(request):
+        requests[request.path] = requests.get(request.path, 0) + 1
+        if request.path == '/food.jpg':
+            return web.Response(body=b'jpeg', content_type='image/jpeg')
+        if request.path == '/page':
+            return web.Response(text='<html></html>', content_type='text/html')
+        if request.path == '/moved':
+            raise web.HTTPFound('/food.jpg')
+        if request.path == '/no-head.png':
+            if request.method == 'HEAD':
+                raise web.HTTPMethodNotAllowed('HEAD', ['GET'])
+            return web.Response(body=b'png', content_type='image/png')
+        if request.path == '/broken':
+            raise web.HTTPServiceUnavailable()
+        if request.path == '/forbidden.jpg':
+            raise web.HTTPForbidden()
+        if request.path == '/slow.jpg':
+            await asyncio.sleep(1)
+            return web.Response(body=b'jpeg', content_type='image/jpeg')
+        raise web.HTTPNotFound()
+
+    app = web.Application()
+    app.router.add_route('*', '/{path:.*}', handle)
+    return app
+
+
+# runs `test` with a resolver and the stub server, and returns its result
+def run_with_server(test, requests: Dict[str, int], cache: DummyCache, **kwargs):
+    async def run():
+        server = TestServer(make_app(requests))
+        await server.start_server()
+        resolver = ImageResolver(cache.load, cache.save, **kwargs)
+        try:
+            return await test(resolver, lambda path: str(server.make_url(path)))
+        finally:
+            await resolver.close()
+            await server.close()
+    return asyncio.run(run())
+
+
+def post(post_id: str, image_url: str) -> FoodPost:
+    return FoodPost(id=post_id, title=post_id, permalink=post_id, image_url=image_url)
+
+
+def test_get_image_url_for_direct_images():
+    assert get_image_url(DummySubmission('https://i.redd.it/abc.jpg')) == 'https://i.redd.it/abc.jpg'
+    assert get_image_url(DummySubmission('https://imgur.com/abc')) == 'https://i.imgur.com/abc.jpg'
+    assert get_image_url(DummySubmission('https://imgur.com/a/abc')) == 'https://imgur.com/a/abc'
+    assert get_image_url(DummySubmission('https://i.imgur.com/abc.gifv')) == 'https://i.imgur.com/abc.gif'
+
+
+def test_get_image_url_for_galleries():
+    submission = DummySubmission('https://www.reddit.com/gallery/abc', is_gallery=True,
+                                 gallery_data={'items': [{'media_id': 'x'}, {'media_id': 'y'}]},
+                                 media_metadata={'x': {'s': {'u': 'https://preview.redd.it/x.jpg?a=1&amp;b=2'}},
+                                                 'y': {'s': {'u': 'https://preview.redd.it/y.jpg'}}})
+    assert get_image_url(submission) == 'https://preview.redd.it/x.jpg?a=1&b=2'
+    assert get_image_url(DummySubmission('https://www.reddit.com/gallery/abc', is_gallery=True)) == ''
+
+
+def test_get_image_url_uses_preview_for_videos_and_self_posts():
+    preview = {'images': [{'source': {'url': 'https://preview.redd.it/v.jpg?a=1&amp;b=2'}}]}
+    assert get_image_url(DummySubmission('https://v.redd.it/abc', preview=preview)) == \
+        'https://preview.redd.it/v.jpg?a=1&b=2'
+    permalink = 'https://www.reddit.com/r/FoodPorn/comments/abc/title/'
+    assert get_image_url(DummySubmission(permalink, is_self=True)) == ''
+    assert get_image_url(DummySubmission(permalink, preview=preview)) == 'https://preview.redd.it/v.jpg?a=1&b=2'
+
+
+def test_resolve_caches_results():
+    requests = {}
+    cache = DummyCache()
+
+    async def test(resolver, url):
+        posts = [post('a', url('/food.jpg')), post('b', url('/page')), post('c', url('/missing.jpg')),
+                 post('d', url('/moved')), post('e', url('/no-head.png')), post('f', '')]
+        first = [p.id for p in await resolver.resolve(posts)]
+        checks = resolver.checks
+        second = [p.id for p in await resolver.resolve(posts)]
+        return first, second, checks, resolver.checks, resolver.cache_hits
+
+    first, second, checks_before, checks_after, hits = \
+        run_with_server(test, requests, cache, positive_ttl=20, negative_ttl=10)
+    assert first == ['a', 'd', 'e']
+    assert second == first
+    assert checks_before == 5  # the empty URL isn't requested
+    assert checks_after == checks_before  # everything came from the cache the second time
+    assert hits == 5
+    assert sorted(cache.ttls.values()) == [10, 10, 20, 20, 20]
+    assert requests['/food.jpg'] == 2  # checked directly, and again after the redirect
+
+
+def test_unknown_results_keep_the_post_and_are_not_cached():
+    requests = {}
+    cache = DummyCache()
+    logger = MockLogger()
+
+    async def test(resolver, url):
+        posts = [post('a', url('/broken')), post('b', url('/slow.jpg')), post('c', url('/food.jpg')),
+                 post('d', url('/forbidden.jpg')), post('e', url('/missing.jpg'))]
+        return [p.id for p in await resolver.resolve(posts)]
+
+    # only the image that's gone is dropped
+    assert run_with_server(test, requests, cache, timeout=0.2, logger=logger) == ['a', 'b', 'c', 'd']
+    assert sorted(cache.results.values()) == [False, True]
+    assert len(logger.warn_messages) == 1  # the timeout
+
+
+def test_checks_run_concurrently():
+    requests = {}
+    cache = DummyCache()
+
+    async def test(resolver, url):
+        posts = [post(str(i), url(f'/slow.jpg?{i}')) for i in range(5)]
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        valid = await resolver.resolve(posts)
+        return len(valid), loop.time() - start
+
+    count, elapsed = run_with_server(test, requests, cache, concurrency=5)
+    assert count == 5
+    assert elapsed < 3  # one at a time would take at least 5 seconds
+
+
+def test_first_valid_stops_at_the_first_batch_with_an_image():
+    requests = {}
+    cache = DummyCache()
+
+    async def test(resolver, url):
+        posts = [post('a', url('/missing.jpg')), post('b', url('/page')), post('c', url('/food.jpg')),
+                 post('d', url('/no-head.png')), post('e', url('/moved')), post('f', url('/food.jpg?f'))]
+        first = await resolver.first_valid(posts, batch_size=2)
+        none = await resolver.first_valid(posts[:2], batch_size=2)
+        return first.id, none
+
+    assert run_with_server(test, requests, cache) == ('c', None)
+    # the batch after the first valid post is never checked
+    assert '/moved' not in requests
+    assert sorted(requests) == ['/food.jpg', '/missing.jpg', '/no-head.png', '/page']
@@ -0,0 +1,36 @@
+# Tests for logging through a queue and a background thread
+from logging.handlers import QueueHandler
+import io
+import logging
+import logging_config
+import threading
+
+
+# stream that records which thread wrote to it
+class RecordingStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.threads = set()
+
+    def write(self, s: str) -> int:
+        self.threads.add(threading.current_thread().name)
+        return super().write(s)
+
+
+def test_records_are_written_by_a_background_thread():
+    stream = RecordingStream()
+    logger, listener = logging_config.configure('INFO', stream)
+    handler = logger.handlers[-1]
+    try:
+        assert isinstance(handler, QueueHandler)
+        logger.debug('Key %s not currently in Redis', 'abc')
+        logger.info('Checked %d posts, %d unused', 500, 3)
+        logging_config.stop(listener)  # waits for the queued records to be written
+        lines = stream.getvalue().splitlines()
+        assert len(lines) == 1
+        assert lines[0].endswith(' - root - INFO - Checked 500 posts, 3 unused')
+        assert threading.current_thread().name not in stream.threads
+        logging_config.stop(listener)  # stopping it again, as at exit, does nothing
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(logging.WARNING)
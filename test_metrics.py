@@ -0,0 +1,80 @@
+# Tests for the metrics registry and the endpoint that serves it
+from metrics import Histogram, Registry, start_server
+import aiohttp
+import asyncio
+import pytest
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_counters_and_gauges_render_with_labels():
+    registry = Registry()
+    counter = registry.counter('requests_total', 'Requests made', ('operation',))
+    gauge = registry.gauge('depth', 'How deep it went')
+    counter.inc(operation='hot')
+    counter.inc(2, operation='say "hi"\n')
+    gauge.set(3)
+    assert registry.render() == (
+        '# HELP requests_total Requests made\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{operation="hot"} 1.0\n'
+        'requests_total{operation="say \\"hi\\"\\n"} 2.0\n'
+        '# HELP depth How deep it went\n'
+        '# TYPE depth gauge\n'
+        'depth 3.0\n'
+    )
+
+
+def test_registering_twice_returns_the_same_metric():
+    registry = Registry()
+    counter = registry.counter('requests_total', 'Requests made', ('operation',))
+    assert registry.counter('requests_total', 'Requests made', ('operation',)) is counter
+    with pytest.raises(ValueError):
+        registry.gauge('requests_total', 'Requests made', ('operation',))
+    with pytest.raises(ValueError):
+        counter.inc(outcome='ok')
+
+
+def test_histogram_buckets_are_cumulative():
+    clock = FakeClock()
+    histogram = Histogram('latency_seconds', 'Latency', ('operation',), buckets=(0.1, 1), clock=clock)
+    histogram.observe(0.05, operation='get')
+    with pytest.raises(RuntimeError):
+        with histogram.time(operation='get'):
+            clock.now += 0.5
+            raise RuntimeError('the duration is still recorded')
+    histogram.observe(5, operation='get')
+    assert histogram.count(operation='get') == 3
+    assert histogram.render().split('\n')[2:] == [
+        'latency_seconds_bucket{operation="get",le="0.1"} 1.0',
+        'latency_seconds_bucket{operation="get",le="1.0"} 2.0',
+        'latency_seconds_bucket{operation="get",le="+Inf"} 3.0',
+        'latency_seconds_sum{operation="get"} 5.55',
+        'latency_seconds_count{operation="get"} 3.0',
+    ]
+
+
+def test_endpoint_serves_metrics():
+    registry = Registry()
+    registry.counter('requests_total', 'Requests made').inc()
+
+    async def scrape():
+        runner = await start_server(registry, '127.0.0.1', 0)
+        try:
+            host, port = runner.addresses[0][:2]
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f'http://{host}:{port}/metrics') as response:
+                    return response.status, response.headers['Content-Type'], await response.text()
+        finally:
+            await runner.cleanup()
+
+    status, content_type, body = asyncio.run(scrape())
+    assert status == 200
+    assert content_type.startswith('text/plain; version=0.0.4')
+    assert 'requests_total 1.0' in body
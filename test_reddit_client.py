@@ -0,0 +1,297 @@
+# Tests for running Reddit requests off of the event loop
+import asyncio
+import threading
+import time
+import pytest
+import reddit_client
+
+
+class DummySubmission:
+    def __init__(self, submission_id: str):
+        self.id = submission_id
+        self.fullname = f't3_{submission_id}'
+
+
+# Fake PRAW subreddit that records the requests made against it.
+# Listings are served from the owning DummyReddit, and honor `after`.
+class DummySubreddit:
+    def __init__(self, name: str, reddit):
+        self.name = name
+        self.reddit = reddit
+
+    def _listing(self, listing: str, limit: int, params: dict):
+        self.reddit.calls.append((listing, self.name, dict(limit=limit, **params)))
+        self.reddit.threads.append(threading.current_thread().name)
+        time.sleep(self.reddit.delay)
+        items = self.reddit.listings.get(listing, [])
+        start = 0
+        if 'after' in params:
+            start = [s.fullname for s in items].index(params['after']) + 1
+        return iter(items[start:start + limit])
+
+    def hot(self, limit: int, params: dict):
+        return self._listing('hot', limit, params)
+
+    def new(self, limit: int, params: dict):
+        return self._listing('new', limit, params)
+
+    def top(self, limit: int, params: dict):
+        return self._listing('top', limit, params)
+
+    def search(self, query: str, **kwargs):
+        self.reddit.calls.append(('search', self.name, dict(query=query, **kwargs)))
+        time.sleep(self.reddit.delay)
+        return iter([query])
+
+
+class DummyReddit:
+    def __init__(self, delay: float = 0, listings: dict = None):
+        self.delay = delay
+        self.listings = listings or {}
+        self.calls = []
+        self.threads = []
+
+    def subreddit(self, name: str):
+        return DummySubreddit(name, self)
+
+
+class FakeClock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_listing(prefix: str, size: int) -> list:
+    return [DummySubmission(f'{prefix}{i}') for i in range(size)]
+
+
+def test_hot_joins_subreddits_and_consumes_listing():
+    reddit = DummyReddit(listings={'hot': make_listing('h', 5)})
+    result = asyncio.run(reddit_client.hot(reddit, ['a', 'b'], 3))
+    assert [s.id for s in result] == ['h0', 'h1', 'h2']
+    assert reddit.calls == [('hot', 'a+b', {'limit': 3})]
+    assert reddit.threads[0].startswith('reddit')
+
+
+def test_search_passes_arguments_through():
+    reddit = DummyReddit()
+    result = asyncio.run(reddit_client.search(reddit, ['a'], 'foo', sort='relevance', time_filter='month'))
+    assert result == ['foo']
+    assert reddit.calls == [('search', 'a', {'query': 'foo', 'sort': 'relevance', 'time_filter': 'month'})]
+
+
+def test_slow_request_times_out():
+    reddit = DummyReddit(delay=0.5)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(reddit_client.hot(reddit, ['a'], 1, timeout=0.05))
+
+
+def test_requests_are_counted_and_timed():
+    requests, latency = reddit_client.requests_total, reddit_client.request_seconds
+    ok, timeouts = requests.value(operation='hot', outcome='ok'), requests.value(operation='hot', outcome='timeout')
+    searches = latency.count(operation='search')
+    asyncio.run(reddit_client.hot(DummyReddit(), ['a'], 1))
+    asyncio.run(reddit_client.search(DummyReddit(), ['a'], 'foo'))
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(reddit_client.hot(DummyReddit(delay=0.5), ['a'], 1, timeout=0.05))
+    assert requests.value(operation='hot', outcome='ok') == ok + 1
+    assert requests.value(operation='hot', outcome='timeout') == timeouts + 1
+    assert latency.count(operation='search') == searches + 1
+
+
+def test_concurrent_requests_run_in_parallel():
+    reddit = DummyReddit(delay=0.2)
+
+    async def fetch_many():
+        return await asyncio.gather(*[reddit_client.hot(reddit, ['a'], 1) for _ in range(reddit_client.MAX_WORKERS)])
+
+    start = time.monotonic()
+    asyncio.run(fetch_many())
+    # run serially, this would take at least MAX_WORKERS * 0.2 seconds
+    assert time.monotonic() - start < 0.2 * reddit_client.MAX_WORKERS
+
+
+def test_pager_resumes_from_last_submission():
+    reddit = DummyReddit(listings={'hot': make_listing('h', 150)})
+    pager = reddit_client.ListingPager(reddit_client.RedditClient(reddit, cache_ttl=0), ['a'], listings=['hot'])
+
+    first = asyncio.run(pager.next_page())
+    second = asyncio.run(pager.next_page())
+    assert [s.id for s in first] == [f'h{i}' for i in range(20)]
+    assert [s.id for s in second] == [f'h{i}' for i in range(20, 120)]
+    assert reddit.calls[1] == ('hot', 'a', {'limit': 100, 'after': 't3_h19'})
+
+
+def test_pager_moves_to_next_listing_and_skips_repeats():
+    reddit = DummyReddit(listings={'hot': make_listing('h', 10), 'new': make_listing('h', 5) + make_listing('n', 3)})
+    pager = reddit_client.ListingPager(reddit_client.RedditClient(reddit, cache_ttl=0), ['a'], listings=['hot', 'new'])
+
+    assert len(asyncio.run(pager.next_page())) == 10
+    assert [s.id for s in asyncio.run(pager.next_page())] == ['n0', 'n1', 'n2']
+    assert asyncio.run(pager.next_page()) == []
+    assert pager.exhausted()
+
+
+def test_pager_stops_listing_at_max_items():
+    # Refetching from the start with doubled limits (20, 20, 40, 80, 160, 320, 500)
+    # transferred 1140 submissions over 15 requests of up to 100 submissions
+    # before giving up on a 500 submission listing. Paging reads each one once.
+    reddit = DummyReddit(listings={'hot': make_listing('h', 1000)})
+    pager = reddit_client.ListingPager(reddit_client.RedditClient(reddit, cache_ttl=0), ['a'], listings=['hot'], max_items=500)
+
+    while len(asyncio.run(pager.next_page())) > 0:
+        pass
+    assert pager.items_fetched == 500
+    assert pager.api_calls == 6
+
+
+def test_merged_pagers_share_each_subreddits_requests():
+    reddit = DummyReddit(listings={'hot': make_listing('h', 30)})
+    client = reddit_client.RedditClient(reddit)
+    ramen = reddit_client.MergedPager(client, ['ramen', 'food'], listings=['hot'], max_items=30)
+    pho = reddit_client.MergedPager(client, ['pho', 'food'], listings=['hot'], max_items=30)
+
+    async def page_both():
+        return await asyncio.gather(ramen.next_page(), pho.next_page())
+
+    first, _ = asyncio.run(page_both())
+    # the listings are the same for every subreddit here, so the repeats are dropped
+    assert [s.id for s in first] == [f'h{i}' for i in range(20)]
+    assert sorted(call[1] for call in reddit.calls) == ['food', 'pho', 'ramen']
+    assert [s.id for s in asyncio.run(ramen.next_page())] == [f'h{i}' for i in range(20, 30)]
+    assert asyncio.run(ramen.next_page()) == []
+    assert ramen.exhausted()
+    assert (ramen.api_calls, ramen.items_fetched) == (4, 60)
+
+
+def test_identical_calls_in_flight_share_one_request():
+    client = reddit_client.RedditClient(DummyReddit(delay=0.1, listings={'hot': make_listing('h', 5)}))
+
+    async def commands():
+        return await asyncio.gather(*[client.hot(['a', 'b'], 3) for _ in range(10)],
+                                    *[client.search(['a'], 'pho', sort='relevance') for _ in range(5)],
+                                    client.search(['a'], 'ramen', sort='relevance'))
+
+    results = asyncio.run(commands())
+    assert [s.id for s in results[0]] == ['h0', 'h1', 'h2']
+    assert results[10:] == [['pho']] * 5 + [['ramen']]
+    assert [call[0] for call in client.reddit.calls] == ['hot', 'search', 'search']
+    assert (client.requests, client.saved) == (3, 13)
+    assert str(client) == '3 requests made to Reddit, 13 calls saved'
+
+
+def test_failed_request_fails_every_caller_and_isnt_cached():
+    client = reddit_client.RedditClient(DummyReddit(delay=0.5))
+
+    async def commands():
+        return await asyncio.gather(client.hot(['a'], 1, timeout=0.05), client.hot(['a'], 1), return_exceptions=True)
+
+    assert [type(e) for e in asyncio.run(commands())] == [asyncio.TimeoutError, asyncio.TimeoutError]
+    client.reddit.delay = 0
+    assert asyncio.run(client.hot(['a'], 1)) == []
+    assert client.requests == 2
+
+
+def test_listing_pages_are_cached_briefly():
+    clock = FakeClock(0)
+    reddit = DummyReddit(listings={'hot': make_listing('h', 5)})
+    client = reddit_client.RedditClient(reddit, cache_ttl=30, cache_size=2, clock=clock)
+    page = asyncio.run(client.hot(['a'], 3))
+    page.clear()  # callers get their own copy
+    assert len(asyncio.run(client.hot(['a'], 3))) == 3
+    clock.now = 31
+    asyncio.run(client.hot(['a'], 3))
+    # the oldest page is dropped, once the cache is full
+    asyncio.run(client.listing(['a'], 'hot', 3, after='t3_h0'))
+    asyncio.run(client.listing(['a'], 'hot', 3, after='t3_h1'))
+    asyncio.run(client.hot(['a'], 3))
+    assert len(reddit.calls) == 5
+    assert client.saved == 1
+
+
+def test_budget_waits_for_the_window_to_reset(monkeypatch):
+    clock = FakeClock(0)
+    budget = reddit_client.RateBudget(capacity=2, window=600, clock=clock)
+
+    async def sleep(seconds):
+        clock.now += seconds
+
+    async def acquire_three():
+        for _ in range(3):
+            await budget.acquire()
+            budget.release()
+
+    monkeypatch.setattr(reddit_client.asyncio, 'sleep', sleep)
+    asyncio.run(acquire_three())
+    assert clock.now == 600
+    assert budget.tokens == 1
+
+
+def test_budget_follows_reported_rate_limit():
+    clock = FakeClock(0)
+    budget = reddit_client.RateBudget(capacity=600, window=600, clock=clock)
+    asyncio.run(budget.acquire())
+    asyncio.run(budget.acquire())
+    # other clients using the same credentials spent most of the budget
+    budget.release((10, 120))
+    assert (budget.tokens, budget.reset_at, budget.in_flight) == (9, 120, 1)
+    budget.release((0, 100))
+    assert budget.tokens == 0
+    assert reddit_client.rate_limit_remaining.value() == 0
+    clock.now = 100
+    asyncio.run(budget.acquire())
+    assert budget.tokens == 599
+
+
+# serves the parts of Reddit's API that the client uses: an OAuth token, and a hot listing
+# whose responses report the given rate limit headers
+async def start_fake_reddit(requests: list, remaining: int):
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    async def access_token(request):
+        return web.json_response({'access_token': 'token', 'expires_in': 3600, 'scope': '*', 'token_type': 'bearer'})
+
+    async def hot(request):
+        requests.append(str(request.rel_url))
+        await asyncio.sleep(0.1)
+        children = [{'kind': 't3', 'data': {'id': f'p{i}', 'name': f't3_p{i}', 'title': f'Post {i}',
+                                            'permalink': f'/r/a/comments/p{i}/', 'url': f'https://i.redd.it/p{i}.jpg'}}
+                    for i in range(int(request.query['limit']))]
+        headers = {'x-ratelimit-remaining': str(remaining), 'x-ratelimit-used': str(600 - remaining),
+                   'x-ratelimit-reset': '120'}
+        return web.json_response({'kind': 'Listing', 'data': {'children': children, 'after': None, 'before': None}},
+                                 headers=headers)
+
+    app = web.Application()
+    app.router.add_post('/api/v1/access_token', access_token)
+    app.router.add_get('/r/{subs}/hot', hot)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+
+def test_client_against_fake_reddit_server():
+    import praw
+    requests = []
+
+    async def commands():
+        server = await start_fake_reddit(requests, remaining=42)
+        url = str(server.make_url('')).rstrip('/')
+        reddit = praw.Reddit(client_id='id', client_secret='secret', user_agent='test', oauth_url=url,
+                             reddit_url=url, check_for_updates=False)
+        client = reddit_client.RedditClient(reddit)
+        try:
+            pages = await asyncio.gather(*[client.hot(['a', 'b'], 3) for _ in range(20)])
+            pages.append(await client.hot(['a', 'b'], 3))
+            return client, pages
+        finally:
+            await server.close()
+
+    client, pages = asyncio.run(commands())
+    assert requests == ['/r/a+b/hot?limit=3&raw_json=1']
+    assert [s.title for s in pages[-1]] == ['Post 0', 'Post 1', 'Post 2']
+    assert (client.requests, client.saved) == (1, 20)
+    assert client.budget.tokens == 42
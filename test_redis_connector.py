@@ -1,66 +1,40 @@
 # Tests that cover the Redis integration
+from bloom_filter import BloomFilter
 from mock_logger import MockLogger
-from typing import Optional
-import sys
+from mock_redis import MockRedisClient, reset_redis_connector
+import asyncio
 import pytest
+import shutil
+import redis_connector
 
 
-original_imports = set(sys.modules.keys())
 k = 'foo'
 v = 'bar'
 logger = MockLogger()
 
 
-# Mock Redis client to use for testing.
-# The `should_fail` flag is used to force specific code branches for
-# consistent testing and more code coverage.
-class MockRedisClient:
-    def __init__(self, should_fail: bool=False):
-        self.cache = {}  # store a cache internally
-        self.should_fail = should_fail
-
-    def set(self, post_id: str, server: str) -> bool:
-        if not self.should_fail:
-            self.cache[post_id] = server
-            return True
-        else:
-            return False
-
-    def exists(self, post_id: str) -> int:
-        if post_id in self.cache:
-            return 1
-        else:
-            return 0
-
-    def flushall(self, asynchronous: bool=False) -> bool:
-        return not self.should_fail
-
-    def keys(self):
-        if self.should_fail:
-            raise Exception('Oops')
-        else:
-            return self.cache.keys()
-
-    def get(self, post_id: str) -> Optional[str]:
-        if post_id in self.cache:
-            return self.cache[post_id]
-        else:
-            return None
-
-
-# The things that get mocked, such as `redis` are cached
-# by Python import magic, and need to be removed in each
-# test setup in order to reapply a different mock.
-# https://github.com/pytest-dev/pytest-mock/issues/161
+class FakeClock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+# Each test starts with a new client, which is created by whichever `redis.from_url`
+# the test mocked, the first time the test uses it, and with an empty dedup filter
 @pytest.fixture(autouse=True)
 def cleanup(monkeypatch):
-    monkeypatch.setenv('REDIS_URL', 'something')
-    current_imports = set(sys.modules.keys())
-    for key in current_imports - original_imports:
-        del sys.modules[key]
+    reset_redis_connector(monkeypatch, FakeClock(0))
     logger.flush()  # flush all of the messages before executing a new test
 
 
+# writes a post record straight to the mock client, bypassing the local filter
+def seed_post(redis_connector, post_id: str, posted_at: float = None):
+    redis_connector.r.hset(redis_connector.POSTS_KEY, post_id, v)
+    redis_connector.r.zadd(redis_connector.POSTED_AT_KEY, {post_id: posted_at or redis_connector.clock()})
+
+
 def valid_client(*args, **kwargs):
     return MockRedisClient()
 
@@ -75,8 +49,9 @@ def test_store_post_successfully(mocker):
     from redis_connector import store_post_from_server
 
     assert store_post_from_server(k, v, logger)
-    assert len(logger.info_messages) == 1
-    assert logger.info_messages[0] == 'Successfully persisted foo -> bar to Redis'
+    assert len(logger.debug_messages) == 1
+    assert logger.debug_messages[0] == 'Successfully persisted foo -> bar to Redis'
+    assert len(logger.info_messages) == 0
     assert len(logger.warn_messages) == 0
 
 
@@ -98,8 +73,8 @@ def test_accurately_finds_post_already_used(mocker):
 
     store_post_from_server(k, v)
     assert post_already_used(k, logger)
-    assert len(logger.info_messages) == 1
-    assert logger.info_messages[0] == f'Found {k} already in Redis'
+    assert len(logger.debug_messages) == 1
+    assert logger.debug_messages[0] == f'Found {k} already in Redis'
     
 
 def test_accurately_does_not_find_unused_post(mocker):
@@ -108,8 +83,8 @@ def test_accurately_does_not_find_unused_post(mocker):
     from redis_connector import post_already_used
 
     assert not post_already_used(k, logger)
-    assert len(logger.info_messages) == 1
-    assert logger.info_messages[0] == f'Key {k} not currently in Redis'
+    assert len(logger.debug_messages) == 1
+    assert logger.debug_messages[0] == f'Key {k} not currently in Redis'
 
 
 def test_flush_all_records_succeeds(mocker):
@@ -186,3 +161,525 @@ def test_get_value_returns_none_for_invalid_key(mocker):
     from redis_connector import get_value
 
     assert get_value(k) == None
+
+
+def test_store_post_async(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    from redis_connector import store_post_from_server_async, post_already_used_async
+
+    assert asyncio.run(store_post_from_server_async(k, v, logger))
+    assert asyncio.run(post_already_used_async(k, logger))
+    assert logger.debug_messages == ['Successfully persisted foo -> bar to Redis', f'Found {k} already in Redis']
+
+
+def test_post_already_used_async_does_not_find_unused_post(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    from redis_connector import post_already_used_async
+
+    assert not asyncio.run(post_already_used_async(k, logger))
+    assert logger.debug_messages == [f'Key {k} not currently in Redis']
+
+
+def test_flush_all_records_async_fails(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', invalid_client)
+    from redis_connector import flush_all_records_async
+
+    assert not asyncio.run(flush_all_records_async(logger))
+    assert logger.warn_messages == ['Did not successfully flush all keys in Redis']
+
+
+def test_get_value_async(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    from redis_connector import get_value_async, store_post_from_server
+
+    store_post_from_server(k, v)
+    assert asyncio.run(get_value_async(k)) == v
+    assert asyncio.run(get_value_async(v)) is None
+
+
+def test_filter_unused_posts_in_batches(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+    mocker.patch.object(redis_connector, 'PIPELINE_CHUNK_SIZE', 2)
+
+    redis_connector.store_post_from_server('b', v)
+    redis_connector.store_post_from_server('d', v)
+    round_trips = redis_connector.r.round_trips
+    assert redis_connector.filter_unused_posts(['a', 'b', 'c', 'a', 'd', 'e'], logger) == ['a', 'c', 'e']
+    assert redis_connector.r.round_trips - round_trips == 3
+    assert len(logger.debug_messages) == 1
+    assert logger.debug_messages[0].startswith('Checked 5 posts, 3 unused, 5 looked up in Redis, ')
+    assert logger.debug_messages[0].endswith(' ms')
+    assert len(logger.info_messages) == 0
+
+
+def test_filter_unused_posts_empty(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    from redis_connector import filter_unused_posts, filter_unused_posts_async
+
+    assert filter_unused_posts([]) == []
+    assert asyncio.run(filter_unused_posts_async(iter(['a', 'b']))) == ['a', 'b']
+
+
+def test_store_posts_in_one_round_trip(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+
+    assert redis_connector.store_posts({'a': 'all', 'b': '123'}, logger)
+    # one round trip for the write, and one to check if the history needs trimming
+    assert redis_connector.r.round_trips == 2
+    assert redis_connector.get_value('a') == 'all'
+    assert redis_connector.get_value('b') == '123'
+    assert logger.info_messages == ['Successfully persisted 2 posts to Redis']
+
+
+def test_store_posts_fails(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', invalid_client)
+    from redis_connector import store_posts_async
+
+    assert not asyncio.run(store_posts_async({'a': 'all', 'b': '123'}, logger))
+    assert logger.warn_messages == ['Failed to persist some of 2 posts to Redis']
+
+
+def test_posting_channel_round_trip(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    from redis_connector import get_posting_channel_async, store_posting_channel_async, delete_posting_channel_async
+
+    assert asyncio.run(get_posting_channel_async(1)) is None
+    asyncio.run(store_posting_channel_async(1, 2))
+    assert asyncio.run(get_posting_channel_async(1)) == 2
+    asyncio.run(delete_posting_channel_async(1))
+    assert asyncio.run(get_posting_channel_async(1)) is None
+
+
+def test_broadcast_slots_round_trip(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    from redis_connector import get_broadcast_slots, store_broadcast_slots
+
+    assert get_broadcast_slots([]) == {}
+    store_broadcast_slots({1: 3600.0, 2: 7200.0})
+    assert get_broadcast_slots([1, 3]) == {1: 3600.0}
+
+
+def test_broadcast_cadences_round_trip(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    from redis_connector import get_broadcast_cadences_async, store_broadcast_cadence_async
+
+    asyncio.run(store_broadcast_cadence_async(1, 4))
+    assert asyncio.run(get_broadcast_cadences_async([1, 2])) == {1: 4}
+
+
+def test_guild_subreddits_round_trip(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    from redis_connector import delete_guild_subreddits_async, get_guild_subreddits_async, \
+        store_guild_subreddits_async
+
+    asyncio.run(store_guild_subreddits_async(1, ['ramen', 'pho']))
+    asyncio.run(store_guild_subreddits_async(2, ['food']))
+    asyncio.run(delete_guild_subreddits_async(2))
+    assert asyncio.run(get_guild_subreddits_async([1, 2])) == {1: ['ramen', 'pho']}
+
+
+def test_warm_filter_skips_redis_for_unused_posts(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+
+    seed_post(redis_connector, k)  # written before the filter existed, e.g. by a previous run
+    assert redis_connector.warm_used_posts_filter(logger) == 1
+    assert logger.info_messages[0].startswith('Loaded 1 keys into the dedup filter')
+    assert not redis_connector.post_already_used('unused')
+    assert redis_connector.post_already_used(k)
+    assert redis_connector.r.lookups == 1
+    assert redis_connector.filter_stats == {'skipped': 1, 'checked': 1}
+
+
+def test_filter_tracks_stored_and_flushed_posts(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+
+    asyncio.run(redis_connector.warm_used_posts_filter_async())
+    redis_connector.store_post_from_server('a', v)
+    redis_connector.store_posts({'b': v})
+    assert redis_connector.filter_unused_posts(['a', 'b', 'c']) == ['c']
+    # 'a' and 'b' are looked up in one round trip, and 'c' doesn't need one
+    assert redis_connector.filter_stats == {'skipped': 0, 'checked': 1}
+    assert redis_connector.filter_unused_posts(['c', 'd']) == ['c', 'd']
+    assert redis_connector.filter_stats == {'skipped': 1, 'checked': 1}
+    redis_connector.flush_all_records()
+    assert 'a' not in redis_connector.used_posts
+
+
+def test_filters_of_two_processes_sharing_redis_stay_in_sync(mocker, monkeypatch):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+
+    # each process (a shard, or an overlapping deployment) has its own filter
+    processes = [{'used_posts': BloomFilter(10000), 'used_posts_warm': False, 'used_posts_synced_to': None,
+                  'used_posts_synced_at': None, 'used_posts_behind': False} for _ in range(2)]
+
+    def run_as(process, call, *args):
+        for name, value in process.items():
+            monkeypatch.setattr(redis_connector, name, value)
+        try:
+            return call(*args)
+        finally:
+            for name in process:
+                process[name] = getattr(redis_connector, name)
+
+    first, second = processes
+    run_as(first, redis_connector.warm_used_posts_filter)
+    run_as(second, redis_connector.warm_used_posts_filter)
+    run_as(first, redis_connector.store_posts, {'a': '1'})
+    run_as(second, redis_connector.store_posts, {'b': '2'})
+    # until the filter is due to sync, it doesn't see the posts the other process recorded
+    assert not run_as(second, redis_connector.post_already_used, 'a')
+    assert redis_connector.filter_stats == {'skipped': 1, 'checked': 0}
+    monkeypatch.setattr(redis_connector, 'SYNC_INTERVAL', 0)
+    assert run_as(second, redis_connector.post_already_used, 'a')
+    assert run_as(first, redis_connector.filter_unused_posts, ['a', 'b', 'c']) == ['c']
+    # posts that no process recorded are still ruled out without looking them up
+    lookups = redis_connector.r.lookups
+    assert run_as(second, redis_connector.filter_unused_posts, ['c', 'd']) == ['c', 'd']
+    assert redis_connector.r.lookups == lookups
+
+
+def test_filter_that_fell_behind_is_warmed_again(mocker, monkeypatch):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+
+    monkeypatch.setattr(redis_connector, 'SYNC_INTERVAL', 0)
+    redis_connector.warm_used_posts_filter()
+    r = redis_connector.r
+    # another process records a post, and the stream is trimmed before this process reads it
+    r.hset(redis_connector.POSTS_KEY, 'a', '1')
+    r.zadd(redis_connector.POSTED_AT_KEY, {'a': redis_connector.clock()})
+    r.xadd(redis_connector.RECORDED_POSTS_KEY, {'ids': 'a'})
+    r.xdel(redis_connector.RECORDED_POSTS_KEY, *[e for e, _ in r.xrange(redis_connector.RECORDED_POSTS_KEY)])
+    r.xadd(redis_connector.RECORDED_POSTS_KEY, {'ids': 'b'})
+    assert redis_connector.filter_unused_posts(['a', 'c']) == ['c']
+    assert not redis_connector.used_posts_warm
+    assert redis_connector.check_health(logger)
+    assert redis_connector.used_posts_warm
+    assert 'a' in redis_connector.used_posts
+
+
+def test_filter_reduces_redis_lookups_per_new_post(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+
+    # a hot listing of 100 posts, where 5 were posted before
+    listing = [f'post{i}' for i in range(100)]
+    for post_id in listing[:5]:
+        seed_post(redis_connector, post_id)
+
+    # without a warm filter, every post is checked in Redis
+    assert len(redis_connector.filter_unused_posts(listing)) == 95
+    assert redis_connector.r.lookups == 100
+
+    redis_connector.warm_used_posts_filter()
+    assert len(redis_connector.filter_unused_posts(listing)) == 95
+    # only the used posts, and the odd false positive, still go to Redis
+    assert redis_connector.r.lookups - 100 < 10
+
+
+def test_flush_only_removes_post_records(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+
+    redis_connector.store_posts({'a': 'all', 'b': '123'})
+    redis_connector.store_posting_channel(1, 2)
+    assert redis_connector.flush_all_records(logger)
+    assert not redis_connector.post_already_used('a')
+    # the stream that keeps other processes' filters in sync is left alone
+    assert set(redis_connector.r.cache) == {redis_connector.CHANNELS_KEY, redis_connector.RECORDED_POSTS_KEY}
+
+
+def test_enumerate_keys_pages_through_posts(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+
+    redis_connector.store_posts({'a': 'all', 'b': '1', 'c': '2'})
+    cursor = redis_connector.enumerate_keys_page(logger, 0, count=2)
+    assert cursor != 0
+    assert asyncio.run(redis_connector.enumerate_keys_page_async(logger, cursor, count=2)) == 0
+    assert logger.info_messages == ['a, b', 'c']
+
+
+def test_migrate_flat_keys(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+
+    r = redis_connector.r
+    r.set('abc123', 'all')
+    r.set('bcd234', '42')
+    r.sadd('unrelated_set', 'x')
+    # string keys that other applications keep in the same database
+    r.set('session:abc', 'token')
+    r.set('feature', 'on')
+    assert redis_connector.migrate_flat_keys(logger) == 2
+    assert logger.info_messages == [f'Migrated 2 posts to the {redis_connector.NAMESPACE} keyspace']
+    assert redis_connector.get_value('abc123') == 'all'
+    assert redis_connector.get_value('bcd234') == '42'
+    assert 'abc123' not in r.cache
+    assert 'unrelated_set' in r.cache
+    assert (r.get('session:abc'), r.get('feature')) == ('token', 'on')
+
+    # it only runs once
+    r.set('cde345', '1')
+    assert asyncio.run(redis_connector.migrate_flat_keys_async()) == 0
+    assert redis_connector.get_value('cde345') is None
+
+
+def test_failed_migration_keeps_flat_keys(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+
+    def write_posts(records, now):
+        raise redis.ConnectionError('Connection reset')
+
+    r = redis_connector.r
+    r.set('abc123', 'all')
+    write = redis_connector._write_posts
+    mocker.patch.object(redis_connector, '_write_posts', write_posts)
+    with pytest.raises(redis.ConnectionError):
+        redis_connector.migrate_flat_keys(logger)
+    assert r.get('abc123') == 'all'
+    assert not r.exists(redis_connector.MIGRATED_KEY)
+    # it's tried again on the next start
+    mocker.patch.object(redis_connector, '_write_posts', write)
+    assert redis_connector.migrate_flat_keys(logger) == 1
+    assert redis_connector.get_value('abc123') == 'all'
+
+
+def test_posts_outside_window_can_be_reused(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+    now = 100 * 24 * 60 * 60
+    mocker.patch.object(redis_connector, 'clock', lambda: now)
+    mocker.patch.object(redis_connector, 'DEDUP_WINDOW', 30 * 24 * 60 * 60)
+
+    seed_post(redis_connector, 'old', now - 31 * 24 * 60 * 60)
+    seed_post(redis_connector, 'recent', now - 29 * 24 * 60 * 60)
+    assert not redis_connector.post_already_used('old')
+    assert redis_connector.post_already_used('recent')
+    assert redis_connector.filter_unused_posts(['old', 'recent', 'new']) == ['old', 'new']
+
+
+def test_writes_trim_expired_posts(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+    now = 100 * 24 * 60 * 60
+    mocker.patch.object(redis_connector, 'clock', lambda: now)
+    mocker.patch.object(redis_connector, 'DEDUP_WINDOW', 10)
+    mocker.patch.object(redis_connector, 'TRIM_BATCH_SIZE', 2)
+
+    for i in range(3):
+        seed_post(redis_connector, f'old{i}', now - 20)
+    redis_connector.store_post_from_server('new', 'all')
+    assert redis_connector.r.zcard(redis_connector.POSTED_AT_KEY) == 2
+    redis_connector.store_post_from_server('newer', 'all')
+    assert redis_connector.r.zrange(redis_connector.POSTED_AT_KEY, 0, -1) == ['new', 'newer']
+    assert set(redis_connector.r.cache[redis_connector.POSTS_KEY]) == {'new', 'newer'}
+
+
+def test_history_keeps_most_recent_posts(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+    times = iter(range(1, 100))
+    mocker.patch.object(redis_connector, 'clock', lambda: next(times))
+    mocker.patch.object(redis_connector, 'DEDUP_MAX_POSTS', 2)
+
+    for post_id in ['a', 'b', 'c']:
+        redis_connector.store_post_from_server(post_id, '1')
+    assert redis_connector.r.zrange(redis_connector.POSTED_AT_KEY, 0, -1) == ['b', 'c']
+    assert redis_connector.get_value('a') is None
+
+
+def test_search_results_round_trip(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    from redis_connector import get_search_results_async, store_search_results_async, flush_all_records
+
+    assert asyncio.run(get_search_results_async('abc')) is None
+    asyncio.run(store_search_results_async('abc', '[]', 60))
+    flush_all_records()  # only removes post records
+    assert asyncio.run(get_search_results_async('abc')) == '[]'
+
+
+def test_image_checks_round_trip(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    from redis_connector import get_image_checks_async, store_image_checks_async
+    import redis_connector
+
+    assert asyncio.run(get_image_checks_async([])) == {}
+    asyncio.run(store_image_checks_async({'a': True, 'b': False}, 60, 10))
+    assert redis_connector.r.round_trips == 1
+    assert asyncio.run(get_image_checks_async(['a', 'b', 'c'])) == {'a': True, 'b': False}
+    assert redis_connector.r.round_trips == 2
+
+
+def test_async_operations_are_measured(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+
+    # the registry is shared with the other tests, so only count the changes
+    stored = redis_connector.operations_total.value(operation='store_posts', outcome='ok')
+    fetched = redis_connector.operation_seconds.count(operation='get_value')
+    asyncio.run(redis_connector.store_posts_async({'a': 'b'}))
+    asyncio.run(redis_connector.get_value_async('a'))
+    assert redis_connector.operations_total.value(operation='store_posts', outcome='ok') == stored + 1
+    assert redis_connector.operation_seconds.count(operation='get_value') == fetched + 1
+    assert 'food_waifu_redis_operations_total{operation="store_posts",outcome="ok"}' in \
+        redis_connector.metrics.registry.render()
+
+
+def test_filter_ignores_posts_recorded_after_selection(mocker):
+    import redis
+    mocker.patch.object(redis, 'from_url', valid_client)
+    import redis_connector
+    now = 100 * 24 * 60 * 60
+    mocker.patch.object(redis_connector, 'clock', lambda: now)
+
+    seed_post(redis_connector, 'before', now - 10)
+    seed_post(redis_connector, 'after', now - 5)
+    assert redis_connector.filter_unused_posts(['before', 'after']) == []
+    assert asyncio.run(redis_connector.filter_unused_posts_async(['before', 'after'], before=now - 8)) == ['after']
+
+
+def test_commands_fail_fast_while_redis_is_down(mocker):
+    import redis
+    client = MockRedisClient()
+    mocker.patch.object(redis, 'from_url', lambda *args, **kwargs: client)
+    client.down = True
+    for _ in range(3):
+        with pytest.raises(redis.ConnectionError):
+            redis_connector.get_value('a')
+    assert redis_connector.breaker.state == 'open'
+
+    # Redis is back, but isn't tried again until the breaker's reset timeout
+    client.down = False
+    unavailable = redis_connector.operations_total.value(operation='get_value', outcome='unavailable')
+    with pytest.raises(redis_connector.RedisUnavailable):
+        asyncio.run(redis_connector.get_value_async('a'))
+    assert client.round_trips == 0
+    assert redis_connector.operations_total.value(operation='get_value', outcome='unavailable') == unavailable + 1
+    redis_connector.breaker.clock.now = 30
+    assert redis_connector.check_health(logger)
+    assert redis_connector.breaker.state == 'closed'
+
+
+def test_posts_recorded_while_redis_is_down_are_reconciled(mocker):
+    import redis
+    client = MockRedisClient()
+    mocker.patch.object(redis, 'from_url', lambda *args, **kwargs: client)
+    mocker.patch.object(redis_connector, 'clock', lambda: 1000.0)
+    client.down = True
+    assert not redis_connector.store_posts({'a': 'all', 'b': '123'})
+    assert len(redis_connector.pending_posts) == 2
+    # the posts still count as used while Redis is down, through the filter and the pending posts
+    assert redis_connector.filter_unused_posts(['a', 'b', 'c'], logger) == ['c']
+    assert logger.warn_messages == ["Checked 3 posts against the local records, since Redis is unavailable: "
+                                    "ConnectionError('Connection refused')"]
+    assert redis_connector.post_already_used('b')
+    redis_connector.used_posts.clear()
+    assert redis_connector.filter_unused_posts(['a', 'b', 'c']) == ['c']
+
+    assert not redis_connector.check_health(logger)
+    client.down = False
+    redis_connector.breaker.clock.now = 30
+    assert redis_connector.check_health(logger)
+    assert len(redis_connector.pending_posts) == 0
+    assert client.cache[redis_connector.POSTED_AT_KEY] == {'a': 1000.0, 'b': 1000.0}
+    assert client.cache[redis_connector.POSTS_KEY] == {'a': 'all', 'b': '123'}
+    assert logger.info_messages[-1] == 'Wrote 2 posts that were recorded while Redis was down to Redis (0 were dropped)'
+    assert redis_connector.filter_unused_posts(['a', 'b', 'c']) == ['c']
+
+
+def test_pending_posts_are_bounded():
+    pending = redis_connector.PendingPosts(2)
+    pending.add({'a': 'all', 'b': 'all'}, 1)
+    pending.add({'c': '123'}, 2)
+    assert [post_id for post_id, _ in pending.items()] == ['b', 'c']
+    assert pending.dropped == 1
+    written = dict(pending.items())
+    # recorded again while the first record was being written
+    pending.add({'c': '456'}, 3)
+    pending.remove(written)
+    assert pending.items() == [('c', ('456', 3))]
+
+
+# starts a Redis server on the given port, that doesn't save anything to disk
+def start_redis_server(port: int):
+    import subprocess
+    import time
+    import redis
+    server = subprocess.Popen(['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'],
+                              stdout=subprocess.DEVNULL)
+    client = redis.Redis(port=port)
+    for _ in range(100):
+        try:
+            client.ping()
+            return server
+        except redis.ConnectionError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError('Redis server did not start')
+
+
+@pytest.mark.skipif(shutil.which('redis-server') is None, reason='needs redis-server installed')
+def test_bot_keeps_deduplicating_while_redis_restarts(monkeypatch):
+    import socket
+    import redis
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    monkeypatch.setenv('REDIS_URL', f'redis://127.0.0.1:{port}')
+    monkeypatch.setattr(redis_connector, 'SOCKET_TIMEOUT', 0.5)
+    monkeypatch.setattr(redis_connector, 'CONNECT_TIMEOUT', 0.5)
+
+    server = start_redis_server(port)
+    try:
+        assert redis_connector.store_posts({'a': 'all'})
+        server.kill()
+        server.wait()
+        assert not redis_connector.store_posts({'b': '123'})
+        assert redis_connector.filter_unused_posts(['a', 'b', 'c']) == ['c']
+        for _ in range(3):
+            redis_connector.check_health()
+        assert redis_connector.breaker.state == 'open'
+
+        # the restarted server lost everything, so the pending post is all that's written back
+        server = start_redis_server(port)
+        redis_connector.breaker.clock.now = 30
+        assert redis_connector.check_health(logger)
+        assert redis.Redis(port=port, decode_responses=True).hgetall(redis_connector.POSTS_KEY) == {'b': '123'}
+        assert redis_connector.filter_unused_posts(['a', 'b', 'c']) == ['a', 'c']
+    finally:
+        server.kill()
+        server.wait()
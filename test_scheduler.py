@@ -0,0 +1,154 @@
+# Tests for deciding when each guild gets its scheduled post
+from scheduler import BroadcastScheduler, SECONDS_PER_HOUR
+from functools import partial
+import asyncio
+import pytest
+
+
+class FakeClock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+# in-memory stand-in for the persisted schedule in Redis
+class DummyStore:
+    def __init__(self):
+        self.slots = {}
+        self.cadences = {}
+
+    async def load_slots(self, guild_ids):
+        return {g: self.slots[g] for g in guild_ids if g in self.slots}
+
+    async def save_slots(self, slots):
+        self.slots.update(slots)
+
+    async def load_cadences(self, guild_ids):
+        return {g: self.cadences[g] for g in guild_ids if g in self.cadences}
+
+    async def save_cadence(self, guild_id, hours):
+        self.cadences[guild_id] = hours
+
+
+def make_scheduler(store: DummyStore, clock: FakeClock, **kwargs) -> BroadcastScheduler:
+    return BroadcastScheduler(store.load_slots, store.save_slots, store.load_cadences, store.save_cadence,
+                              clock=clock, **kwargs)
+
+
+def test_offsets_are_spread_over_window_and_stable():
+    scheduler = make_scheduler(DummyStore(), FakeClock(0), window=300, buckets=10)
+    offsets = {scheduler.offset(g) for g in range(1000)}
+    assert len(offsets) == 10
+    assert min(offsets) == 0
+    assert max(offsets) == 270
+    assert scheduler.offset(1234) == make_scheduler(DummyStore(), FakeClock(0)).offset(1234)
+
+
+def test_new_guild_waits_for_next_deadline():
+    store = DummyStore()
+    clock = FakeClock(10 * SECONDS_PER_HOUR + 1000)
+    scheduler = make_scheduler(store, clock, window=0)
+    assert asyncio.run(scheduler.due_guilds([1])) == []
+    assert store.slots == {1: 10 * SECONDS_PER_HOUR}
+    clock.now = 11 * SECONDS_PER_HOUR
+    assert asyncio.run(scheduler.due_guilds([1])) == [1]
+
+
+def test_fires_once_per_slot_across_restarts():
+    store = DummyStore()
+    store.slots[1] = 9 * SECONDS_PER_HOUR
+    clock = FakeClock(10 * SECONDS_PER_HOUR + 5)
+    scheduler = make_scheduler(store, clock, window=0)
+    assert asyncio.run(scheduler.due_guilds([1])) == [1]
+    asyncio.run(scheduler.mark_fired([1]))
+
+    # a restart in the same slot doesn't post again
+    restarted = make_scheduler(store, clock, window=0)
+    assert asyncio.run(restarted.due_guilds([1])) == []
+
+
+def test_missed_slots_are_posted_once():
+    store = DummyStore()
+    store.slots[1] = 5 * SECONDS_PER_HOUR
+    clock = FakeClock(10 * SECONDS_PER_HOUR + 5)
+    scheduler = make_scheduler(store, clock, window=0)
+    assert asyncio.run(scheduler.due_guilds([1])) == [1]
+    asyncio.run(scheduler.mark_fired([1]))
+    assert asyncio.run(scheduler.due_guilds([1])) == []
+
+
+def test_cadence_spaces_out_posts():
+    store = DummyStore()
+    store.cadences[1] = 3
+    store.slots[1] = 9 * SECONDS_PER_HOUR
+    clock = FakeClock(10 * SECONDS_PER_HOUR)
+    scheduler = make_scheduler(store, clock, window=0)
+    assert asyncio.run(scheduler.due_guilds([1])) == []
+    assert scheduler.next_deadline(1, clock.now) == 12 * SECONDS_PER_HOUR
+
+
+def test_set_cadence_rejects_less_than_an_hour():
+    store = DummyStore()
+    scheduler = make_scheduler(store, FakeClock(0))
+    asyncio.run(scheduler.set_cadence(1, 2))
+    assert store.cadences == {1: 2}
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.set_cadence(1, 0))
+
+
+def test_wait_for_due_groups_guilds_by_offset():
+    store = DummyStore()
+    clock = FakeClock(0)
+    scheduler = make_scheduler(store, clock, window=300, buckets=10)
+    guild_ids = list(range(50))
+    for g in guild_ids:
+        store.slots[g] = -SECONDS_PER_HOUR + scheduler.offset(g)
+    clock.now = SECONDS_PER_HOUR  # every guild's slot in the last hour has come due
+    groups = asyncio.run(scheduler.wait_for_due(lambda: guild_ids))
+    assert sorted(g for group in groups for g in group) == guild_ids
+    assert len(groups) == 10
+    for group in groups:
+        assert len({scheduler.offset(g) for g in group}) == 1
+
+
+def test_claimed_slots_are_only_posted_by_one_scheduler():
+    store = DummyStore()
+    store.cadences[2] = 3
+    store.slots = {1: 11 * SECONDS_PER_HOUR, 2: 9 * SECONDS_PER_HOUR}
+    claims = {}
+
+    async def claim_slots(owner, slots, ttl):
+        return [g for g, start in slots.items() if claims.setdefault((g, start), (owner, ttl))[0] == owner]
+
+    clock = FakeClock(12 * SECONDS_PER_HOUR)
+    first = make_scheduler(store, clock, window=0, claim_slots=partial(claim_slots, 'first'))
+    second = make_scheduler(store, clock, window=0, claim_slots=partial(claim_slots, 'second'))
+    assert asyncio.run(first.due_guilds([1, 2])) == [1, 2]
+    assert asyncio.run(second.due_guilds([1, 2])) == [1, 2]
+    assert asyncio.run(first.claim([1, 2])) == [1, 2]
+    # the claims outlast the longest cadence
+    assert claims[(1, clock.now)] == ('first', 6 * SECONDS_PER_HOUR)
+    # a process that fires the same slots finds them claimed, and doesn't post them
+    assert asyncio.run(second.claim([1, 2])) == []
+    assert asyncio.run(second.due_guilds([1, 2])) == []
+    assert asyncio.run(first.claim([])) == []
+
+    # the slots only fire once their posts are queued, so a failed broadcast is claimed again
+    assert asyncio.run(first.due_guilds([1, 2])) == [1, 2]
+    assert asyncio.run(first.claim([1, 2])) == [1, 2]
+    asyncio.run(first.mark_fired([1, 2]))
+    assert asyncio.run(first.due_guilds([1, 2])) == []
+    assert store.slots == {1: clock.now, 2: clock.now}
+
+
+def test_guilds_in_the_same_bucket_share_a_broadcast_key():
+    clock = FakeClock(10 * SECONDS_PER_HOUR + 200)
+    scheduler = make_scheduler(DummyStore(), clock, window=300, buckets=10)
+    by_offset = {}
+    for g in range(100):
+        by_offset.setdefault(scheduler.offset(g), set()).add(scheduler.broadcast_key(g))
+    for offset, keys in by_offset.items():
+        start = 10 * SECONDS_PER_HOUR + offset if offset <= 200 else 9 * SECONDS_PER_HOUR + offset
+        assert keys == {str(int(start))}
@@ -0,0 +1,86 @@
+# Tests for caching search results
+from food_post import FoodPost
+from search_cache import SearchCache
+import asyncio
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+# in-memory stand-in for the shared cache in Redis
+class DummyStore:
+    def __init__(self):
+        self.payloads = {}
+
+    async def load(self, key):
+        return self.payloads.get(key)
+
+    async def save(self, key, payload, ttl):
+        self.payloads[key] = payload
+
+
+class CountingSearch:
+    def __init__(self, *ids: str):
+        self.calls = 0
+        self.posts = [FoodPost(id=i, title=i, permalink=f'/r/food/{i}', image_url=f'https://i.redd.it/{i}.jpg')
+                      for i in ids]
+
+    async def __call__(self):
+        self.calls += 1
+        return self.posts
+
+
+def test_repeated_search_is_served_from_cache():
+    cache = SearchCache(clock=FakeClock())
+    search = CountingSearch('a', 'b')
+
+    first = asyncio.run(cache.get_or_search(['food'], 'title:"pho" self:no', search))
+    second = asyncio.run(cache.get_or_search(['food'], 'title:"pho" self:no', search))
+    assert [p.id for p in first] == ['a', 'b']
+    assert [p.id for p in second] == ['a', 'b']
+    assert search.calls == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_key_is_normalized():
+    assert SearchCache.key(['b', 'A'], 'title:"Pho"  self:no') == SearchCache.key(['a', 'b'], 'title:"pho" self:no')
+    assert SearchCache.key(['a'], 'pho') != SearchCache.key(['a'], 'pho', 'month')
+    assert SearchCache.key(['a'], 'pho') != SearchCache.key(['a', 'b'], 'pho')
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = SearchCache(ttl=10, clock=clock)
+    search = CountingSearch('a')
+    asyncio.run(cache.get_or_search(['food'], 'pho', search))
+    clock.now = 11
+    asyncio.run(cache.get_or_search(['food'], 'pho', search))
+    assert search.calls == 2
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SearchCache(max_entries=2, clock=FakeClock())
+    search = CountingSearch('a')
+    for query in ['a', 'b', 'a', 'c']:
+        asyncio.run(cache.get_or_search(['food'], query, search))
+    assert search.calls == 3
+    assert asyncio.run(cache.get(['food'], 'a')) is not None
+    assert asyncio.run(cache.get(['food'], 'b')) is None
+
+
+def test_results_are_shared_between_processes():
+    store = DummyStore()
+    search = CountingSearch('a', 'b')
+    asyncio.run(SearchCache(store.load, store.save).get_or_search(['food'], 'pho', search))
+
+    other = SearchCache(store.load, store.save)
+    posts = asyncio.run(other.get_or_search(['food'], 'pho', search))
+    assert search.calls == 1
+    assert [p.id for p in posts] == ['a', 'b']
+    assert posts[0].image_url == 'https://i.redd.it/a.jpg'
+    assert posts[0].post_url == '/r/food/a'
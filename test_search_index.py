@@ -0,0 +1,85 @@
+# Tests for the local full-text search index
+from search_index import SearchIndex, parse_query
+from utility import build_query
+import asyncio
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class DummySubreddit:
+    def __init__(self, name: str):
+        self.display_name = name
+
+
+class DummySubmission:
+    def __init__(self, submission_id: str, title: str, subreddit: str = 'FoodPorn', is_self: bool = False):
+        self.id = submission_id
+        self.title = title
+        self.subreddit = DummySubreddit(subreddit)
+        self.permalink = f'/r/{subreddit}/comments/{submission_id}/'
+        self.url = f'https://i.redd.it/{submission_id}.jpg'
+        self.is_self = is_self
+
+
+def make_index(clock=None) -> SearchIndex:
+    return SearchIndex(':memory:', stale_after=60, retention=3600, clock=clock or FakeClock())
+
+
+def test_parse_query_understands_built_queries():
+    assert parse_query(build_query(['beef', 'pho'])) == ('title : "beef pho"', True)
+    assert parse_query('title:"say ""cheese"""') == ('title : "say """"cheese"""""', False)
+    assert parse_query('pho OR ramen') is None
+
+
+def test_search_finds_title_phrase_in_subreddits():
+    index = make_index()
+    index.add_submissions([
+        DummySubmission('a', 'Homemade beef pho'),
+        DummySubmission('b', 'Pho with beef'),
+        DummySubmission('c', 'Beef pho at a restaurant', subreddit='other'),
+        DummySubmission('d', 'My beef pho recipe', is_self=True),
+    ])
+    results = index.search(['foodporn'], build_query(['beef', 'pho']))
+    assert [p.id for p in results] == ['a']
+    assert results[0].post_url == 'https://www.reddit.com/r/FoodPorn/comments/a/'
+    assert results[0].image_url == 'https://i.redd.it/a.jpg'
+    assert [p.id for p in index.search(['FoodPorn'], 'title:"beef pho"')] == ['a', 'd']
+
+
+def test_search_misses_fall_through():
+    index = make_index()
+    index.add_submissions([DummySubmission('a', 'Ramen')])
+    assert index.search(['foodporn'], build_query(['pho'])) is None
+    assert index.search(['foodporn'], 'ramen') is None
+
+
+def test_stale_results_fall_through():
+    clock = FakeClock()
+    index = make_index(clock)
+    index.add_submissions([DummySubmission('a', 'Ramen')])
+    clock.now += 61
+    assert index.search(['foodporn'], build_query(['ramen'])) is None
+    # seeing the submission again refreshes it
+    index.add_submissions([DummySubmission('a', 'Ramen')])
+    assert [p.id for p in index.search(['foodporn'], build_query(['ramen']))] == ['a']
+
+
+def test_old_submissions_are_removed():
+    clock = FakeClock()
+    index = make_index(clock)
+    index.add_submissions([DummySubmission('a', 'Ramen')])
+    clock.now += 3601
+    index.add_submissions([DummySubmission('b', 'Ramen bowl')])
+    assert [p.id for p in index.search(['foodporn'], build_query(['ramen']))] == ['b']
+
+
+def test_async_api():
+    index = make_index()
+    asyncio.run(index.add_submissions_async(iter([DummySubmission('a', 'Tacos')])))
+    assert [p.id for p in asyncio.run(index.search_async(['foodporn'], build_query(['tacos'])))] == ['a']
@@ -1,5 +1,6 @@
 # Tests for the utility functions
-from utility import read_subreddits_from_env, build_query
+from utility import read_subreddits_from_env, read_shards_from_env, build_query, get_text_channel, interleave
+from mock_discord import DummyChannel, DummyGuild
 import pytest
 
 
@@ -36,3 +37,47 @@ def test_read_from_env_works(monkeypatch):
     monkeypatch.setenv('SUBREDDITS', sub_str)
     subs = read_subreddits_from_env()
     assert subs == sub_str.split(',')
+
+
+def test_get_text_channel_picks_top_channel_regardless_of_order():
+    top, tie, bottom = DummyChannel(2, 0), DummyChannel(1, 0), DummyChannel(3, 5)
+    assert get_text_channel(DummyGuild(10, [bottom, top, tie])) is tie
+    assert get_text_channel(DummyGuild(10, [tie, bottom, top])) is tie
+
+
+def test_get_text_channel_returns_none_without_permissions():
+    assert get_text_channel(DummyGuild(10, [DummyChannel(1, 0, can_send=False), object()])) is None
+
+
+def test_read_shards_defaults_to_unsharded(monkeypatch):
+    monkeypatch.delenv('SHARD_COUNT', raising=False)
+    monkeypatch.delenv('SHARD_IDS', raising=False)
+    assert read_shards_from_env() == (None, None)
+
+
+def test_read_shards_works(monkeypatch):
+    monkeypatch.setenv('SHARD_COUNT', '4')
+    monkeypatch.delenv('SHARD_IDS', raising=False)
+    assert read_shards_from_env() == (4, None)
+    monkeypatch.setenv('SHARD_IDS', '1,3')
+    assert read_shards_from_env() == (4, [1, 3])
+
+
+def test_read_shards_fails_on_invalid_ids(monkeypatch):
+    monkeypatch.setenv('SHARD_COUNT', '2')
+    monkeypatch.setenv('SHARD_IDS', '2')
+    with pytest.raises(ValueError):
+        read_shards_from_env()
+    monkeypatch.delenv('SHARD_COUNT')
+    with pytest.raises(ValueError):
+        read_shards_from_env()
+
+
+def test_interleave_takes_from_each_list_in_turn():
+    class Post:
+        def __init__(self, post_id):
+            self.id = post_id
+
+    lists = [[Post('a'), Post('b'), Post('c')], [Post('x'), Post('a')], []]
+    assert [p.id for p in interleave(lists)] == ['a', 'x', 'b', 'c']
+    assert interleave([]) == []
@@ -1,5 +1,5 @@
 # Collection of utility functions that are used by the main script.
-from typing import List, Optional
+from typing import Iterable, List, Optional, Tuple
 import os
 from discord import TextChannel
 
@@ -19,22 +19,47 @@ def read_subreddits_from_env() -> List[str]:
         return subs_str.split(',')
 
 
+# Read the sharding configuration from the environment. "SHARD_COUNT" is the
+# total number of shards, and "SHARD_IDS" is the comma delimited list of the
+# shards that this process runs (all of them if it isn't defined).
+# Returns (None, None) if "SHARD_COUNT" isn't defined, meaning the bot isn't sharded.
+# If the shard IDs aren't all within the shard count, raises a ValueError
+def read_shards_from_env() -> Tuple[Optional[int], Optional[List[int]]]:
+    if "SHARD_COUNT" not in os.environ:
+        if "SHARD_IDS" in os.environ:
+            raise ValueError('SHARD_IDS cannot be defined without SHARD_COUNT')
+        return None, None
+    shard_count = int(os.environ["SHARD_COUNT"])
+    if shard_count < 1:
+        raise ValueError('SHARD_COUNT must be at least 1')
+    if len(os.environ.get("SHARD_IDS", "")) < 1:
+        return shard_count, None
+    shard_ids = [int(s) for s in os.environ["SHARD_IDS"].split(',')]
+    if any(s < 0 or s >= shard_count for s in shard_ids):
+        raise ValueError(f'SHARD_IDS must be between 0 and {shard_count - 1}')
+    return shard_count, shard_ids
+
+
 # takes a Guild object and returns the first channel that the bot has access to post to.
 # this is determined by using the Channel class's `permissions_for(..)` function
 # This function returns None for the given guild if it could not find a TextChannel
 # that it has send_message permissions for.
-# Note that the iteration over the channels in the guild are up to the
-# underlying implementation, and not necessarily guaranteed to maintain
-# a consistent ordering. As such, this function cannot be expected to be
-# deterministic.
+# Channels are checked in the order they are shown in the Discord client (by position,
+# then ID to break ties), so the same guild always resolves to the same channel.
 def get_text_channel(guild) -> Optional[TextChannel]:
     member = guild.me
-    for channel in guild.channels:
-        if isinstance(channel, TextChannel) and channel.permissions_for(member).send_messages:
+    channels = [c for c in guild.channels if isinstance(c, TextChannel)]
+    for channel in sorted(channels, key=lambda c: (c.position, c.id)):
+        if can_send_messages(channel, member):
             return channel
     return None
 
 
+# returns True if the given member is allowed to send messages in the channel
+def can_send_messages(channel, member) -> bool:
+    return channel.permissions_for(member).send_messages
+
+
 # takes a query for searching and applies the necessary restrictions
 # we want to limit our searches to just the title of the post, and also
 # exclude all self posts (text posts)
@@ -45,3 +70,18 @@ def build_query(search_terms: List[str]) -> str:
         raise ValueError('Cannot search on no terms')
     joined = ' '.join(search_terms)
     return f'title:"{joined}" self:no'
+
+
+# merges the given lists (of submissions or posts) by taking one item from each
+# list in turn, so that every list is represented near the front. An item whose
+# ID was already taken from an earlier list is skipped
+def interleave(lists: Iterable[list]) -> list:
+    lists = list(lists)
+    merged = []
+    seen = set()
+    for i in range(max((len(items) for items in lists), default=0)):
+        for items in lists:
+            if i < len(items) and items[i].id not in seen:
+                seen.add(items[i].id)
+                merged.append(items[i])
+    return merged